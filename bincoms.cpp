@@ -16,6 +16,8 @@
 #include "bincoms.h"
 
 uint8_t buff[BUFFSIZE];
+// FNV-1a hash of the command table as 8 hexadecimal digits
+char fingerprint[9];
 #if defined(HAVE_HWSERIAL0)
 struct Com<HardwareSerial>  client(&Serial);
 #else
@@ -29,16 +31,42 @@ void command_count(uint8_t rb){
 }
 
 void get_command_names(uint8_t rb){
+  /* Describe the function nfunc
+   *
+   * par 0, 1, 2 return respectively the name, argument format and
+   * answer format of the function. par 3 returns the fingerprint of the
+   * whole command table (independently of nfunc) so that the host can
+   * reuse a previously decoded table.
+   */
   uint8_t nfunc = client.read_buffer[rb++];
   uint8_t par = client.read_buffer[rb++];
   if (nfunc >= NFUNC)
     client.sndstatus(UNDEFINED_FUNCTION_ERROR);
+  else if (par == 3)
+    client.sndstr(fingerprint);
   else if (par > 2)
     client.sndstatus(VALUE_ERROR);
   else
     client.sndstr(command_names[nfunc * 3 + par]);
 }
 
+void compute_fingerprint(){
+  uint32_t h = 2166136261UL;
+  for (uint8_t i = 0; i < NFUNC * 3; i++){
+    const char * c = command_names[i];
+    do{
+      h ^= (uint8_t) *c;
+      h *= 16777619UL;
+    } while (*c++);
+  }
+  for (int8_t i = 7; i >= 0; i--){
+    uint8_t d = h & 0xF;
+    fingerprint[i] = d < 10 ? '0' + d : 'a' + d - 10;
+    h >>= 4;
+  }
+  fingerprint[8] = 0;
+}
+
 void setup_bincom(){
   Serial.begin(115200);
   //Serial.begin(1000000);
@@ -71,6 +99,7 @@ void setup_bincom(){
       }
     }
   }
+  compute_fingerprint();
   //disable interrupt Data register empty
   UCSR0B &= ~_BV(UDRIE0);
   //disable interrupt receive complete
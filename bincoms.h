@@ -47,6 +47,9 @@ struct Com{
   uint8_t wb, we, rb, re;
   uint8_t wait;
   bool message;
+  // Called by serve_serial when no complete message is waiting, the
+  // application can use it to send unsolicited frames (see sndevent)
+  void (*idle)();
   
   Com(com *c){
     client = c;
@@ -56,6 +59,7 @@ struct Com{
     re = 0;
     wait=3;
     message=false;
+    idle=0;
   }
 
   void serve_serial(){
@@ -75,6 +79,8 @@ struct Com{
 	else
 	  rcv_header();
       }
+      else if (idle)
+	idle();
     }
   }
 
@@ -92,6 +98,22 @@ struct Com{
   }
 
 
+  void sndevent(uint8_t code, uint8_t * address, uint8_t len){
+    /* Send an unsolicited frame. It starts with 'e' instead of 'b' so
+     * that the host can tell it from the answers.
+     */
+    write('e');
+    write(code);
+    write(len);
+    for(int i=0; i < len; i++)
+      write(address[i]);
+  }
+
+  uint8_t room(){
+    // Free space in the write buffer
+    return wb - we - 1;
+  }
+
   void sndstr(const char * str){
     uint8_t len = strlen(str);
     snd((uint8_t *) str, len); 
@@ -105,10 +127,12 @@ struct Com{
     if (read_buffer[rb++] != 'b'){
       rb = re; //flushing
       sndstatus(COMMUNICATION_ERROR);
+      return;
     }
     if (read_buffer[rb++] != STATUS_OK){
       rb = re; //flushing
       sndstatus(COMMUNICATION_ERROR);
+      return;
     }
     uint8_t len = read_buffer[rb++];
     if (len > 0){
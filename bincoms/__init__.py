@@ -14,14 +14,15 @@
 
 import struct
 import time
-import numpy as np
-import serial
+import collections
 import types
 import os
 import select
-from serial.serialutil import Timeout
+import json
 import termios
 
+from bincoms.metrics import Metrics
+
 status_codes = ['STATUS_OK',
                 'STATUS_BUSY',
                 'STATUS_ERROR',
@@ -40,49 +41,246 @@ status_message = ['Action performed successfully',
                   'Not used for now',
                   'The provided arguments are outside the allowed range']
 
-def find_devices():
-    """Discover all bincom compatible devices."""
+# The two protocol functions implemented by bincoms.cpp itself. Their
+# description is hashed by the firmware along with the user functions.
+protocol_commands = [('command_count', '', 'B'),
+                     ('get_command_names', 'BB', 's')]
+
+def cache_dir():
+    """Return the directory holding the decoded command tables."""
+    root = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(root, 'bincoms')
+
+def table_fingerprint(table):
+    """Compute the 32-bit FNV-1a hash of a command table as done by the firmware.
+
+    The table is the list of (name, argument format, answer format)
+    triplets for all functions, protocol functions included.
+    """
+    h = 0x811c9dc5
+    for command in table:
+        for field in command:
+            for c in field.encode() + b'\0':
+                h = ((h ^ c) * 0x01000193) & 0xffffffff
+    return f'{h:08x}'
+
+def serial_number(dev):
+    """Return the USB serial number of the adapter behind dev (None if unknown)."""
     import serial.tools.list_ports
-    ports = serial.tools.list_ports.comports()
-    devices = []
-    for port in ports:
-        if port.vid is not None:
-            try:
-                device = SerialBC(dev=port.device)
-                devices.append(port.device)
-            except ValueError:
-                pass
-    return devices
+    real = os.path.realpath(dev)
+    for port in serial.tools.list_ports.comports():
+        if os.path.realpath(port.device) == real:
+            return port.serial_number
+    return None
+
+def open_port(dev, baudrate=115200, timeout=3):
+    """Open the serial port dev without resetting the device at hangup."""
+    import serial
+    # Disable reset after hangup
+    f=os.open(dev, os.O_RDWR | os.O_NOCTTY | os.O_NONBLOCK)
+    try:
+        attrs = termios.tcgetattr(f)
+        attrs[2] = attrs[2] & ~termios.HUPCL
+        termios.tcsetattr(f, termios.TCSAFLUSH, attrs)
+    finally:
+        os.close(f)
+    return serial.Serial(dev, baudrate=baudrate, timeout=timeout, dsrdtr=None)
+
+def probe(dev, baudrate=115200, timeout=1):
+    """Check whether a bincoms device answers on dev.
+
+    Only the command_count function is queried, with a deadline of
+    timeout seconds for the whole exchange.
+    """
+    import serial
+    try:
+        com = open_port(dev, baudrate, timeout)
+    except (OSError, termios.error, serial.SerialException):
+        return False
+    try:
+        com.reset_input_buffer()
+        com.write(b'b\x00\x01\x00')
+        return com.read(4)[:3] == b'b\x00\x01'
+    except (OSError, serial.SerialException):
+        return False
+    finally:
+        com.close()
+
+def find_devices(timeout=1, max_workers=16):
+    """Discover all bincom compatible devices.
+
+    The USB serial ports are probed concurrently.
+
+    Args:
+        timeout (float): time allowed to each port to answer.
+        max_workers (int): maximum number of ports probed simultaneously.
+    """
+    import serial.tools.list_ports
+    from concurrent.futures import ThreadPoolExecutor
+    ports = [port.device for port in serial.tools.list_ports.comports() if port.vid is not None]
+    if not ports:
+        return []
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(ports))) as pool:
+        found = list(pool.map(lambda dev: probe(dev, timeout=timeout), ports))
+    return [dev for dev, ok in zip(ports, found) if ok]
             
-def _command_factory(self, f, s, a):
-    def func(self, *args):
+# Answer header: 'b', status code, payload length
+_header = struct.Struct('BBB')
+
+
+class CommunicationError(ValueError):
+    """The answer stream is not aligned on the requests anymore."""
+
+class Batch(object):
+    """ Accumulate device function calls to execute them pipelined
+
+    Obtained from SerialBC.batch(). Calling a device function on the
+    batch returns a concurrent.futures.Future. All the requests are sent
+    when leaving the with block and the futures are resolved, in order,
+    with the decoded answers or the error reported for that specific call.
+    """
+    def __init__(self, device):
+        self._device = device
+        self._requests = []
+
+    def __getattr__(self, name):
+        method = getattr(self._device, name)
+        if not hasattr(method, 'encode'):
+            raise AttributeError(f'{name} is not a device function')
+        def deferred(*args):
+            from concurrent.futures import Future
+            future = Future()
+            self._requests.append((method, method.frame(*args), future))
+            return future
+        return deferred
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        requests, self._requests = self._requests, []
+        if exc_type is None:
+            self._device._pipeline(requests)
+        else:
+            for method, frame, future in requests:
+                future.cancel()
+
+class _Answer(object):
+    """ Receive the answer to a request of call_many
+
+    A lighter stand-in for the Future of a Batch, with the methods used
+    by SerialBC._pipeline.
+    """
+    __slots__ = ('value', 'error')
+
+    def __init__(self):
+        self.value = self.error = None
+
+    def set_result(self, value):
+        self.value = value
+
+    def set_exception(self, error):
+        self.error = error
+
+class Codec(object):
+    """ Precompiled encoder and decoder of a device function
+
+    Args:
+        f (int): function code.
+        s (bytes): struct format of the arguments.
+        a (bytes): struct format of the answer, or b's' for a string.
+    """
+    def __init__(self, f, s, a):
+        self.f = f
+        # The whole request frame: header and function code, then arguments
+        self.request = struct.Struct(b'<4s' + s)
+        self.prefix = struct.pack(b'ccBB', b'b', b'\x00', self.request.size - 3, f)
+        # pack_into(buffer, 0, prefix, *args) writes the frame in buffer
+        self.pack_into = self.request.pack_into
+        self.size = self.request.size
+        self.arg_format = s
+        self.answer_format = a
+        if a == b's':
+            self.answer = None
+            self.answer_size = 3 + 64
+            self.expected = None
+        else:
+            # The mcu sends packed little-endian values
+            self.answer = struct.Struct(b'<' + a)
+            self.answer_size = 3 + self.answer.size
+            # Length of the payload of a successful answer
+            self.expected = self.answer.size
+            self.single = len(self.answer.unpack(bytes(self.answer.size))) == 1
+
+    def frame(self, *args):
+        ''' Return the request frame as bytes '''
         try:
-            data = struct.pack(b'<B' + s, f, *args)
+            return self.request.pack(self.prefix, *args)
         except struct.error:
-            raise ValueError(f'Provided arguments {args} do not match the requested types {s}')
-        if self.debug:
-            print(f'Encoding request with arguments {args} according to format {b"B"+s} as: {data}')
-        r = self.snd(data)
-        if a == b's':
-            if self.debug:
-                print(f'data: {r}')
-            return r.decode()
+            raise self.argument_error(args)
+
+    def argument_error(self, args):
+        return ValueError(f'Provided arguments {args} do not match the requested types {self.arg_format}')
+
+    def decode(self, r):
+        ''' Decode the answer payload r (any bytes-like object) '''
+        if self.answer is None:
+            return str(r, 'utf-8')
+        if len(r) != self.answer.size:
+            raise ValueError(f'Received answer "{bytes(r)}" does not match the expected argument format: "{self.answer_format}"')
+        answer = self.answer.unpack_from(r)
+        if self.single:
+            return answer[0]
         else:
-            try:
-                answer = struct.unpack(a, r)
-                if self.debug:
-                    print(f'data: {answer}')
-                if len(answer) == 1:
-                    return answer[0]
-                else:
-                    return answer
-            except:
-                buffer = self.flush()
-                raise ValueError(f'Received answer "{r}" does not match the expected argument format: "{a}", trailing bytes:{buffer}')
+            return answer
+
+# Codecs are immutable and shared by all the devices with the same command table
+_codecs = {}
+
+def get_codec(f, s, a):
+    key = (f, s, a)
+    if key not in _codecs:
+        _codecs[key] = Codec(f, s, a)
+    return _codecs[key]
+
+def _command_factory(self, f, s, a):
+    codec = get_codec(f, s, a)
+    def func(self, *args):
+        return self._transact(codec, args)
+    func.codec = codec
+    func.frame = codec.frame
+    func.encode = lambda *args: codec.frame(*args)[3:]
+    func.decode = codec.decode
+    # Upper bound on the answer size, used to limit the pipelining depth
+    func.answer_size = codec.answer_size
     return types.MethodType(func, self)
 
 class SerialBC(object):
-    def __init__(self, dev='/dev/ttyUSB0', baudrate=115200, debug=False, reset=False):
+    # Maximum number of bytes (requests plus expected answers) in flight
+    # during pipelined execution. It must stay well below the 256 bytes
+    # of the firmware ring buffers.
+    pipeline_window = 128
+    # Time to wait for the answer to a synchronisation request before
+    # sending a new one
+    sync_interval = 0.1
+    # Callable invoked as on_event(code, payload) for each unsolicited
+    # event frame ('e', code, len, payload) sent by the device. Event
+    # frames are never answers and are dropped when it is None.
+    on_event = None
+
+    def __init__(self, dev='/dev/ttyUSB0', baudrate=115200, debug=False, reset=False, cache=True):
+        ''' Open the connection and register the device functions as methods
+
+        Args:
+            dev (str): path to the serial device. If empty, attempt to autodetect it.
+            baudrate (int): communication speed.
+            debug (bool): print communication debugging info.
+            reset (bool): hard reset the device before connecting.
+            cache (bool): reuse the command table decoded during a
+                previous connection to the same device when the firmware
+                fingerprint still matches. The table is stored in
+                cache_dir() along with the values recorded by cached().
+        '''
         if not dev:
             devices = find_devices()
             if len(devices) == 1:
@@ -95,6 +293,20 @@ class SerialBC(object):
         self.debug=debug
         self._dev = dev
         self._baudrate = baudrate
+        self._use_cache = cache
+        self._cache_file = None
+        # Whether the cache entry is known to belong to this very device
+        self._cache_identified = False
+        # Communication statistics
+        self.metrics = Metrics(dev)
+        self.metrics.names = self._command_names = [c[0] for c in protocol_commands]
+        # How often, and at which cost, the answer stream was realigned
+        self.resync_counters = self.metrics.resync
+        self._sync_count = 0
+        # Size of the longest answer received from each function
+        # answering a string, by function code (see _pipeline)
+        self._string_sizes = {}
+        self.cache = {}
         self._open(reset=reset)
         #self.com.set_low_latency_mode(True)
         #time.sleep(5)
@@ -111,19 +323,24 @@ class SerialBC(object):
             self.com.close()
         except:
             pass
-        # Disable reset after hangup
         if self.debug:
             print('Port closed')
-        f=os.open(self._dev, os.O_RDWR | os.O_NOCTTY | os.O_NONBLOCK)
-        attrs = termios.tcgetattr(f)
-        attrs[2] = attrs[2] & ~termios.HUPCL
-        termios.tcsetattr(f, termios.TCSAFLUSH, attrs)
-        os.close(f)
-        if self.debug:
-            print('Port set')
+        import serial
+        # Time to wait for an answer before considering the link broken
+        self.timeout = timeout
+        # Answers are read in place in a preallocated buffer. Unread bytes
+        # lie between _head and _tail.
+        self._buffer = bytearray(1024)
+        self._view = memoryview(self._buffer)
+        self._head = self._tail = 0
+        # Number of requests sent whose answer has not been read
+        self._unanswered = 0
+        # Requests are packed in place in this one
+        self._wbuffer = bytearray(3 + 255)
+        self._wview = memoryview(self._wbuffer)
         try:
-            self.com = serial.Serial(self._dev, baudrate=self._baudrate, timeout=timeout, dsrdtr=None)
-        except:
+            self.com = open_port(self._dev, self._baudrate, timeout)
+        except serial.SerialException:
             print('Connexion failed')
         if self.debug:
             print('Port open')
@@ -135,56 +352,462 @@ class SerialBC(object):
             self.com.setDTR(True)
 
         
-    def _read(self, size):
-        read = bytearray()
-        #timeout = Timeout(self.com._timeout)
-        for i in range(10000):
-            buf = os.read(self.com.fd, size - len(read))
-            read.extend(buf)
-            if len(read) == size:
-                break
-            time.sleep(0.0001)
-        return bytes(read)
-    
+    def _fill(self, deadline, request=True):
+        ''' Wait until the device sends data and append it to the read buffer
+
+        Raises CommunicationError when nothing arrives before deadline
+        (in time.monotonic() seconds). The timeout is counted in
+        metrics.timeouts if the data awaited is the answer to a request,
+        not for the waits of resync.
+        '''
+        remaining = deadline - time.monotonic()
+        if (remaining <= 0) or not select.select([self.com.fd], [], [], remaining)[0]:
+            self._head = self._tail = 0
+            if request:
+                self.metrics.timeouts += 1
+            raise CommunicationError(f'No answer from the device after {self.timeout} s')
+        self._read_available()
+
+    def _read_available(self):
+        # Append the bytes waiting on the port to the read buffer
+        if self._tail == len(self._buffer):
+            # Move the unread bytes back to the start of the buffer
+            n = self._tail - self._head
+            self._buffer[:n] = self._buffer[self._head:self._tail]
+            self._head, self._tail = 0, n
+        n = os.readv(self.com.fd, [self._view[self._tail:]])
+        if n == 0:
+            raise CommunicationError('The device was disconnected')
+        self._tail += n
+        self.metrics.received_bytes += n
+
+    def _read(self, size, deadline=None):
+        ''' Return a view on the next size bytes of the answer stream
+
+        The view points into the read buffer and is only valid until the
+        next read.
+        '''
+        if deadline is None:
+            deadline = time.monotonic() + self.timeout
+        while self._tail - self._head < size:
+            self._fill(deadline)
+        start = self._head
+        self._head += size
+        if self._head == self._tail:
+            self._head = self._tail = 0
+        return self._view[start:start + size]
+
     def _register_commands(self):
         self._get_nfunc = _command_factory(self, 0x00, b'', b'B')
         self._get_func_name = _command_factory(self, 0x01, b'BB', b's')
-        for i in range(2, self._get_nfunc()):
-            name, arg_format, answer_format = [self._get_func_name(i, a) for a in range(3)]
+        # Names of the bound device functions
+        self._functions = []
+        fingerprint = self._fingerprint() if self._use_cache else None
+        if fingerprint is not None:
+            self._load_cache(fingerprint)
+        table = self.cache.get('commands')
+        if table is None:
+            calls = [('_get_func_name', (i, a)) for i in range(2, self._get_nfunc()) for a in range(3)]
+            # Subclasses may redefine call_many as a coroutine
+            names = SerialBC.call_many(self, calls)
+            table = [names[i:i+3] for i in range(0, len(names), 3)]
+            if (fingerprint is not None) and (table_fingerprint(protocol_commands + table) == fingerprint):
+                self.cache = {'commands': table}
+                self.save_cache()
+        elif self.debug:
+            print(f'Command table {fingerprint} read from {self._cache_file}')
+        self.metrics.names = self._command_names = [c[0] for c in protocol_commands + table]
+        for i, (name, arg_format, answer_format) in enumerate(table, 2):
+            # Subclasses can wrap a device function by defining a method
+            # of the same name. The raw function is then bound with a
+            # leading underscore.
+            if hasattr(type(self), name):
+                name = '_' + name
             if self.debug:
                 print(f'Registering user function "{name}"')
             setattr(self, name, _command_factory(self, i, arg_format.encode(), answer_format.encode()))
+            self._functions.append(name)
+
+    def _fingerprint(self):
+        ''' Query the hash of the device command table
+
+        Firmware predating the fingerprint answer VALUE_ERROR, in which
+        case None is returned and the cache is not used.
+        '''
+        try:
+            return self._get_func_name(0, 3)
+        except ValueError as e:
+            if not str(e).startswith('VALUE_ERROR'):
+                raise
+            return None
+
+    def _load_cache(self, fingerprint):
+        serial = serial_number(self._dev)
+        # Without a serial number, the entry of a path is shared by all
+        # the devices with the same firmware plugged there: it is only
+        # trusted for the command table
+        self._cache_identified = serial is not None
+        device = serial or os.path.realpath(self._dev)
+        key = ''.join(c if c.isalnum() else '_' for c in device)
+        self._cache_file = os.path.join(cache_dir(), f'{key}-{fingerprint}.json')
+        try:
+            with open(self._cache_file) as fid:
+                self.cache = json.load(fid)
+        except (OSError, ValueError):
+            self.cache = {}
+
+    def save_cache(self):
+        ''' Write the cache entry of the device back to disk
+
+        Failures are silently ignored, the cache being an optimisation only.
+        '''
+        if self._cache_file is None:
+            return
+        try:
+            os.makedirs(os.path.dirname(self._cache_file), exist_ok=True)
+            tmp = f'{self._cache_file}.{os.getpid()}'
+            with open(tmp, 'w') as fid:
+                json.dump(self.cache, fid)
+            os.replace(tmp, self._cache_file)
+        except OSError:
+            pass
+
+    def cached(self, key, func, *args):
+        ''' Return func(*args), reusing the value stored under key if any
+
+        This is intended for constant device properties (factory
+        calibration constants of the signature row) that do not need to
+        be read back at each connection. Values stored in EEPROM, which
+        can be changed by other hosts, must not be cached. The value is stored along the command table
+        and is therefore discarded when the firmware changes. It is read
+        at each connection when the USB adapter of the device has no
+        serial number, the cache entry being then keyed by the device path.
+        '''
+        if not self._cache_identified:
+            return func(*args)
+        if key not in self.cache:
+            self.cache[key] = func(*args)
+            if 'commands' in self.cache:
+                self.save_cache()
+        return self.cache[key]
                     
     def rcv(self):
-        b = self.com.read(3)
+        return bytes(self._rcv_view())
+
+    def _rcv_view(self, expected=None):
+        ''' Read the next answer frame and return a view on its payload
+
+        The view is only valid until the next read. If the frame cannot
+        be the answer to the oldest request (bad header, firmware
+        reporting an ill-formed request, or payload length different
+        from expected), the stream is resynchronized and
+        CommunicationError is raised.
+        '''
+        deadline = time.monotonic() + self.timeout
+        while True:
+            while self._tail - self._head < 3:
+                self._fill(deadline)
+            m, a, l = _header.unpack_from(self._buffer, self._head)
+            if m != ord('e'):
+                break
+            self._event(a, self._read(3 + l, deadline)[3:])
         if self.debug:
-            print(f'Received: {b}')
-        try:
-            m, a, l = struct.unpack(b'ccB', b)
-        except:
-            raise ValueError(f'Answer header: "{b}" does not match expected format "bcB"')
-        a = int.from_bytes(a, byteorder='little', signed=False)
+            print(f'header: {chr(m)},{status_codes[a] if a < len(status_codes) else a},{l}')
+        if ((m != ord('b')) or (a >= len(status_codes)) or (status_codes[a] == 'COMMUNICATION_ERROR')
+            or ((a == 0) and (expected is not None) and (l != expected))):
+            b = bytes(self._view[self._head:self._head + 3])
+            if a < len(status_codes):
+                self.metrics.errors[status_codes[a]] += 1
+            self.resync()
+            raise CommunicationError(f'Answered string not understood: {b}')
+        # Errors may come with a payload, consume it to stay in sync
+        data = self._read(3 + l, deadline)[3:]
+        self._unanswered -= 1
         if self.debug:
-            print(f'header: {m.decode()},{status_codes[a]},{l}')  
-        if (m == b'b' ) and (a == 0):
-            data = self.com.read(l)
-        elif (m == b'b') and (a < len(status_codes)):
+            print(f'Received: {bytes([m, a, l]) + data}')
+        if a != 0:
+            self.metrics.errors[status_codes[a]] += 1
             raise ValueError(f'{status_codes[a]}, {status_message[a]}')
-        else:
-            self.com.flush()
-            raise ValueError (f'Answered string not understood: {b}')
         return data
 
-    def snd(self, data):
+    def _event(self, code, payload):
+        if self.debug:
+            print(f'Event {code}: {bytes(payload)}')
+        if self.on_event is not None:
+            self.on_event(code, bytes(payload))
+
+    def poll_events(self, timeout=0.):
+        ''' Dispatch the event frames received while no request is pending
+
+        Waits up to timeout seconds for data from the device, then passes
+        the complete event frames at the head of the input to on_event.
+        Nothing is read while answers are outstanding: event frames are
+        then dispatched by the reading of the answers.
+
+        Returns:
+            int: the number of event frames dispatched.
+        '''
+        if self._unanswered:
+            return 0
+        n = 0
+        deadline = time.monotonic() + timeout
+        while True:
+            while self._tail - self._head >= 3 and self._buffer[self._head] == ord('e'):
+                l = self._buffer[self._head + 2]
+                if self._tail - self._head < 3 + l:
+                    break
+                data = self._read(3 + l)
+                self._event(data[1], data[3:])
+                n += 1
+            remaining = deadline - time.monotonic()
+            if (n and self._tail == self._head) or not select.select([self.com.fd], [], [], max(remaining, 0))[0]:
+                return n
+            self._read_available()
+
+    def resync(self):
+        ''' Realign the answer stream on the requests
+
+        A synchronisation request, get_command_names(k, 0), is sent and
+        the input is scanned until its answer, the name of function k, is
+        found. Complete frames found on the way are the stale answers of
+        requests that were given up (timeout, error) and are discarded
+        along with any garbage. The request is repeated every
+        sync_interval seconds, with a different k, in case the device
+        dropped it. Counts are accumulated in resync_counters.
+        '''
+        self.resync_counters['resyncs'] += 1
+        if self.debug:
+            print(f'Resynchronizing, {self._unanswered} answers outstanding')
+        self._communication_error()
+        deadline = time.monotonic() + self.timeout
+        while True:
+            k = self._sync_count % len(self._command_names)
+            self._sync_count += 1
+            name = self._command_names[k].encode()
+            self._send(get_codec(1, b'BB', b's').frame(k, 0))
+            if self._scan(b'b\x00' + bytes([len(name)]) + name, min(deadline, time.monotonic() + self.sync_interval)):
+                break
+            if time.monotonic() >= deadline:
+                raise CommunicationError(f'No answer to synchronisation requests after {self.timeout} s')
+        self._unanswered = 0
+
+    def _scan(self, answer, deadline):
+        ''' Discard the input up to answer included
+
+        Returns:
+            bool: False if answer was not received before deadline.
+        '''
+        counters = self.resync_counters
+        while True:
+            found = self._buffer.find(answer, self._head, self._tail)
+            if found == self._head:
+                self._read(len(answer))
+                return True
+            available = self._tail - self._head
+            valid = False
+            if available >= 3:
+                m, a, l = _header.unpack_from(self._buffer, self._head)
+                valid = ((m == ord('b')) and (a < len(status_codes))) or (m == ord('e'))
+                if valid and (available >= 3 + l) and ((found < 0) or (self._head + 3 + l <= found)):
+                    # A complete frame preceding the awaited answer
+                    data = self._read(3 + l)
+                    if m == ord('e'):
+                        self._event(a, data[3:])
+                    else:
+                        counters['stale_answers'] += 1
+                    continue
+            if found >= 0:
+                skip = found - self._head
+            elif (available >= 3) and not valid:
+                # Jump to the next possible frame start
+                starts = [self._buffer.find(c, self._head + 1, self._tail) for c in (b'b', b'e')]
+                starts = [i for i in starts if i >= 0]
+                skip = (min(starts) if starts else self._tail) - self._head
+            else:
+                try:
+                    self._fill(deadline, request=False)
+                except CommunicationError:
+                    return False
+                continue
+            self._read(skip)
+            counters['discarded_bytes'] += skip
+
+    def _communication_error(self):
+        """Called when the answer stream is found corrupted.
+
+        Subclasses keeping a copy of the device state can override it to
+        invalidate that copy.
+        """
+        pass
+
+    def _frame(self, data):
         b = struct.pack(b'ccB', b'b', b'\x00', len(data))
-        #print(b+data)
         if self.debug:
             print(f'Send: {b+data}')
-        self.com.write(b+data)
+        return b + data
+
+    def snd(self, data):
+        if self._unanswered:
+            self.resync()
+        self._send(self._frame(data))
         return self.rcv()
 
+    def _send(self, data, nframes=1):
+        self._unanswered += nframes
+        self.metrics.sent_bytes += len(data)
+        while data:
+            n = os.write(self.com.fd, data)
+            data = data[n:]
+
+    def _transact(self, codec, args):
+        ''' Send the request encoded by codec and return the decoded answer '''
+        try:
+            codec.pack_into(self._wbuffer, 0, codec.prefix, *args)
+        except struct.error:
+            raise codec.argument_error(args)
+        if self.debug:
+            print(f'Send: {bytes(self._wview[:codec.size])}')
+        if self._unanswered:
+            self.resync()
+        start = time.perf_counter()
+        self._send(self._wview[:codec.size])
+        try:
+            r = self._rcv_view(codec.expected)
+        except ValueError as e:
+            self.metrics.record(codec.f, time.perf_counter() - start, codec.size, 0, e)
+            raise
+        self.metrics.record(codec.f, time.perf_counter() - start, codec.size, 3 + len(r))
+        try:
+            answer = codec.decode(r)
+        except ValueError as e:
+            buffer = self.flush()
+            self._communication_error()
+            raise ValueError(f'{e}, trailing bytes:{buffer}')
+        if self.debug:
+            print(f'data: {answer}')
+        return answer
+
+    def stats(self, format='dict'):
+        ''' Return the communication statistics recorded in self.metrics
+
+        Args:
+            format (str): 'dict', 'json' or 'prometheus'.
+        '''
+        if format == 'json':
+            return self.metrics.to_json()
+        elif format == 'prometheus':
+            return self.metrics.to_prometheus()
+        return self.metrics.as_dict()
+
+    def batch(self):
+        """ Return a context accumulating device calls to pipeline them
+
+        Example:
+            with dev.batch() as b:
+                t = b.get_time()
+                s = b.raw_status()
+            print(t.result(), s.result())
+        """
+        return Batch(self)
+
+    def call_many(self, calls, return_exceptions=False):
+        """ Execute a sequence of device functions pipelining the requests
+
+        The requests are written without waiting for the answers (up to
+        pipeline_window bytes in flight) and the answers are decoded in
+        order. Functions whose execution on the device is slow compared
+        to the transmission of a character (EEPROM writes) should not be
+        followed by other requests in the same call.
+
+        Args:
+            calls: sequence of (function name, arguments tuple)
+            return_exceptions (bool): if True errors are returned in place
+                of the corresponding results instead of being raised.
+
+        Returns:
+            list: the decoded answers in the order of the calls.
+        """
+        requests = []
+        for name, args in calls:
+            method = getattr(self, name)
+            if not hasattr(method, 'encode'):
+                raise AttributeError(f'{name} is not a device function')
+            requests.append((method, method.frame(*args), _Answer()))
+        self._pipeline(requests)
+        results = []
+        for method, frame, answer in requests:
+            if answer.error is None:
+                results.append(answer.value)
+            elif return_exceptions:
+                results.append(answer.error)
+            else:
+                raise answer.error
+        return results
+
+    def _pipeline(self, requests):
+        # The answers of string functions are counted in the window at the
+        # size of the longest one received so far, rather than at the 64
+        # characters bound: the command names of a cold connection are
+        # then pipelined after the first one. A longer answer can exceed
+        # the window by the difference, which the firmware buffers,
+        # twice as large, absorb.
+        string_sizes = self._string_sizes
+        if self._unanswered:
+            self.resync()
+        pending = collections.deque()
+        inflight = 0
+        i = 0
+        while i < len(requests) or pending:
+            frames = []
+            start = time.perf_counter()
+            while i < len(requests):
+                method, frame, future = requests[i]
+                codec = method.codec
+                if codec.expected is None:
+                    cost = len(frame) + string_sizes.get(codec.f, codec.answer_size)
+                else:
+                    cost = len(frame) + codec.answer_size
+                if pending and (inflight + cost > self.pipeline_window):
+                    break
+                frames.append(frame)
+                pending.append((method, future, cost, start))
+                inflight += cost
+                i += 1
+            if frames:
+                if self.debug:
+                    print(f'Send: {frames}')
+                self._send(b''.join(frames), len(frames))
+            method, future, cost, start = pending.popleft()
+            inflight -= cost
+            codec = method.codec
+            try:
+                r = self._rcv_view(codec.expected)
+            except CommunicationError as e:
+                self.metrics.record(codec.f, time.perf_counter() - start, codec.size, 0, e)
+                # The remaining answers cannot be attributed anymore
+                future.set_exception(e)
+                for method, future, cost, start in pending:
+                    future.set_exception(e)
+                for method, frame, future in requests[i:]:
+                    future.set_exception(e)
+                return
+            except ValueError as e:
+                self.metrics.record(codec.f, time.perf_counter() - start, codec.size, 0, e)
+                future.set_exception(e)
+                continue
+            self.metrics.record(codec.f, time.perf_counter() - start, codec.size, 3 + len(r))
+            if (codec.expected is None) and (3 + len(r) > string_sizes.get(codec.f, 0)):
+                string_sizes[codec.f] = 3 + len(r)
+            try:
+                future.set_result(codec.decode(r))
+            except ValueError as e:
+                future.set_exception(e)
+
     def flush(self):
-        return self.com.read_all()
+        ''' Discard and return the unread bytes of the answer stream '''
+        data = bytes(self._view[self._head:self._tail])
+        self._head = self._tail = 0
+        return data + self.com.read_all()
 
 if __name__ == '__main__':
     import argparse
@@ -0,0 +1,312 @@
+# Copyright 2022 Marc Betoule
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+''' asyncio front-end to bincoms devices
+
+The connection and the registration of the device functions are done
+by SerialBC. The device functions are then rebound as coroutines
+exchanging frames through the non-blocking file descriptor of the serial
+port, watched by the running event loop. Requests issued concurrently
+are pipelined and their answers dispatched in order. As with SerialBC,
+the answer stream is realigned by a synchronisation request before the
+next request once answers were given up (timeout, corrupted frame).
+
+Example:
+    dev = await AsyncSerialBC.connect('/dev/ttyUSB0')
+    n = await dev.get_time()
+'''
+
+import asyncio
+import collections
+import functools
+import os
+import time
+
+from bincoms import SerialBC, CommunicationError, get_codec, status_codes, status_message, _header
+
+
+class AsyncSerialBC(SerialBC):
+    # Time to wait for an answer before considering the link broken
+    timeout = 3
+
+    def __init__(self, *args, **keys):
+        ''' Connect synchronously, then rebind the device functions as coroutines
+
+        Arguments are passed to SerialBC. Use AsyncSerialBC.connect to
+        avoid blocking the event loop during the connection.
+        '''
+        super().__init__(*args, **keys)
+        self._loop = None
+        self._rbuf = bytearray()
+        self._wbuf = bytearray()
+        self._pending = collections.deque()
+        self._inflight = 0
+        # Answers of given up requests may still arrive
+        self._out_of_sync = False
+        # Running resynchronisation task, and (answer, future) awaited by it
+        self._syncing = None
+        self._scan_for = None
+        # Set when the device is gone
+        self._lost = None
+        for name in self._functions:
+            setattr(self, name, self._async_command(getattr(self, name)))
+
+    @classmethod
+    async def connect(cls, *args, **keys):
+        ''' Create the instance in an executor thread '''
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, functools.partial(cls, *args, **keys))
+
+    def _async_command(self, method):
+        async def func(*args):
+            return await self._request(method, method.frame(*args))
+        func.codec = method.codec
+        func.frame = method.frame
+        func.encode = method.encode
+        func.decode = method.decode
+        func.answer_size = method.answer_size
+        return func
+
+    def _attach(self):
+        loop = asyncio.get_running_loop()
+        if self._loop is loop:
+            return
+        if self._loop is not None:
+            raise RuntimeError('The device is already used from another event loop')
+        self._loop = loop
+        os.set_blocking(self.com.fd, False)
+        loop.add_reader(self.com.fd, self._on_readable)
+
+    def close(self):
+        ''' Stop watching the device and close the serial port '''
+        if self._loop is not None:
+            self._loop.remove_reader(self.com.fd)
+            self._loop.remove_writer(self.com.fd)
+            self._loop = None
+        self._fail_pending(CommunicationError('Connection closed'))
+        self.com.close()
+
+    async def _request(self, method, frame):
+        self._attach()
+        if self._lost is not None:
+            raise self._lost
+        while self._out_of_sync:
+            if self._syncing is None:
+                self._syncing = self._loop.create_task(self._resync())
+                # Retrieved even if all the waiting requests are cancelled
+                self._syncing.add_done_callback(lambda task: task.cancelled() or task.exception())
+            await asyncio.shield(self._syncing)
+        codec = method.codec
+        if codec.expected is None:
+            # As SerialBC._pipeline, see there
+            cost = len(frame) + self._string_sizes.get(codec.f, codec.answer_size)
+        else:
+            cost = len(frame) + codec.answer_size
+        # Limit the amount of data in flight to protect the device buffers
+        while self._pending and (self._inflight + cost > self.pipeline_window):
+            await asyncio.wait([self._pending[0][1]])
+        future = self._loop.create_future()
+        self._pending.append((method, future, cost, time.perf_counter()))
+        self._inflight += cost
+        if self.debug:
+            print(f'Send: {frame}')
+        self._write(frame)
+        try:
+            # The future is cancelled on timeout, or if the caller is,
+            # its answer being then discarded
+            return await asyncio.wait_for(future, self.timeout)
+        except asyncio.TimeoutError:
+            e = CommunicationError(f'No answer from the device after {self.timeout} s')
+            self.metrics.timeouts += 1
+            self._fail_pending(e)
+            raise e
+
+    async def _resync(self):
+        ''' Realign the answer stream on the requests, see SerialBC.resync '''
+        try:
+            self.resync_counters['resyncs'] += 1
+            self._communication_error()
+            deadline = time.monotonic() + self.timeout
+            while True:
+                k = self._sync_count % len(self._command_names)
+                self._sync_count += 1
+                name = self._command_names[k].encode()
+                future = self._loop.create_future()
+                self._scan_for = (b'b\x00' + bytes([len(name)]) + name, future)
+                self._write(get_codec(1, b'BB', b's').frame(k, 0))
+                self._scan()
+                try:
+                    await asyncio.wait_for(future, max(min(self.sync_interval, deadline - time.monotonic()), 0))
+                    break
+                except asyncio.TimeoutError:
+                    if time.monotonic() >= deadline:
+                        raise CommunicationError(f'No answer to synchronisation requests after {self.timeout} s')
+            self._out_of_sync = False
+        finally:
+            self._scan_for = None
+            self._syncing = None
+
+    def _scan(self):
+        # Discard the input up to the answer awaited by _resync, see SerialBC._scan
+        answer, future = self._scan_for
+        counters = self.resync_counters
+        buf = self._rbuf
+        while True:
+            found = buf.find(answer)
+            if found == 0:
+                del buf[:len(answer)]
+                self._scan_for = None
+                if not future.done():
+                    future.set_result(True)
+                return
+            valid = False
+            if len(buf) >= 3:
+                m, a, l = _header.unpack_from(buf)
+                valid = ((m == ord('b')) and (a < len(status_codes))) or (m == ord('e'))
+                if valid and (len(buf) >= 3 + l) and ((found < 0) or (3 + l <= found)):
+                    # A complete frame preceding the awaited answer
+                    data = bytes(buf[3:3 + l])
+                    del buf[:3 + l]
+                    if m == ord('e'):
+                        self._event(a, data)
+                    else:
+                        counters['stale_answers'] += 1
+                    continue
+            if found >= 0:
+                skip = found
+            elif (len(buf) >= 3) and not valid:
+                # Jump to the next possible frame start
+                starts = [i for i in (buf.find(b'b', 1), buf.find(b'e', 1)) if i >= 0]
+                skip = min(starts) if starts else len(buf)
+            else:
+                return
+            del buf[:skip]
+            counters['discarded_bytes'] += skip
+
+    def _write(self, frame):
+        # Frames issued during the same iteration of the loop are
+        # gathered in a single write
+        if not self._wbuf:
+            self._loop.call_soon(self._on_writable)
+        self._wbuf.extend(frame)
+
+    def _on_writable(self):
+        try:
+            n = os.write(self.com.fd, self._wbuf)
+        except BlockingIOError:
+            n = 0
+        except OSError as e:
+            self._wbuf.clear()
+            self._loop.remove_writer(self.com.fd)
+            self._disconnected(IOError(f'The device was disconnected: {e}'))
+            return
+        del self._wbuf[:n]
+        self.metrics.sent_bytes += n
+        if self._wbuf:
+            self._loop.add_writer(self.com.fd, self._on_writable)
+        else:
+            self._loop.remove_writer(self.com.fd)
+
+    def _on_readable(self):
+        try:
+            data = os.read(self.com.fd, 4096)
+        except BlockingIOError:
+            return
+        except OSError as e:
+            self._disconnected(IOError(f'The device was disconnected: {e}'))
+            return
+        if not data:
+            self._disconnected(IOError('The device was disconnected'))
+            return
+        self._rbuf.extend(data)
+        self.metrics.received_bytes += len(data)
+        if self._scan_for is not None:
+            self._scan()
+        if self._out_of_sync:
+            # Stale answers are discarded by the resynchronisation
+            return
+        while len(self._rbuf) >= 3:
+            m, a, l = _header.unpack_from(self._rbuf)
+            if m == ord('e'):
+                # Unsolicited event frame
+                if len(self._rbuf) < 3 + l:
+                    return
+                data = bytes(self._rbuf[3:3 + l])
+                del self._rbuf[:3 + l]
+                self._event(a, data)
+                continue
+            if (m != ord('b')) or (a >= len(status_codes)) or not self._pending:
+                e = CommunicationError(f'Answered string not understood: {bytes(self._rbuf[:3])}')
+                self._out_of_sync = True
+                self._fail_pending(e)
+                return
+            if len(self._rbuf) < 3 + l:
+                return
+            data = bytes(self._rbuf[3:3 + l])
+            del self._rbuf[:3 + l]
+            if self.debug:
+                print(f'Received: {bytes([m, a, l]) + data}')
+            method, future, cost, start = self._pending.popleft()
+            self._inflight -= cost
+            codec = method.codec
+            if a != 0:
+                self.metrics.errors[status_codes[a]] += 1
+                e = ValueError(f'{status_codes[a]}, {status_message[a]}')
+                self.metrics.record(codec.f, time.perf_counter() - start, codec.size, 3 + l, e)
+                if not future.done():
+                    future.set_exception(e)
+                continue
+            self.metrics.record(codec.f, time.perf_counter() - start, codec.size, 3 + l)
+            if (codec.expected is None) and (3 + l > self._string_sizes.get(codec.f, 0)):
+                self._string_sizes[codec.f] = 3 + l
+            if future.done():
+                continue
+            try:
+                future.set_result(method.decode(data))
+            except ValueError as e:
+                future.set_exception(e)
+
+    def _fail_pending(self, e):
+        if self._pending:
+            # Their answers may still come
+            self._out_of_sync = True
+        while self._pending:
+            method, future, cost, start = self._pending.popleft()
+            if not future.done():
+                future.set_exception(e)
+        self._inflight = 0
+        self._rbuf.clear()
+
+    def _disconnected(self, e):
+        # Stop watching the device and fail the current and next requests
+        if self._lost is not None:
+            return
+        self._loop.remove_reader(self.com.fd)
+        self._lost = e
+        self._fail_pending(e)
+        if (self._scan_for is not None) and not self._scan_for[1].done():
+            self._scan_for[1].set_exception(e)
+
+    def flush(self):
+        data = bytes(self._rbuf)
+        self._rbuf.clear()
+        return data
+
+    async def call_many(self, calls, return_exceptions=False):
+        """ Execute a sequence of device functions pipelining the requests
+
+        Same as SerialBC.call_many, as a coroutine.
+        """
+        return await asyncio.gather(*[getattr(self, name)(*args) for name, args in calls],
+                                    return_exceptions=return_exceptions)
@@ -0,0 +1,154 @@
+# Copyright 2022 Marc Betoule
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+''' Communication statistics of a bincoms device
+
+Every SerialBC instance records in its metrics attribute the round-trip
+time of each request in a fixed-bucket histogram per device function,
+the bytes exchanged, the error statuses returned by the device, the
+timeouts, the resynchronisations of the answer stream and the retries
+performed by higher level code. Recording costs a bisection and a few
+additions per request.
+
+Example:
+    d = SerialBC('/dev/ttyUSB0')
+    d.get_time()
+    print(d.metrics.as_dict())
+    print(d.metrics.to_prometheus())
+'''
+
+import bisect
+import collections
+import json
+
+# Upper bounds of the latency histogram buckets in seconds. Values above
+# the last bound go to an additional overflow bucket.
+latency_buckets = (50e-6, 100e-6, 200e-6, 500e-6,
+                   1e-3, 2e-3, 5e-3, 10e-3, 20e-3, 50e-3,
+                   100e-3, 200e-3, 500e-3, 1., 2., 5.)
+
+
+class Metrics(object):
+    """ Accumulate the communication statistics of one device
+
+    Args:
+        device (str): name of the device, used as a label in exports.
+        buckets (tuple): increasing upper bounds of the latency buckets.
+
+    Attributes:
+        trace: None or a callable invoked after each request as
+            trace(command, latency, sent, received, error) with the
+            function name, the round-trip time in seconds, the request
+            and answer frame sizes in bytes, and the exception raised
+            for this request or None.
+    """
+    def __init__(self, device='', buckets=latency_buckets):
+        self.device = device
+        self.buckets = tuple(buckets)
+        # Names of the device functions indexed by function code
+        self.names = []
+        self.trace = None
+        self.resync = {'resyncs': 0, 'discarded_bytes': 0, 'stale_answers': 0}
+        self.reset()
+
+    def reset(self):
+        ''' Zero all the statistics '''
+        self.latency = {}
+        self.latency_sum = collections.Counter()
+        self.sent_bytes = 0
+        self.received_bytes = 0
+        self.timeouts = 0
+        self.errors = collections.Counter()
+        self.retries = collections.Counter()
+        for key in self.resync:
+            self.resync[key] = 0
+
+    def name(self, f):
+        return self.names[f] if f < len(self.names) else f'function_{f}'
+
+    def record(self, f, latency, sent, received, error=None):
+        ''' Account for one request to function f '''
+        counts = self.latency.get(f)
+        if counts is None:
+            counts = self.latency[f] = [0] * (len(self.buckets) + 1)
+        counts[bisect.bisect_left(self.buckets, latency)] += 1
+        self.latency_sum[f] += latency
+        if self.trace is not None:
+            self.trace(self.name(f), latency, sent, received, error)
+
+    def retry(self, operation):
+        ''' Account for one retry of the named operation '''
+        self.retries[operation] += 1
+
+    def as_dict(self):
+        ''' Return the statistics as a dictionary of plain python types '''
+        commands = {}
+        for f, counts in sorted(self.latency.items()):
+            commands[self.name(f)] = {'counts': list(counts),
+                                      'count': sum(counts),
+                                      'sum': self.latency_sum[f]}
+        return {'device': self.device,
+                'sent_bytes': self.sent_bytes,
+                'received_bytes': self.received_bytes,
+                'timeouts': self.timeouts,
+                'errors': dict(self.errors),
+                'retries': dict(self.retries),
+                'resync': dict(self.resync),
+                'latency': {'buckets': list(self.buckets), 'commands': commands}}
+
+    def to_json(self, **keys):
+        ''' Return the statistics as a JSON string
+
+        Keyword arguments are passed to json.dumps.
+        '''
+        return json.dumps(self.as_dict(), **keys)
+
+    def to_prometheus(self, prefix='bincoms'):
+        ''' Return the statistics in the Prometheus text exposition format '''
+        device = _escape(self.device)
+        def label(**labels):
+            return '{' + ','.join([f'device="{device}"'] + [f'{k}="{_escape(v)}"' for k, v in labels.items()]) + '}'
+        lines = [f'# HELP {prefix}_request_duration_seconds Round-trip time of the device function calls.',
+                 f'# TYPE {prefix}_request_duration_seconds histogram']
+        for f, counts in sorted(self.latency.items()):
+            command = self.name(f)
+            total = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                total += count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append(f'{prefix}_request_duration_seconds_bucket{label(command=command, le=le)} {total}')
+            lines.append(f'{prefix}_request_duration_seconds_sum{label(command=command)} {self.latency_sum[f]!r}')
+            lines.append(f'{prefix}_request_duration_seconds_count{label(command=command)} {total}')
+        def counter(name, help, value, key=None):
+            # value is a number, or a dictionary of numbers labelled by key
+            lines.append(f'# HELP {prefix}_{name}_total {help}')
+            lines.append(f'# TYPE {prefix}_{name}_total counter')
+            if key is not None:
+                for k, v in sorted(value.items()):
+                    lines.append(f'{prefix}_{name}_total{label(**{key: k})} {v}')
+            else:
+                lines.append(f'{prefix}_{name}_total{label()} {value}')
+        counter('sent_bytes', 'Bytes written to the device.', self.sent_bytes)
+        counter('received_bytes', 'Bytes read from the device.', self.received_bytes)
+        counter('timeouts', 'Requests left without answer.', self.timeouts)
+        counter('errors', 'Error statuses returned by the device.', dict(self.errors), key='status')
+        counter('retries', 'Operations retried by the host.', dict(self.retries), key='operation')
+        counter('resyncs', 'Resynchronisations of the answer stream.', self.resync['resyncs'])
+        counter('resync_discarded_bytes', 'Garbage bytes dropped during resynchronisations.', self.resync['discarded_bytes'])
+        counter('resync_stale_answers', 'Stale answers dropped during resynchronisations.', self.resync['stale_answers'])
+        return '\n'.join(lines) + '\n'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
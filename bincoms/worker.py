@@ -0,0 +1,248 @@
+# Copyright 2022 Marc Betoule
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+''' Share a bincoms device between threads through a single I/O owner
+
+SerialBC is not thread-safe: two threads exchanging with the device at
+the same time get each other's answers. An IOWorker owns the device: a
+dedicated thread performs all the exchanges, taken from a priority
+queue. Once attached, the device functions (and the methods built on
+them) can be called from any thread: each exchange, or each call_many
+batch, becomes a job queued with the priority of its function and the
+calling thread blocks until the worker has executed it. Urgent requests
+thus overtake the queued ones, and a request whose deadline passes
+before it could be sent fails with TimeoutError instead of delaying the
+others.
+
+Example:
+    worker = IOWorker(dev, priorities={'start_program': CRITICAL, 'read_adc': HOUSEKEEPING})
+    # Then, from any thread
+    dev.read_adc(1)
+    with worker.options(deadline=0.1):
+        dev.get_time()
+    future = worker.submit('read_adc', 1, priority=HOUSEKEEPING)
+    print(future.result())
+'''
+
+import contextlib
+import functools
+import heapq
+import itertools
+import threading
+import time
+from concurrent.futures import Future
+
+# Priority levels, the lowest value is served first
+CRITICAL = 0
+NORMAL = 10
+HOUSEKEEPING = 20
+
+
+class DeviceLock(object):
+    """ Reentrant lock knowing whether the current thread holds it
+
+    The lock of a device shared between threads (see
+    smartiris.daemon._locked). The IOWorker executes directly the calls
+    made by a thread holding it.
+    """
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._local = threading.local()
+
+    def acquire(self, blocking=True, timeout=-1):
+        if not self._lock.acquire(blocking, timeout):
+            return False
+        self._local.depth = getattr(self._local, 'depth', 0) + 1
+        return True
+
+    def release(self):
+        self._local.depth -= 1
+        self._lock.release()
+
+    def owned(self):
+        ''' Return True if the current thread holds the lock '''
+        return getattr(self._local, 'depth', 0) > 0
+
+    def __enter__(self):
+        return self.acquire()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+
+class IOWorker(object):
+    """ Execute all the exchanges with a device in a dedicated thread
+
+    The exchanges made by the worker are atomic with respect to the
+    device lock (a DeviceLock, see smartiris.daemon._locked), created if
+    needed, so that the threads reading the device directly (event
+    streams) or holding the lock for a sequence of exchanges (timesync,
+    the multi-step methods of SmartIris) keep working. Calls made while
+    holding that lock are executed directly. Otherwise only each
+    exchange, or each call_many batch, is atomic: a sequence of calls
+    made without the lock can be interleaved with the calls of other
+    threads.
+
+    Only the exchanges of the device functions (_transact, _pipeline
+    and snd) are rerouted. Code using the raw _send, rcv or poll_events
+    must hold the device lock, as EventStream and SmartIrisGroup do.
+
+    Args:
+        device (SerialBC): the device, its exchange methods are rerouted
+            through the worker until stop is called.
+        priorities (dict): priority of the device functions by name.
+        default_priority (int): priority of the other functions.
+
+    Attributes:
+        expired (int): number of jobs dropped because their deadline
+            passed before they could be executed.
+    """
+    def __init__(self, device, priorities=None, default_priority=NORMAL):
+        self.device = device
+        self.priorities = dict(priorities or {})
+        self.default_priority = default_priority
+        self.expired = 0
+        self._queue = []
+        self._count = itertools.count()
+        self._cond = threading.Condition()
+        self._local = threading.local()
+        self._stopped = False
+        if getattr(device, '_lock', None) is None:
+            device._lock = DeviceLock()
+        elif not isinstance(device._lock, DeviceLock):
+            raise TypeError('The device lock must be a DeviceLock')
+        self._lock = device._lock
+        self._originals = (device._transact, device._pipeline, device.snd)
+        transact, pipeline, snd = self._originals
+        def routed_transact(codec, args):
+            return self._call(self._priority_of([codec.f]), transact, codec, args)
+        def routed_pipeline(requests):
+            return self._call(self._priority_of([r[0].codec.f for r in requests]), pipeline, requests)
+        def routed_snd(data):
+            return self._call(self.default_priority, snd, data)
+        device._transact = routed_transact
+        device._pipeline = routed_pipeline
+        device.snd = routed_snd
+        self._thread = threading.Thread(target=self._run, name='bincoms-worker', daemon=True)
+        self._thread.start()
+
+    def _priority_of(self, codes):
+        local = getattr(self._local, 'priority', None)
+        if local is not None:
+            return local
+        names = self.device._command_names
+        return min(self.priorities.get(names[f] if f < len(names) else None, self.default_priority) for f in codes)
+
+    @contextlib.contextmanager
+    def options(self, priority=None, deadline=None):
+        ''' Set the priority and deadline of the calls made by the current thread in the block
+
+        Args:
+            priority (int): priority overriding the one of the functions.
+            deadline (float): maximum time in seconds a call may wait in
+                the queue before being sent.
+        '''
+        saved = (getattr(self._local, 'priority', None), getattr(self._local, 'deadline', None))
+        self._local.priority, self._local.deadline = priority, deadline
+        try:
+            yield self
+        finally:
+            self._local.priority, self._local.deadline = saved
+
+    def _owns_device(self):
+        # The worker thread holds the lock while executing the jobs
+        return self._lock.owned()
+
+    def _call(self, priority, func, *args):
+        if self._owns_device():
+            return func(*args)
+        return self._submit(priority, getattr(self._local, 'deadline', None), func, args).result()
+
+    def submit(self, func, *args, priority=None, deadline=None, **keys):
+        ''' Queue a call to be executed by the worker
+
+        Args:
+            func: name of a device function, or any callable, executed
+                with args and keys in the worker thread. A callable can make
+                several exchanges that will not be interleaved with others.
+            priority (int): priority of the job, by default the one of
+                the device function (default_priority for callables).
+            deadline (float): maximum time in seconds the job may wait
+                in the queue, after which its future fails with TimeoutError.
+
+        Returns:
+            concurrent.futures.Future: resolved with the result of the call.
+        '''
+        if isinstance(func, str):
+            if priority is None:
+                priority = self.priorities.get(func, self.default_priority)
+            func = getattr(self.device, func)
+        elif priority is None:
+            priority = self.default_priority
+        if keys:
+            func = functools.partial(func, **keys)
+        return self._submit(priority, deadline, func, args)
+
+    def _submit(self, priority, deadline, func, args):
+        future = Future()
+        if deadline is not None:
+            deadline += time.perf_counter()
+        with self._cond:
+            if self._stopped:
+                raise IOError('The I/O worker is stopped')
+            heapq.heappush(self._queue, (priority, next(self._count), deadline, func, args, future))
+            self._cond.notify()
+        return future
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not (self._queue or self._stopped):
+                    self._cond.wait()
+                if not self._queue:
+                    return
+                priority, count, deadline, func, args, future = heapq.heappop(self._queue)
+            if not future.set_running_or_notify_cancel():
+                continue
+            if (deadline is not None) and (time.perf_counter() > deadline):
+                self.expired += 1
+                future.set_exception(TimeoutError('Deadline exceeded before execution'))
+                continue
+            try:
+                with self._lock:
+                    result = func(*args)
+            except BaseException as e:
+                future.set_exception(e)
+            else:
+                future.set_result(result)
+
+    def pending(self):
+        ''' Return the number of jobs waiting in the queue '''
+        with self._cond:
+            return len(self._queue)
+
+    def stop(self):
+        ''' Execute the queued jobs, stop the thread and give the device back to direct calls '''
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+        self._thread.join()
+        device = self.device
+        device._transact, device._pipeline, device.snd = self._originals
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
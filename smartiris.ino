@@ -31,6 +31,14 @@ void get_clock_calibration(uint8_t rb);
 void set_clock_calibration(uint8_t rb);
 void read_adc(uint8_t rb);
 void read_signature_row(uint8_t rb);
+void set_event_stream(uint8_t rb);
+void stream_events();
+void start_stream(uint8_t rb);
+void extend_stream(uint8_t rb);
+void start_repeat(uint8_t rb);
+void store_bank(uint8_t rb);
+void start_program_bank(uint8_t rb);
+void program_state(uint8_t rb);
 void switch_button();
 
 uint32_t duration;
@@ -58,6 +66,26 @@ uint8_t active_nevent;
 // This store the program
 Event program[MAX_N_EVENTS];
 
+// Streaming mode: program[] is used as a ring refilled by the host while
+// the program runs. Events are executed while consumed != committed
+// (both counted modulo 256).
+bool streaming_program = false;
+volatile uint8_t committed = 0;
+volatile uint8_t consumed = 0;
+
+// Repeat mode: the program is executed several times, cycle k starting
+// at k * period counts. The ISR runs a copy of the program whose events
+// are shifted by one period as soon as they are executed.
+Event cycle_program[MAX_N_EVENTS];
+uint16_t cycles_left = 0;
+uint32_t period;
+
+// Resident programs: banks written by the host from program[] (see
+// store_bank) that can be started later in a single exchange
+const uint8_t N_BANKS=4;
+Event banks[N_BANKS][MAX_N_EVENTS];
+uint8_t bank_nevents[N_BANKS];
+
 // Those are 4 builtin programs to open and close the two shutters when the button are activated
 Event OpenA[2] = {{20000, 0x0, 0b10}, {0x5f90, 1, 0b10}};
 Event CloseA[2] = {{20000, 0x0, 0b1}, {0x5f90, 1, 0b1}};
@@ -68,6 +96,43 @@ Event CloseB[2] = {{20000, 0x0, 0b100}, {0x5f90, 1, 0b100}};
 Event sensor_timing_record[MAX_N_RECORDS];
 uint8_t n_record = 0;
 
+// Event streaming: the interrupts queue sensor edges and program ends,
+// the main loop sends them as unsolicited frames (see stream_events)
+#define SENSOR_EVENT 0
+#define PROGRAM_END_EVENT 1
+#define EVENTS_LOST 2
+// Must be a power of 2
+const uint8_t EVENT_QUEUE_SIZE=16;
+typedef struct {
+  uint16_t time_LB;
+  uint16_t time_HB;
+  uint8_t pin;
+  uint8_t kind;
+  uint16_t run;
+} QueuedEvent;
+volatile QueuedEvent event_queue[EVENT_QUEUE_SIZE];
+volatile uint8_t eq_head = 0;
+uint8_t eq_tail = 0;
+volatile uint8_t events_lost = 0;
+bool streaming = false;
+// Number of programs started, identifies the program of an event
+uint16_t run = 0;
+
+#define QUEUE_EVENT(k, lb, hb, p)                                   \
+  if (streaming){                                                   \
+    uint8_t next = (eq_head + 1) & (EVENT_QUEUE_SIZE - 1);          \
+    if (next == eq_tail)                                            \
+      events_lost++;                                                \
+    else{                                                           \
+      event_queue[eq_head].time_LB = lb;                            \
+      event_queue[eq_head].time_HB = hb;                            \
+      event_queue[eq_head].pin = p;                                 \
+      event_queue[eq_head].kind = k;                                \
+      event_queue[eq_head].run = run;                               \
+      eq_head = next;                                               \
+    }                                                               \
+  }
+
 // Generic record interrupt handler. This interrupt handler need to
 // handle timing rollover internally because it could mask the overflow
 // interrupt and record incorrect timing because of that.
@@ -80,6 +145,7 @@ uint8_t n_record = 0;
   }								   \
   sensor_timing_record[n_record].pin = line;			   \
   sensor_timing_record[n_record].time_HB = timeHB;                  \
+  QUEUE_EVENT(SENSOR_EVENT, sensor_timing_record[n_record].time_LB, timeHB, line) \
   if (n_record < MAX_N_RECORDS - 1) n_record++;                    \
   
 // Macros to start and stop the 16-bit timer
@@ -91,7 +157,7 @@ uint8_t n_record = 0;
 #define DISABLE_INT TIMSK1 = 0b00000000
 #define CLEAR_INT TIFR1 = _BV(OCF1A)
 
-const uint8_t NFUNC = 2+12;
+const uint8_t NFUNC = 2+19;
 uint8_t narg[NFUNC];
 // The exposed functions
 void (*func[NFUNC])(uint8_t rb) =
@@ -111,6 +177,13 @@ void (*func[NFUNC])(uint8_t rb) =
    set_clock_calibration,
    read_adc,
    read_signature_row,
+   set_event_stream,
+   start_stream,
+   extend_stream,
+   start_repeat,
+   store_bank,
+   start_program_bank,
+   program_state,
   };
 
 const char* command_names[NFUNC*3] =
@@ -129,12 +202,20 @@ const char* command_names[NFUNC*3] =
    "set_clock_calibration", "f", "",
    "read_adc", "B", "H",
    "read_signature_row", "H", "B",
+   "set_event_stream", "B", "",
+   "_start_stream", "B", "",
+   "_extend_stream", "B", "B",
+   "_start_repeat", "HI", "",
+   "_store_bank", "B", "",
+   "_start_program_bank", "B", "",
+   "program_state", "", "BH",
   };
 
 
 void setup(){
   // Setup fast binary remote procedure call library
   setup_bincom();
+  client.idle = stream_events;
 
   // Nano assignments
   // PORTB dedicated to outputs, PORTD to inputs
@@ -205,6 +286,8 @@ void _stop_program(){
   DISABLE_INT;
   EIMSK = 0b0;
   event = 0;
+  streaming_program = false;
+  cycles_left = 0;
   PORTB = 0;
 }
 
@@ -215,7 +298,37 @@ ISR(TIMER1_COMPA_vect){
   // comparison adds a small (but constant) delay to the pin change.
   if (timeHB == active_program[event-1].time_HB){
     PINB = active_program[event-1].pin;
-    if (event == active_nevent){
+    if (streaming_program){
+      // The high bytes comparison wraps around, allowing programs
+      // longer than the 32 bit timer as long as successive events are
+      // less than 2**32 counts apart
+      consumed++;
+      if (consumed == committed){
+	QUEUE_EVENT(PROGRAM_END_EVENT, active_program[event-1].time_LB, timeHB, 0)
+	_stop_program();
+      }
+      else{
+	event = (consumed & (MAX_N_EVENTS - 1)) + 1;
+	OCR1A = program[event-1].time_LB;
+      }
+    }
+    else if (cycles_left){
+      // Shift the executed event to the next cycle
+      uint32_t next = ((((uint32_t) active_program[event-1].time_HB) << 16) | active_program[event-1].time_LB) + period;
+      active_program[event-1].time_LB = next;
+      active_program[event-1].time_HB = next >> 16;
+      if (event == active_nevent){
+	cycles_left--;
+	event = 1;
+	OCR1A = active_program[0].time_LB;
+      }
+      else{
+	OCR1A = active_program[event].time_LB;
+	event++;
+      }
+    }
+    else if (event == active_nevent){
+      QUEUE_EVENT(PROGRAM_END_EVENT, active_program[event-1].time_LB, timeHB, 0)
       _stop_program();
     }
     else{
@@ -299,7 +412,8 @@ void get_program(uint8_t rb){
    *
    * The function reads 2 arguments from the communication buffer:
    * i: (Byte) the slot number in the program between 0 and MAX_N_EVENTS - 1
-   * p: (Byte) the index of the program to read
+   * p: (Byte) the index of the program to read: 0 for the program, 1
+   *    for the sensor record, 2 + i for the bank i
    * It returns 2 values to the communication buffer:
    * duration: (Int) the timing of the pulse in slot i (in counts)
    * pin: (Byte) the index of the pin switched in the PORTB
@@ -310,6 +424,13 @@ void get_program(uint8_t rb){
   Event * program_slot;
   if (program_num == 1)
     program_slot = sensor_timing_record;
+  else if (program_num >= 2){
+    if (program_num - 2 >= N_BANKS){
+      client.sndstatus(VALUE_ERROR);
+      return;
+    }
+    program_slot = banks[program_num - 2];
+  }
   else
     program_slot = program;
   duration = program_slot[i].time_HB;
@@ -329,6 +450,7 @@ void _start_program(){
   TCNT1=0;
   CLEAR_INT;
   n_record=0;
+  run++;
   EIMSK = 0b11;
   ENABLE_INT;
   START_TIMER;
@@ -336,7 +458,16 @@ void _start_program(){
 
 void start_program(uint8_t rb){
   /* Start the execution of the pulse program
+   *
+   * Answers VALUE_ERROR if no valid program has been written (as after
+   * a reset of the device) so that the host can upload it again.
    */
+  if ((n_events == 0) || (n_events > MAX_N_EVENTS)){
+    client.sndstatus(VALUE_ERROR);
+    return;
+  }
+  // Also leaves a streaming or repeated program aborted by the host
+  _stop_program();
   event = 1;
   active_program = program;
   active_nevent = n_events;
@@ -393,6 +524,20 @@ void status(uint8_t rb){
   client.snd((uint8_t*) &data, 5, STATUS_OK);
 }
 
+void program_state(uint8_t rb){
+  /* Return the state of the pulse program
+   *
+   * The function returns 3 bytes to communication buffer:
+   * n_events: (Byte) the length of the program written by program_pulse
+   * (0 after a reset), which may differ from the running one
+   * run: (Short) the number of programs started, modulo 2**16
+   */
+  uint8_t data[3];
+  data[0] = n_events;
+  *((uint16_t*)(data + 1)) = run;
+  client.snd((uint8_t*) &data, 3, STATUS_OK);
+}
+
 void get_clock_calibration(uint8_t rb){
   float calibration_constant = 2e6;
   EEPROM.get(0, calibration_constant);
@@ -494,3 +639,172 @@ void read_signature_row(uint8_t rb) {
     client.snd(&result, 1, STATUS_OK);
 }
 
+
+void set_event_stream(uint8_t rb){
+  /* Enable (1) or disable (0) the streaming of events
+   *
+   * When enabled, each sensor edge and each program end is sent to the
+   * host as an unsolicited frame ('e', kind, 7, payload) with payload:
+   * time: (Int) timer counts since the program start
+   * pin: (Byte) the sensor line (0 for a program end)
+   * run: (Short) the number of programs started, modulo 2**16
+   * A frame ('e', EVENTS_LOST, 1, n) reports n events dropped because
+   * the queue was full.
+   */
+  uint8_t enable = *((uint8_t *) (client.read_buffer + rb));
+  streaming = false;
+  eq_tail = eq_head;
+  events_lost = 0;
+  streaming = enable;
+  client.sndstatus(STATUS_OK);
+}
+
+void stream_events(){
+  /* Send the queued events, leaving in the write buffer the room
+   * needed by the answers to the host requests in flight (at most 128
+   * bytes, see bincoms.SerialBC.pipeline_window)
+   */
+  if (events_lost && (client.room() > 128 + 4)){
+    cli();
+    uint8_t n = events_lost;
+    events_lost = 0;
+    sei();
+    client.sndevent(EVENTS_LOST, &n, 1);
+  }
+  while ((eq_tail != eq_head) && (client.room() > 128 + 10)){
+    uint8_t data[7];
+    volatile QueuedEvent * e = event_queue + eq_tail;
+    uint32_t t = e->time_HB;
+    t <<= 16;
+    t += e->time_LB;
+    *((uint32_t*)(data)) = t;
+    data[4] = e->pin;
+    *((uint16_t*)(data + 5)) = e->run;
+    client.sndevent(e->kind, data, 7);
+    eq_tail = (eq_tail + 1) & (EVENT_QUEUE_SIZE - 1);
+  }
+}
+
+void start_stream(uint8_t rb){
+  /* Start the execution of the program in streaming mode
+   *
+   * The function reads 1 argument from the communication buffer:
+   * n: (Byte) the number of events written in slots 0 to n-1
+   * Slots are then used as a ring: the slot of the k-th event is k %
+   * MAX_N_EVENTS. The program cursor reported by status is the slot of
+   * the next event plus one. The program stops after the last event
+   * made available with extend_stream.
+   */
+  uint8_t n = *((uint8_t *) (client.read_buffer + rb));
+  if ((n == 0) || (n > MAX_N_EVENTS)){
+    client.sndstatus(VALUE_ERROR);
+    return;
+  }
+  // Also leaves a streaming or repeated program aborted by the host
+  _stop_program();
+  event = 1;
+  active_program = program;
+  active_nevent = MAX_N_EVENTS;
+  consumed = 0;
+  committed = n;
+  streaming_program = true;
+  _start_program();
+  client.sndstatus(STATUS_OK);
+}
+
+void extend_stream(uint8_t rb){
+  /* Make n more events available to the program running in streaming mode
+   *
+   * The events must have been written in their slots beforehand.
+   * Answers the program cursor, or VALUE_ERROR if the program is not
+   * running anymore (the host was too late) or if the ring cannot hold
+   * n more events.
+   */
+  uint8_t n = *((uint8_t *) (client.read_buffer + rb));
+  uint8_t cursor;
+  bool ok;
+  cli();
+  ok = streaming_program && ((uint8_t)(committed + n - consumed) <= MAX_N_EVENTS);
+  if (ok)
+    committed += n;
+  cursor = event;
+  sei();
+  if (ok)
+    client.snd(&cursor, 1, STATUS_OK);
+  else
+    client.sndstatus(VALUE_ERROR);
+}
+
+void start_repeat(uint8_t rb){
+  /* Execute the pulse program several times with a fixed period
+   *
+   * The function reads 2 arguments from the communication buffer:
+   * n: (uint16) the number of cycles
+   * period: (uint32) the time between the start of two cycles in counts
+   *
+   * The timer is not reset between cycles: the events of cycle k are
+   * executed and recorded at k * period plus their programmed timing.
+   * Answers VALUE_ERROR if no valid program has been written, if n is 0
+   * or if the period is not longer than the program.
+   */
+  uint16_t n;
+  uint32_t p;
+  client.readn(&rb, (uint8_t*) &n, 2);
+  client.readn(&rb, (uint8_t*) &p, 4);
+  if ((n_events == 0) || (n_events > MAX_N_EVENTS) || (n == 0)
+      || (p <= (((uint32_t) program[n_events-1].time_HB) << 16 | program[n_events-1].time_LB))){
+    client.sndstatus(VALUE_ERROR);
+    return;
+  }
+  _stop_program();
+  for (uint8_t i = 0; i < n_events; i++)
+    cycle_program[i] = program[i];
+  period = p;
+  cycles_left = n - 1;
+  event = 1;
+  active_program = cycle_program;
+  active_nevent = n_events;
+  _start_program();
+  client.sndstatus(STATUS_OK);
+}
+
+void store_bank(uint8_t rb){
+  /* Copy the pulse program in a resident bank
+   *
+   * The function reads 1 argument from the communication buffer:
+   * i: (Byte) the bank number between 0 and N_BANKS - 1
+   * Answers VALUE_ERROR if no valid program has been written or if
+   * the bank does not exist.
+   */
+  uint8_t i = *((uint8_t *) (client.read_buffer + rb));
+  if ((i >= N_BANKS) || (n_events == 0) || (n_events > MAX_N_EVENTS)){
+    client.sndstatus(VALUE_ERROR);
+    return;
+  }
+  for (uint8_t k = 0; k < n_events; k++)
+    banks[i][k] = program[k];
+  bank_nevents[i] = n_events;
+  client.sndstatus(STATUS_OK);
+}
+
+void start_program_bank(uint8_t rb){
+  /* Start the execution of the program stored in a resident bank
+   *
+   * The function reads 1 argument from the communication buffer:
+   * i: (Byte) the bank number between 0 and N_BANKS - 1
+   * Answers VALUE_ERROR if the bank does not exist or is empty (as
+   * after a reset of the device) so that the host can store it again.
+   */
+  uint8_t i = *((uint8_t *) (client.read_buffer + rb));
+  if ((i >= N_BANKS) || (bank_nevents[i] == 0)){
+    client.sndstatus(VALUE_ERROR);
+    return;
+  }
+  // Also leaves a streaming or repeated program aborted by the host
+  _stop_program();
+  event = 1;
+  active_program = banks[i];
+  active_nevent = bank_nevents[i];
+  _start_program();
+  client.sndstatus(STATUS_OK);
+}
@@ -13,25 +13,18 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import bincoms
+import contextlib
+import math
 import struct
 import time
-import numpy as np
-import argparse
 
-import numpy as np
-import struct
-import time
-
-
-class SmartIris(bincoms.SerialBC):
-    """A class to control an iris blade shutter via serial communication.
 
-    Inherits from bincoms.SerialBC to provide low-level serial communication
-    functionality. This class manages shutter operations such as opening,
-    closing, and timed sequences using a microcontroller's timer.
+class SmartIrisBase(bincoms.SerialBC):
+    """Program logic shared by SmartIris and smartiris.aio.AsyncSmartIris.
 
-    Attributes:
-        time_resolution (float): The timer resolution in seconds (default: 0.5e-6).
+    The methods exchanging with the device are written once, as
+    generators yielding their exchanges (see _execute). SmartIris
+    performs these exchanges blocking, AsyncSmartIris awaits them.
     """
 
     def __init__(self, *args, **keys):
@@ -41,36 +34,57 @@ class SmartIris(bincoms.SerialBC):
             *args: Variable length argument list passed to the parent class.
             **keys: Keyword arguments passed to the parent class.
         """
+        # Copy of the program last confirmed on the device (None if unknown)
+        self._shadow = None
+        # Host time (time.perf_counter) at which the last program was
+        # started and that program, None if unknown
+        self._started = None
+        # Host times (time.time) bracketing the last reset of the mcu
+        # timer by start_program, None if unknown
+        self.program_epoch = None
+        # Optional background TimeSync, see start_timesync
+        self.timesync = None
+        # Optional EventStream, see stream_events
+        self.event_stream = None
+        # Optional ActuationScheduler, see schedule_actuations
+        self.scheduler = None
+        # Optional IOWorker, see start_worker
+        self.worker = None
+        # Optional SnapshotPublisher, see publish_snapshot
+        self.snapshot = None
+        # Number of cycles and period in counts of the last program, and
+        # position of its first event in the event stream buffer
+        self._cycles = (1, 0)
+        self._cycles_index = 0
+        # Resident programs: name -> (bank, events), least recently run first
+        self.programs = {}
+        # Bank of the running program, None for the working program
+        self._running_bank = None
+        # Last known value of the device counter of program starts (see
+        # program_state), and (counter, program length) expected while
+        # the program started by this instance is the active one
+        self._run = None
+        self._active = None
         super().__init__(*args, **keys)
+        self.program_pulse = self._writing_program(self.program_pulse)
+        # The calibration is in EEPROM and can be changed by other
+        # hosts: it is read at each connection, unlike the constants
         self.frequency = self.get_frequency()
-        # Read mcu temperature sensor calibration constants
-        self._ts_offset = self.read_signature_row(0x0002)
-        self._ts_gain = self.read_signature_row(0x0003)
+        # Read mcu temperature sensor calibration constants in one round
+        # trip (call_many is a coroutine in AsyncSmartIris)
+        reads = [('read_signature_row', (0x0002,)), ('read_signature_row', (0x0003,))]
+        self._ts_offset, self._ts_gain = self.cached('ts_calibration', bincoms.SerialBC.call_many, self, reads)
         
     def get_frequency(self):
         ''' Return the mcu clock frequency. Nominal or calibrated if avaialable'''
         freq = self.get_clock_calibration()
-        if np.isnan(freq):
+        if math.isnan(freq):
             import warnings
             warnings.warn('The mcu clock is not calibrated. If you need precise timings consider running "smartiris calibrate".')
             return 2e6
         else:
             return freq
 
-    def calibrate(self, duration_min=10, output_file=''):
-        import smartiris.clock_calibration
-        mcu_data, ntp_data = smartiris.clock_calibration.acquire_clock_data(self, duration=duration_min*60)
-        slope, eslope = smartiris.clock_calibration.clock_calibration_fit(mcu_data['start'], mcu_data['mcu'])
-        print(f'Measured a time scale difference of {(slope-1) * 100:.4f}% (±{eslope*100:.4f}%)')
-        if output_file:
-            smartiris.clock_calibration.save(mcu_data, ntp_data, output_file)
-            print(f'Calibration data saved in {output_file}. Clock scale not adjusted')
-        else:
-            calibrated_frequency = self.frequency * slope
-            print(f'Adjusting frequency from {self.frequency * 1e-6:.6f} MHz to {calibrated_frequency * 1e-6:.6f} MHz')
-            self.set_clock_calibration(calibrated_frequency)
-            self.frequency = calibrated_frequency
-        
     def _ct(self, seconds):
         """Convert a duration in seconds to a microcontroller timer count.
 
@@ -80,7 +94,7 @@ class SmartIris(bincoms.SerialBC):
         Returns:
             int: The number of timer counts, rounded to the nearest integer.
         """
-        return int(np.round(seconds * self.frequency))
+        return int(round(seconds * self.frequency))
 
 #    def async_packet_read(self):
 #        """Read and unpack an asynchronous response packet from the device.
@@ -93,6 +107,15 @@ class SmartIris(bincoms.SerialBC):
 #        answer = struct.unpack('<IB', ans)
 #        return answer
 
+    def _writing_program(self, method):
+        """Wrap a device function writing program slots to forget the copy of the program."""
+        def func(*args):
+            self._shadow = None
+            return method(*args)
+        # Keep the codec, used for batches
+        func.__dict__.update(method.__dict__)
+        return func
+
     def pulse_sec(self, pin, pulsewidth_sec):
         """Generate a pulse on the specified pin for a given duration.
 
@@ -105,24 +128,429 @@ class SmartIris(bincoms.SerialBC):
     def safe_program_pulse(self, pin, pos, timing_sec, retries=2):
         ''' Encapsulate the program_pulse method, reading back values to ensure integrity of the program
 
+        As program_pulse, it invalidates the copy of the program kept
+        by upload_program, which writes it entirely next time.
+
         Args:
             pin (int): The pin number to pulse
             pos (int): The position of the pulse in the program
             timing (float): The timing of the pulse in seconds
         '''
+        return self._execute(self._safe_program_pulse_steps(pin, pos, timing_sec, retries))
+
+    def _safe_program_pulse_steps(self, pin, pos, timing_sec, retries):
         timing_count = self._ct(timing_sec)
+        self._shadow = None
         for i in range(retries):
+            if i:
+                self.metrics.retry('program_pulse')
             try:
-                self.program_pulse(pin, pos, timing_count)
-                rtiming, rpin = self.get_program(pos, 0)
+                yield ('call', 'program_pulse', (pin, pos, timing_count))
+                rtiming, rpin = yield ('call', 'get_program', (pos, 0))
                 if (rtiming == timing_count) and (rpin == pin):
                     return
             except ValueError:
                 print('Catched communication error')
-                self.flush()
         raise IOError(f'Corrupted program on device. Asked for ({timing_count}, {1<<pin}) got ({rtiming}, {rpin}) in position {pos}')
                 
-    def timed_shutter(self, delay_sec=1e-4, duration_sec=1, port='A', pulsewidth_sec=30e-3, exec=True, echo=False):
+    def upload_program(self, events, retries=2):
+        """Write a complete program to the device and check its integrity.
+
+        The host keeps a copy of the last program confirmed on the
+        device. Only the slots differing from that copy are written,
+        followed by the last slot which sets the program length on the
+        device, and the upload is skipped entirely when nothing
+        changed. The written slots are read back in the same pipelined
+        exchange, along with the program length when the firmware can
+        report it, and slots found to differ are written again, always
+        followed by the last one. The slots left unwritten are checked
+        as well: the device must still hold a program of the expected
+        length (the whole program is read back with firmware that
+        cannot report it), otherwise it was reset and the program is
+        written entirely.
+
+        Args:
+            events: Sequence of (timing_counts, pin_mask) pairs sorted by
+                timing, typically a numpy structured array of dtype
+                program_dtype.
+            retries (int): Number of attempts before giving up.
+
+        Raises:
+            IOError: If the program could not be written correctly.
+        """
+        return self._execute(self._upload_program_steps(events, retries))
+
+    def _upload_program_steps(self, events, retries=2):
+        events, todo, base = self._upload_plan(events)
+        for i in range(retries):
+            if not todo:
+                return
+            if i:
+                self.metrics.retry('upload_program')
+            answers = yield ('many', self._upload_calls(events, todo, base), True)
+            todo, readback = self._upload_check(events, todo, base, answers)
+            base = len(events)
+        if todo:
+            raise IOError(f'Corrupted program on device. Asked for {[events[pos] for pos in todo]} got {[readback.get(pos) for pos in todo]} in positions {todo}')
+
+    def _upload_plan(self, events):
+        """Return the program as a list, the slots that need to be written
+        and the length of the program assumed on the device (None if unknown)."""
+        events = _as_events(events)
+        if not 0 < len(events) <= MAX_N_EVENTS:
+            raise ValueError(f'Programs must have between 1 and {MAX_N_EVENTS} events, got {len(events)}')
+        shadow, self._shadow = self._shadow, None
+        if shadow == events:
+            self._shadow = shadow
+            return events, [], len(events)
+        last = len(events) - 1
+        if shadow is None:
+            return events, list(range(len(events))), None
+        return events, [pos for pos in range(last) if (pos >= len(shadow)) or (shadow[pos] != events[pos])] + [last], len(shadow)
+
+    def _upload_layout(self, events, todo, base):
+        """Return whether the program length is read before and after the
+        writes, and the slots read back."""
+        state = 'program_state' in self._command_names
+        # The slots left unwritten are trusted only if the device still
+        # holds the program assumed (it was not reset meanwhile)
+        partial = (base is not None) and (len(todo) < len(events))
+        # Without program_state, all the slots are read back instead
+        reads = todo if (state or not partial) else list(range(len(events)))
+        return partial and state, reads, state
+
+    def _upload_calls(self, events, todo, base):
+        before, reads, after = self._upload_layout(events, todo, base)
+        calls = [('program_state', ())] if before else []
+        calls += [('program_pulse', (events[pos][1], pos, events[pos][0])) for pos in todo]
+        calls += [('get_program', (pos, 0)) for pos in reads]
+        if after:
+            calls.append(('program_state', ()))
+        return calls
+
+    def _upload_check(self, events, todo, base, answers):
+        """Return the slots still to be written and the values read back."""
+        before, reads, after = self._upload_layout(events, todo, base)
+        if before:
+            state, answers = answers[0], answers[1:]
+            if isinstance(state, Exception) or (state[0] != base):
+                # The program was lost, write all the slots
+                print('Catched communication error')
+                return list(range(len(events))), {}
+        written = answers[:len(todo)]
+        readback = dict(zip(reads, answers[len(todo):len(todo) + len(reads)]))
+        state = answers[len(todo) + len(reads):]
+        last = len(events) - 1
+        todo = [pos for pos in reads if readback[pos] != events[pos]]
+        lost = any(isinstance(r, Exception) for r in written + state)
+        # Each write sets the program length: a batch must end with the
+        # last slot, even if it was written correctly before
+        if (todo or lost or (state and state[0][0] != len(events))) and last not in todo:
+            todo.append(last)
+        if state and not lost:
+            self._run = state[0][1]
+        if todo:
+            print('Catched communication error')
+        else:
+            self._shadow = events
+        return todo, readback
+
+    def start_program(self, repeat=1, period_sec=None):
+        """Start the execution of the program stored on the device.
+
+        The firmware refuses to start an empty program, which happens
+        after a reset of the device. In that case the last uploaded
+        program is written again before retrying.
+
+        With repeat > 1, the device executes the program repeat times,
+        re-arming itself every period_sec without any exchange with the
+        host: cycle k starts exactly k * period_sec after the program
+        start. The timer is not reset between cycles, see
+        read_cycle_records for the sensor records of each cycle. Without
+        an event stream (see stream_events), the device records only the
+        first MAX_N_RECORDS - 1 sensor edges of the whole run, not of each
+        cycle.
+
+        Args:
+            repeat (int): Number of executions of the program (at most 65535).
+            period_sec (float): Time between the starts of two cycles,
+                required if repeat > 1. It must be longer than the program.
+
+        Raises:
+            ValueError: If the repeat parameters are invalid.
+            IOError: If the firmware does not support the repeat mode.
+        """
+        return self._execute(self._start_program_steps(repeat, period_sec))
+
+    def _start_program_steps(self, repeat, period_sec):
+        period = self._repeat_period(repeat, period_sec, self._shadow)
+        yield from self._admit_steps(self._shadow, repeat, period)
+        yield from self._start_working_steps(repeat, period)
+
+    def _start_working_steps(self, repeat=1, period=0):
+        """Start the working program once admitted, see start_program."""
+        if repeat != 1:
+            start_call = ('call', '_start_repeat', (repeat, period))
+        else:
+            start_call = ('call', '_start_program', ())
+        if self.event_stream is not None:
+            self._cycles_index = self.event_stream.buffer.count
+        try:
+            epoch = time.time()
+            start = time.perf_counter()
+            yield start_call
+        except ValueError:
+            events, self._shadow = self._shadow, None
+            if events is None:
+                raise
+            self.metrics.retry('start_program')
+            yield from self._upload_program_steps(events)
+            epoch = time.time()
+            start = time.perf_counter()
+            yield start_call
+        self._program_started(epoch, start, repeat, period)
+
+    def _program_started(self, epoch, start, repeat=1, period=0, bank=None):
+        """Record the start of the stored program (see start_program)."""
+        self.program_epoch = (epoch, time.time())
+        self._cycles = (repeat, period)
+        self._running_bank = bank
+        events = self._shadow if bank is None else self._bank_events(bank)
+        self._count_start(None if events is None else len(events))
+        if events is None:
+            self._started = None
+        elif repeat != 1:
+            # Only the first and last events matter to wait()
+            last_timing, last_pin = events[-1]
+            self._started = (start, [events[0], (last_timing + (repeat - 1) * period, last_pin)])
+        else:
+            self._started = (start, events)
+
+    def _count_start(self, length):
+        """Account for a program start in the expected state of the device."""
+        if self._run is not None:
+            self._run = (self._run + 1) & 0xFFFF
+        self._active = (self._run, length)
+
+    def _bank_events(self, bank):
+        """Return the program resident in bank, None if unknown."""
+        for b, events in self.programs.values():
+            if b == bank:
+                return events
+        return None
+
+    def store_program(self, name, events):
+        """Keep a program resident on the device under the given name.
+
+        The program is written in one of the N_BANKS device banks, the
+        least recently run one being reused when they are all taken. It
+        can then be started with run_program(name) in a single exchange,
+        whatever the working program. The working program is overwritten
+        on the way (see upload_program). Storing a program again under
+        the same name with the same events costs nothing.
+
+        Args:
+            name (str): Name of the program.
+            events: Sequence of (timing_counts, pin_mask) pairs, as for upload_program.
+
+        Raises:
+            IOError: If the firmware has no program banks, or if the
+                program cannot be stored.
+        """
+        return self._execute(self._store_program_steps(name, events))
+
+    def _store_program_steps(self, name, events):
+        events = _as_events(events)
+        if '_store_bank' not in self._command_names:
+            raise IOError('The firmware does not support resident programs, please update it')
+        if (name in self.programs) and (self.programs[name][1] == events):
+            return
+        bank = self._free_bank(name)
+        calls = [('_store_bank', (bank,))] + [('get_program', (i, bank + 2)) for i in range(len(events))]
+        yield from self._upload_program_steps(events)
+        try:
+            answers = yield ('many', calls, False)
+        except ValueError:
+            # The working program was lost (device reset), write it again
+            self._shadow = None
+            self.metrics.retry('store_program')
+            yield from self._upload_program_steps(events)
+            answers = yield ('many', calls, False)
+        if answers[1:] != events:
+            raise IOError(f'Corrupted program in bank {bank}. Asked for {events} got {answers[1:]}')
+        self.programs[name] = (bank, events)
+
+    def _free_bank(self, name):
+        """Return the bank to use for a program, forgetting the program it holds."""
+        if name in self.programs:
+            return self.programs.pop(name)[0]
+        taken = [bank for bank, events in self.programs.values()]
+        for bank in range(N_BANKS):
+            if bank not in taken:
+                return bank
+        # Evict the least recently run program
+        return self.programs.pop(next(iter(self.programs)))[0]
+
+    def run_program(self, name):
+        """Start the resident program stored under the given name, see store_program.
+
+        If the device lost its banks (after a reset), the program is
+        stored again before retrying.
+        """
+        return self._execute(self._run_program_steps(name))
+
+    def _run_program_steps(self, name):
+        yield from self._admit_steps(self.programs[name][1])
+        yield from self._start_bank_steps(name)
+
+    def _start_bank_steps(self, name):
+        """Start a resident program once admitted, see run_program."""
+        bank, events = self.programs[name]
+        # Keep the registry ordered by last use
+        self.programs[name] = self.programs.pop(name)
+        try:
+            epoch = time.time()
+            start = time.perf_counter()
+            yield ('call', '_start_program_bank', (bank,))
+        except ValueError:
+            self.metrics.retry('run_program')
+            del self.programs[name]
+            yield from self._store_program_steps(name, events)
+            bank = self.programs[name][0]
+            epoch = time.time()
+            start = time.perf_counter()
+            yield ('call', '_start_program_bank', (bank,))
+        self._program_started(epoch, start, bank=bank)
+
+    def _repeat_period(self, repeat, period_sec, events):
+        """Check the repeat mode parameters of the program events and return the period in counts (0 if not repeated)."""
+        if repeat == 1:
+            return 0
+        if '_start_repeat' not in self._command_names:
+            raise IOError('The firmware does not support the repeat mode, please update it')
+        if period_sec is None:
+            raise ValueError('period_sec is required to repeat a program')
+        period = self._ct(period_sec)
+        if not 0 < repeat < 2**16:
+            raise ValueError(f'The number of cycles must be between 1 and 65535, got {repeat}')
+        if not 0 < period < 2**32:
+            raise ValueError(f'The period must be shorter than {2**32 / self.frequency:.0f} seconds')
+        if (events is not None) and (period <= events[-1][0]):
+            raise ValueError('The period must be longer than the program')
+        return period
+
+    def stream_program(self, events, lead_sec=0.1):
+        """Execute a program of any length timed by the device.
+
+        Programs of up to MAX_N_EVENTS events are uploaded and started
+        as usual. Longer ones run in streaming mode: the device program
+        slots are used as a ring, refilled by the host as the events are
+        executed. The refills are driven by the program cursor reported
+        in the status, and are scheduled when half of the ring has been
+        consumed, lead_sec ahead. The events keep the timer resolution
+        whatever the program length, successive events only have to be
+        less than 2**32 counts (about 35 minutes) apart.
+
+        The call returns when the last events have been handed to the
+        device, use wait() for the end of the program.
+
+        Args:
+            events: Sequence of (timing_counts, pin_mask) pairs sorted by
+                timing, typically a numpy structured array. Timings are
+                counts since the program start and may exceed 2**32
+                (use a 64 bit integer type).
+            lead_sec (float): Margin kept between the refill of the ring
+                and the execution of the events.
+
+        Raises:
+            ValueError: If the timings are not increasing or too far apart.
+            IOError: If the device executed all the events available
+                before the host refilled the ring, or if its firmware
+                cannot stream programs.
+        """
+        return self._execute(self._stream_program_steps(events, lead_sec))
+
+    def _stream_program_steps(self, events, lead_sec):
+        events = _as_events(events)
+        timings = [e[0] for e in events]
+        if (not events) or (timings[0] < 0) or any(not 0 <= b - a < 2**32 for a, b in zip([0] + timings, timings)):
+            raise ValueError('Program timings must be increasing with steps below 2**32 counts')
+        if (len(events) > MAX_N_EVENTS) and ('_start_stream' not in self._command_names):
+            raise IOError(f'The firmware cannot run programs longer than {MAX_N_EVENTS} events, please update it')
+        yield from self._admit_steps(events)
+        if len(events) <= MAX_N_EVENTS:
+            yield from self._upload_program_steps(events)
+            yield from self._start_working_steps()
+            return
+        # The ring overwrites the stored program
+        self._shadow = None
+        self._started = None
+        yield from self._stream_write_steps(events, 0, MAX_N_EVENTS, [])
+        epoch = time.time()
+        start = time.perf_counter()
+        yield ('call', '_start_stream', (MAX_N_EVENTS,))
+        self.program_epoch = (epoch, time.time())
+        self._cycles = (1, 0)
+        self._running_bank = None
+        self._count_start(MAX_N_EVENTS)
+        committed = MAX_N_EVENTS
+        consumed = 0
+        while committed < len(events):
+            cursor = (yield ('call', 'raw_status', ()))[2]
+            if cursor == 0:
+                raise IOError(f'Program underrun: the device ran out of events after {committed} of {len(events)}')
+            # The cursor is the slot of the next event plus one
+            consumed += (cursor - 1 - consumed) % MAX_N_EVENTS
+            free = MAX_N_EVENTS - (committed - consumed)
+            if free:
+                end = min(len(events), committed + free)
+                try:
+                    yield from self._stream_write_steps(events, committed, end, [('_extend_stream', (end - committed,))])
+                except ValueError:
+                    raise IOError(f'Program underrun: the device ran out of events after {committed} of {len(events)}')
+                committed = end
+            # Sleep until half of the ring has been consumed
+            wake = self.mcu_to_host(timings[max(consumed, committed - MAX_N_EVENTS // 2)]) - lead_sec
+            yield ('sleep', wake - time.time())
+        self._started = (start, [events[0], events[-1]])
+
+    def _stream_write_steps(self, events, begin, end, calls):
+        """Write events[begin:end] in their ring slots, followed by calls."""
+        writes = [('program_pulse', (events[k][1], k % MAX_N_EVENTS, events[k][0] & 0xFFFFFFFF)) for k in range(begin, end)]
+        answers = yield ('many', writes + calls, False)
+        if any(a != w[1][2] for a, w in zip(answers, writes)):
+            raise IOError('Corrupted program slot on device')
+
+    def _start_executed_steps(self, run, events):
+        """Tell whether a start whose answer was lost was executed.
+
+        Args:
+            run: The device counter of program starts before the start, None if unknown.
+            events: The program the device held before the start, None if unknown.
+
+        Returns:
+            bool: True if the device counted the start. False if it did
+            not, or if its firmware cannot tell (no program_state).
+        """
+        if (run is None) or ('program_state' not in self._command_names):
+            return False
+        n_events, current = yield ('call', 'program_state', ())
+        if (events is not None) and (n_events == len(events)):
+            # The program was not lost with the answer
+            self._shadow = events
+        executed = current == (run + 1) & 0xFFFF
+        # The start is counted by _program_started or _start_working_steps
+        self._run = run if executed else current
+        return executed
+
+    def _communication_error(self):
+        self._shadow = None
+        self._started = None
+        # A start may have been executed without its answer
+        self._run = None
+        self._active = None
+
+    def timed_shutter(self, delay_sec=1e-4, duration_sec=1, port='A', pulsewidth_sec=30e-3, exec=True, echo=False, repeat=1, period_sec=None, store=None):
         """Program a sequence to open and close the shutter with specified timing.
 
         This method sets up a sequence of pulses to open the shutter after a delay,
@@ -135,16 +563,16 @@ class SmartIris(bincoms.SerialBC):
             pulsewidth_sec (float): Duration of the opening/closing pulses (default: 0.03 s).
             exec (bool): If false program only. The execution can be triggered later using method start_program.
             echo (bool): If True, the pulses are echoed on the trigger out line.
+            repeat (int): Number of exposures, executed by the device every period_sec (see start_program).
+                Call stream_events first to get the sensor records of all the exposures.
+            period_sec (float): Time between the starts of two exposures when repeat > 1.
+            store (str): If given, keep the program resident on the device under this name and run it from there (see store_program).
         """
-        pins = port_pins_with_echo[port] if echo else port_pins[port]
-        self.safe_program_pulse(pins['open'], 0, delay_sec)
-        self.safe_program_pulse(pins['open'], 1, delay_sec + pulsewidth_sec)
-        self.safe_program_pulse(pins['close'], 2, delay_sec + duration_sec)
-        self.safe_program_pulse(pins['close'], 3, delay_sec + duration_sec + pulsewidth_sec)
-        if exec:
-            self.start_program()
+        if (store is not None) and (repeat != 1):
+            raise ValueError('Resident programs cannot be repeated')
+        return self._execute(self._load_steps(self._timed_events(delay_sec, duration_sec, port, pulsewidth_sec, echo), exec, store, repeat, period_sec))
 
-    def open_shutter(self, port='A', pulsewidth_sec=30e-3, delay_sec=10e-3, exec=True, echo=False):
+    def open_shutter(self, port='A', pulsewidth_sec=30e-3, delay_sec=10e-3, exec=True, echo=False, store=None):
         """Open the shutter on the specified port.
 
         Programs and starts a sequence to activate the open pin for the given pulse width.
@@ -155,14 +583,11 @@ class SmartIris(bincoms.SerialBC):
             delay_sec (float): Delay before starting (default: 0.01 s).
             exec (bool): If false program only. The execution can be triggered later using method start_program.
             echo (bool): If True, the pulses are echoed on the trigger out line.
+            store (str): If given, keep the program resident on the device under this name and run it from there (see store_program).
         """
-        pins = port_pins_with_echo[port] if echo else port_pins[port]
-        self.program_pulse(pins['open'], 0, self._ct(delay_sec))
-        self.program_pulse(pins['open'], 1, self._ct(delay_sec + pulsewidth_sec))
-        if exec:
-            self.start_program()
+        return self._execute(self._load_steps(self._pulse_events('open', port, pulsewidth_sec, delay_sec, echo), exec, store))
 
-    def close_shutter(self, port='A', pulsewidth_sec=30e-3, delay_sec=10e-3, exec=True, echo=False):
+    def close_shutter(self, port='A', pulsewidth_sec=30e-3, delay_sec=10e-3, exec=True, echo=False, store=None):
         """Close the shutter on the specified port.
 
         Programs and starts a sequence to activate the close pin for the given pulse width.
@@ -173,38 +598,222 @@ class SmartIris(bincoms.SerialBC):
             delay_sec (float): Delay before starting (default: 0.01 s).
             exec (bool): If false program only. The execution can be triggered later using method start_program.
             echo (bool): If True, the pulses are echoed on the trigger out line.
+            store (str): If given, keep the program resident on the device under this name and run it from there (see store_program).
         """
-        pins = port_pins_with_echo[port] if echo else port_pins[port]
-        self.program_pulse(pins['close'], 0, self._ct(delay_sec))
-        self.program_pulse(pins['close'], 1, self._ct(delay_sec + pulsewidth_sec))
+        return self._execute(self._load_steps(self._pulse_events('close', port, pulsewidth_sec, delay_sec, echo), exec, store))
+
+    def _load_steps(self, events, exec, store, repeat=1, period_sec=None):
+        """Upload (or store) and start a program for the shutter methods."""
         if exec:
-            self.start_program()
+            # Wait, or refuse the program, before it replaces the one loaded
+            period = self._repeat_period(repeat, period_sec, events) if store is None else 0
+            yield from self._admit_steps(events, repeat, period)
+        if store is None:
+            yield from self._upload_program_steps(events)
+            if exec:
+                yield from self._start_working_steps(repeat, period)
+        else:
+            yield from self._store_program_steps(store, events)
+            if exec:
+                yield from self._start_bank_steps(store)
+
+    def _timed_events(self, delay_sec, duration_sec, port, pulsewidth_sec, echo):
+        pins = port_pins_with_echo[port] if echo else port_pins[port]
+        return [(self._ct(delay_sec), pins['open']),
+                (self._ct(delay_sec + pulsewidth_sec), pins['open']),
+                (self._ct(delay_sec + duration_sec), pins['close']),
+                (self._ct(delay_sec + duration_sec + pulsewidth_sec), pins['close'])]
+
+    def _pulse_events(self, action, port, pulsewidth_sec, delay_sec, echo):
+        pins = port_pins_with_echo[port] if echo else port_pins[port]
+        return [(self._ct(delay_sec), pins[action]),
+                (self._ct(delay_sec + pulsewidth_sec), pins[action])]
 
     def read_program(self):
         """Print the programmed pulse sequence for debugging.
 
         Reads and displays the program steps (up to 4) from the device.
         """
-        program_length = self.status()['program_length']
-        return [self.get_program(i, 0) for i in range(program_length)]
+        return self._execute(self._read_program_steps())
+
+    def _read_program_steps(self):
+        program_length = (yield from self._status_steps())['program_length']
+        return (yield ('many', [('get_program', (i, 0)) for i in range(program_length)], False))
 
-    def read_timing_record(self):
+    def read_timing_record(self, host_time=False):
         """Read the record of sensor detection timing.
+
+        Args:
+            host_time (bool): Return the host times (as time.time) of the
+                events instead of times relative to the program start, see
+                mcu_to_host.
+        """
+        return self._execute(self._read_timing_record_steps(host_time))
+
+    def _read_timing_record_steps(self, host_time):
+        records = yield from self._records_steps()
+        if host_time:
+            return [(self.mcu_to_host(timing), ['', 'sensorA', 'sensorB'][pin]) for timing, pin in records]
+        return self._convert_records(records)
+
+    def read_cycle_records(self, host_time=False):
+        """Read the sensor records of the last program, split by cycle.
+
+        Intended for programs started with repeat > 1 (see
+        start_program). When the events are streamed (see
+        stream_events), the buffer of the stream is used and holds the
+        events of all the cycles. Otherwise the device record is read,
+        which only keeps the first MAX_N_RECORDS - 1 events of the whole
+        program: once it is full, the cycle of its last event and the
+        following ones are unknown.
+
+        Args:
+            host_time (bool): Return the host times (as time.time) of the
+                events instead of times relative to the cycle start.
+
+        Returns:
+            list: One list of (time, sensor) pairs per cycle, empty for
+            the cycles not executed yet, None for the cycles whose
+            events were not recorded (device record full).
+        """
+        return self._execute(self._read_cycle_records_steps(host_time))
+
+    def _read_cycle_records_steps(self, host_time):
+        records = self._streamed_records()
+        complete = True
+        if records is None:
+            records = yield from self._records_steps()
+            # The firmware stops recording, without telling whether
+            # events were missed, once its record is full
+            complete = len(records) < MAX_N_RECORDS - 1
+        return self._split_cycles(records, host_time, complete)
+
+    def _records_steps(self):
+        """Read the sensor records kept by the device."""
+        nrecords = (yield from self._status_steps())['events_recorded']
+        return (yield ('many', [('get_program', (i, 1)) for i in range(nrecords)], False))
+
+    def _streamed_records(self):
+        """Return the sensor events of the last program in the event stream, None if not streamed."""
+        stream = self.event_stream
+        if (stream is None) or (not stream.streaming):
+            return None
+        events = stream.buffer.since(self._cycles_index)[0]
+        if len(events):
+            # Keep the last program only
+            events = events[events['run'] == events['run'][-1]]
+        return [(int(e['time']), int(e['pin'])) for e in events if e['kind'] == 0]
+
+    def _split_cycles(self, records, host_time, complete=True):
+        repeat, period = self._cycles
+        cycles = [[] for i in range(repeat)]
+        base = last = 0
+        k = 0
+        for timing, pin in records:
+            # Undo the timer rollovers
+            timing += base
+            if timing < last:
+                base += 2**32
+                timing += 2**32
+            last = timing
+            k = min(timing // period, repeat - 1) if period else 0
+            if host_time:
+                cycles[k].append((self.mcu_to_host(timing), ['', 'sensorA', 'sensorB'][pin]))
+            else:
+                cycles[k].append(((timing - k * period) / self.frequency, ['', 'sensorA', 'sensorB'][pin]))
+        if not complete:
+            cycles[k:] = [None] * (repeat - k)
+        return cycles
+
+    def _convert_records(self, records):
+        return [(timing/self.frequency, ['', 'sensorA', 'sensorB'][pin]) for timing, pin in records]
+
+    def stream_events(self, capacity=65536):
+        """Collect the sensor events and program ends continuously.
+
+        See smartiris.events. The firmware pushes the events as they
+        happen, without the 16 records limit and without readout round
+        trips. Older firmware is polled instead.
+
+        Args:
+            capacity (int): Number of events kept in the ring buffer.
+
+        Returns:
+            EventStream: The stream, stop it with its stop method.
         """
-        nrecords = self.status()['events_recorded']
-        def convert(i):
-            timing, pin = self.get_program(i, 1)
-            return timing/self.frequency, ['', 'sensorA', 'sensorB'][pin]
-        return [convert(i) for i in range(nrecords)]
+        if self.event_stream is None:
+            from smartiris.events import EventStream
+            self.event_stream = EventStream(self, capacity)
+        return self.event_stream
+
+    def schedule_actuations(self, threshold=3.5, measure=True):
+        """Delay the program starts to keep the capacitor bank charged.
+
+        See smartiris.power. Once enabled, start_program, run_program
+        and stream_program wait until the bank, as predicted by a model
+        learned from its voltage readings, stays above threshold during
+        the whole program. Set the scheduler attribute to None to disable.
+
+        Args:
+            threshold (float): Minimum voltage of the capacitor bank in V.
+            measure (bool): Read the bank voltage before each start.
+
+        Returns:
+            ActuationScheduler: The scheduler, see its max_rate method.
+        """
+        from smartiris.power import ActuationScheduler
+        self.scheduler = ActuationScheduler(self, threshold, measure)
+        return self.scheduler
+
+    def _admit_steps(self, events, repeat=1, period=0):
+        """Wait until the scheduler, if any, lets the program start."""
+        if self.scheduler is not None:
+            yield from self.scheduler._admit_steps(events, repeat, period)
+
+    def mcu_to_host(self, counts):
+        """Convert mcu timer counts since the last program start to host time.
+
+        Without a running timesync, the timer is assumed to run at the
+        calibrated frequency from the middle of the start_program exchange.
+
+        Args:
+            counts (int or numpy array): mcu timer counts.
+
+        Returns:
+            The host times (as time.time) in seconds.
+        """
+        if self.timesync is not None:
+            return self.timesync.mcu_to_host(counts)
+        if self.program_epoch is None:
+            raise ValueError('No program started, the mcu time is not related to the host time')
+        return (self.program_epoch[0] + self.program_epoch[1]) * 0.5 + counts / self.frequency
+
+    def host_to_mcu(self, t):
+        """Convert host times to mcu timer counts since the last program start, see mcu_to_host."""
+        if self.timesync is not None:
+            return self.timesync.host_to_mcu(t)
+        if self.program_epoch is None:
+            raise ValueError('No program started, the mcu time is not related to the host time')
+        return (t - (self.program_epoch[0] + self.program_epoch[1]) * 0.5) * self.frequency
 
     def read_mcu_temperature(self):
-        V_adc = self.read_adc(adc_pin_maps['MCU_TEMP'])
+        return self._execute(self._adc_steps('MCU_TEMP', self._mcu_temperature))
+
+    def _adc_steps(self, channel, convert):
+        """Read the ADC channel and return the reading converted by convert."""
+        return convert((yield ('call', 'read_adc', (adc_pin_maps[channel],))))
+
+    def _mcu_temperature(self, V_adc):
         return (V_adc - 273 + 100 - self._ts_offset)*128/self._ts_gain + 25
     
     def read_temperature(self):
         """ Read the TMP36 temperature in deg C
         """
-        V_adc = self.read_adc(adc_pin_maps['TMP36']) * 1.1/1024
+        return self._execute(self._adc_steps('TMP36', self._temperature))
+
+    @staticmethod
+    def _temperature(adc):
+        V_adc = adc * 1.1/1024
         # 10 mV / deg and 750mV @ 25
         temp = 25 + (V_adc - 0.75) * 100
         return temp
@@ -212,7 +821,11 @@ class SmartIris(bincoms.SerialBC):
     def read_capacitor_bank_voltage(self):
         """ Read the capacitor bank voltage in V
         """
-        V_adc = self.read_adc(adc_pin_maps['U_BANK']) * 1.1/1024
+        return self._execute(self._adc_steps('U_BANK', self._capacitor_bank_voltage))
+
+    @staticmethod
+    def _capacitor_bank_voltage(adc):
+        V_adc = adc * 1.1/1024
         return 46 / 10 * V_adc # Divider 10k/36k
 
     def status(self):
@@ -226,9 +839,41 @@ class SmartIris(bincoms.SerialBC):
                 - 'program_length': number of pin changes in the program.
                 - 'events_recorded': The number of recorded sensor events.
         """
-        com_port, read_port, program_cursor, program_length, nrecords = self.raw_status()
+        return self._execute(self._status_steps())
+
+    def _status_steps(self):
+        if 'program_state' in self._command_names:
+            return self._decode_status(*(yield ('many', [('raw_status', ()), ('program_state', ())], False)))
+        return self._decode_status((yield ('call', 'raw_status', ())))
+
+    def _decode_status(self, raw, state=None):
+        com_port, read_port, program_cursor, program_length, nrecords = raw
         if self.debug:
-            print(f'{com_port=}, {read_port=}, {program_cursor=},{program_length=}, {nrecords=}')
+            print(f'{com_port=}, {read_port=}, {program_cursor=},{program_length=}, {nrecords=}, {state=}')
+        if state is not None:
+            n_events, run = state
+            if (self._shadow is not None) and (n_events != len(self._shadow)):
+                # The device was reset, its program is lost
+                self._shadow = None
+        if self._active is not None:
+            expected_run, length = self._active
+            if (((state is not None) and (expected_run is not None) and (run != expected_run))
+                or ((length is not None) and (program_length != length))):
+                # A builtin program was started by a button, or the
+                # device was reset: the program started by this
+                # instance is not the active one anymore
+                self._active = None
+                self._started = None
+                self._running_bank = None
+        if state is not None:
+            self._run = run
+        if self.snapshot is not None:
+            self.snapshot.publish_status(raw)
+        return self._status_fields(raw)
+
+    @staticmethod
+    def _status_fields(raw):
+        com_port, read_port, program_cursor, program_length, nrecords = raw
         status = {
             'shutter_A': 'closed' if read_port & 0b100 else 'open',
             'shutter_B': 'closed' if read_port & 0b1000 else 'open',
@@ -238,19 +883,391 @@ class SmartIris(bincoms.SerialBC):
         }
         return status
 
-    def wait(self):
+    def wait(self, condition=None, timeout=None, poll_interval=2e-3, margin_sec=5e-3):
         """Block execution until the shutter program completes.
 
-        Polls the status until the 'busy' flag is cleared, checking every 0.1 seconds.
+        When the running program was started by this instance, its
+        expected end is computed from the program timings and the
+        calibrated clock frequency. The host sleeps until shortly before
+        that point and then polls the status every poll_interval. For
+        other programs (e.g. triggered by the buttons) the status is
+        polled every 0.1 seconds.
+
+        Args:
+            condition (callable): If provided, return as soon as
+                condition(status) is True instead of waiting for the
+                program completion. Polling then starts at the first
+                pin change of the program. Example:
+                lambda s: s['shutter_A'] == 'open'
+            timeout (float): Maximum waiting time in seconds.
+            poll_interval (float): Interval between status queries close to the deadline.
+            margin_sec (float): Wake up that long before the expected end of the program.
+
+        Returns:
+            dict: The last status read.
+
+        Raises:
+            TimeoutError: If the timeout expires first.
         """
-        while self.status()['busy']:
-            time.sleep(0.1)
+        return self._execute(self._wait_steps(condition, timeout, poll_interval, margin_sec))
+
+    def _wait_steps(self, condition, timeout, poll_interval, margin_sec):
+        wake, interval, deadline = self._wait_plan(condition, timeout, poll_interval, margin_sec)
+        yield ('sleep', wake - time.perf_counter())
+        if condition is None:
+            condition = lambda status: not status['busy']
+        while True:
+            status = yield from self._status_steps()
+            if condition(status):
+                return status
+            yield ('sleep', self._poll_delay(status, interval, deadline, timeout))
+
+    def _wait_plan(self, condition, timeout, poll_interval, margin_sec):
+        """Return the wake up time, polling interval and deadline for wait()."""
+        now = time.perf_counter()
+        deadline = None if timeout is None else now + timeout
+        if self._started is not None:
+            start, events = self._started
+            end = events[-1][0] if condition is None else events[0][0]
+            # Allow for the residual error on the clock frequency
+            wake = start + end / self.frequency * (1 - clock_tolerance) - margin_sec
+            interval = poll_interval
+        else:
+            wake = now
+            interval = 0.1
+        if deadline is not None:
+            wake = min(wake, deadline)
+        return wake, interval, deadline
+
+    def _poll_delay(self, status, interval, deadline, timeout):
+        if deadline is None:
+            return interval
+        now = time.perf_counter()
+        if now >= deadline:
+            raise TimeoutError(f'Condition not met after {timeout} s, last status: {status}')
+        return min(interval, deadline - now)
 
     def enable_buttons(self):
-        self._set_interrupt_mask((1<<5 | 1<<6))
+        return self._set_interrupt_mask((1<<5 | 1<<6))
 
     def disable_buttons(self):
-        self._set_interrupt_mask(0)
+        return self._set_interrupt_mask(0)
+
+    def _execute(self, steps):
+        """Perform the exchanges yielded by the generator steps and return its result.
+
+        The generator yields its requests and receives their results:
+        ('call', name, args) for the device function name, ('many',
+        calls, return_exceptions) for call_many and ('sleep', seconds).
+        The exceptions raised by a request are thrown into the generator.
+
+        When the device is shared between threads (I/O worker, event
+        stream, snapshot publisher), its lock is held during the whole
+        operation so that the exchanges of other threads cannot come in
+        between, e.g. between an upload and the start of the program.
+        It is released while the operation sleeps (scheduler delays,
+        wait, refills of stream_program), unless the caller holds it.
+        """
+        lock = getattr(self, '_lock', None)
+        if (lock is not None) and lock.owned():
+            lock = None
+        if lock is not None:
+            lock.acquire()
+        try:
+            result = error = None
+            while True:
+                try:
+                    request = steps.send(result) if error is None else steps.throw(error)
+                except StopIteration as stop:
+                    return stop.value
+                result = error = None
+                try:
+                    kind = request[0]
+                    if kind == 'call':
+                        result = getattr(self, request[1])(*request[2])
+                    elif kind == 'many':
+                        result = self.call_many(request[1], return_exceptions=request[2])
+                    elif lock is None:
+                        time.sleep(max(request[1], 0))
+                    else:
+                        lock.release()
+                        try:
+                            time.sleep(max(request[1], 0))
+                        finally:
+                            lock.acquire()
+                except Exception as e:
+                    error = e
+        finally:
+            if lock is not None:
+                lock.release()
+
+class SmartIris(SmartIrisBase):
+    """A class to control an iris blade shutter via serial communication.
+
+    Inherits from bincoms.SerialBC to provide low-level serial communication
+    functionality. This class manages shutter operations such as opening,
+    closing, and timed sequences using a microcontroller's timer.
+
+    Attributes:
+        time_resolution (float): The timer resolution in seconds (default: 0.5e-6).
+    """
+
+    def calibrate(self, duration_min=10, output_file='', precision=0):
+        ''' Measure the mcu clock rate against the host clock and store the calibrated frequency
+
+        Args:
+            duration_min (float): Duration of the measurement in minutes.
+            output_file (str): If given, save the data in this directory instead of adjusting the clock.
+            precision (float): If non zero, stop as soon as the relative uncertainty on the rate is below this value.
+        '''
+        import smartiris.clock_calibration
+        fit = smartiris.clock_calibration.OnlineClockFit(self.frequency)
+        smartiris.clock_calibration.acquire_clock_data(self, duration=duration_min*60, output=output_file, precision=precision, fit=fit)
+        slope, eslope = fit.slope, fit.eslope
+        print(f'Measured a time scale difference of {(slope-1) * 100:.4f}% (±{eslope*100:.4f}%)')
+        if output_file:
+            print(f'Calibration data saved in {output_file}. Clock scale not adjusted')
+        else:
+            calibrated_frequency = self.frequency * slope
+            print(f'Adjusting frequency from {self.frequency * 1e-6:.6f} MHz to {calibrated_frequency * 1e-6:.6f} MHz')
+            self.set_clock_calibration(calibrated_frequency)
+            self.frequency = calibrated_frequency
+        
+    def start_timesync(self, interval=1.):
+        """Start tracking the mcu timer against the host clock in the background.
+
+        See smartiris.timesync.TimeSync. Once started, mcu_to_host and
+        host_to_mcu use its estimate.
+
+        Args:
+            interval (float): Time between two samples of the mcu timer in seconds.
+
+        Returns:
+            TimeSync: The synchronizer.
+        """
+        if self.timesync is None:
+            from smartiris.timesync import TimeSync
+            self.timesync = TimeSync(self, interval)
+        return self.timesync
+
+    def start_worker(self, priorities=None):
+        """Let several threads share the device through a prioritized I/O worker.
+
+        See bincoms.worker. Once started, all the exchanges go through a
+        dedicated thread that serves the program starts and stops
+        first, then the other requests, and the housekeeping readings
+        (ADC, signature row, calibration) last. Threads can set the
+        priority and deadline of their calls with worker.options, or
+        queue calls with worker.submit to get a future. The methods of
+        SmartIris making several exchanges hold the device lock, so that
+        their exchanges are not interleaved with those of other threads.
+
+        Args:
+            priorities (dict): Priorities of the device functions by name,
+                overriding the defaults.
+
+        Returns:
+            IOWorker: The worker, stop it with its stop method.
+        """
+        if self.worker is None:
+            from bincoms.worker import IOWorker, CRITICAL, HOUSEKEEPING
+            defaults = {name: CRITICAL for name in ('_start_program', 'stop_program', '_start_repeat',
+                                                    '_start_program_bank', '_start_stream', '_extend_stream')}
+            defaults.update((name, HOUSEKEEPING) for name in ('read_adc', 'read_signature_row', 'get_clock_calibration'))
+            defaults.update(priorities or {})
+            self.worker = IOWorker(self, defaults)
+        return self.worker
+
+    def publish_snapshot(self, path=None, interval=0.1, adc_interval=1.):
+        """Share the status, temperatures and bank voltage with other processes.
+
+        See smartiris.snapshot. A background thread keeps a memory-mapped
+        file up to date, which any number of processes can read with
+        smartiris.snapshot.SnapshotReader without using the serial port.
+        The status reads made by this process are published as well.
+
+        Args:
+            path (str): Path of the file, by default
+                smartiris.snapshot.snapshot_path of the device path.
+            interval (float): Maximum age of the published status in seconds.
+            adc_interval (float): Time between two ADC readings in seconds.
+
+        Returns:
+            SnapshotPublisher: The publisher, stop it with its stop method.
+        """
+        if self.snapshot is None:
+            from smartiris.snapshot import SnapshotPublisher
+            # Registered before starting so that the first status is published
+            self.snapshot = SnapshotPublisher(self, path, interval, adc_interval, start=False)
+            self.snapshot.start()
+        return self.snapshot
+
+
+class SmartIrisGroup(object):
+    """Drive several controllers as one.
+
+    Programs are uploaded to all the controllers in parallel and started
+    in a single burst of writes, without waiting for the answers in
+    between. The host-side start skew of the last burst, i.e. the spread
+    of the times at which the start requests were written, is available
+    as start_skew.
+
+    Example:
+        g = SmartIrisGroup()  # all the connected controllers
+        g.timed_shutter(duration_sec=2)
+        print(g.start_skew)
+        g.wait()
+    """
+
+    def __init__(self, devices=None, **keys):
+        """Connect to the controllers.
+
+        Args:
+            devices (list): SmartIris instances or device paths. All the
+                detected controllers are used if None.
+            **keys: Keyword arguments passed to SmartIris for the devices given as paths.
+        """
+        if devices is None:
+            devices = bincoms.find_devices()
+        from concurrent.futures import ThreadPoolExecutor
+        self._pool = ThreadPoolExecutor(max_workers=max(len(devices), 1))
+        self.devices = list(self._pool.map(lambda d: d if isinstance(d, SmartIris) else SmartIris(dev=d, **keys), devices))
+        self.start_skew = None
+
+    def __len__(self):
+        return len(self.devices)
+
+    def __iter__(self):
+        return iter(self.devices)
+
+    def __getitem__(self, i):
+        return self.devices[i]
+
+    def map(self, func, *iterables):
+        """Return [func(device, *args)] evaluated in parallel for each device."""
+        return list(self._pool.map(func, self.devices, *iterables))
+
+    def upload_program(self, events, retries=2):
+        """Upload the same program to all controllers."""
+        self.map(lambda d: d.upload_program(events, retries))
+
+    def start_program(self):
+        """Start the programs of all controllers in one burst.
+
+        The programs are admitted first by the scheduler of each
+        controller, if any (see SmartIris.schedule_actuations). During
+        the burst, the controllers shared with other threads (event
+        streams, time synchronisation, I/O worker) are held by their
+        device lock.
+
+        A device reporting that it has no valid program (after a reset)
+        gets its program uploaded again and is started alone. When the
+        answer to a start is lost or corrupted, the device counter of
+        program starts tells whether the start was executed, and the
+        device is started alone only if it was not.
+
+        Returns:
+            float: The host-side start skew in seconds.
+        """
+        for d in self.devices:
+            d._execute(d._admit_steps(d._shadow))
+        frames = [d._start_program.frame() for d in self.devices]
+        times = []
+        epochs = []
+        error = None
+        with contextlib.ExitStack() as stack:
+            for d in self.devices:
+                if getattr(d, '_lock', None) is not None:
+                    stack.enter_context(d._lock)
+                if d._unanswered:
+                    d.resync()
+                if (d._run is None) and ('program_state' in d._command_names):
+                    d._run = d.program_state()[1]
+                if d.event_stream is not None:
+                    d._cycles_index = d.event_stream.buffer.count
+            # State of the devices before the burst
+            before = [(d._run, d._shadow) for d in self.devices]
+            for d, frame in zip(self.devices, frames):
+                epochs.append(time.time())
+                start = time.perf_counter()
+                d._send(frame)
+                times.append((start + time.perf_counter()) / 2)
+            self.start_skew = max(times) - min(times)
+            for d, start, epoch, (run, events) in zip(self.devices, times, epochs, before):
+                try:
+                    d.rcv()
+                except bincoms.CommunicationError:
+                    if d._unanswered:
+                        d.resync()
+                    if d._execute(d._start_executed_steps(run, events)):
+                        d._program_started(epoch, start)
+                    else:
+                        if events is not None:
+                            d.upload_program(events)
+                        d._execute(d._start_working_steps())
+                except ValueError as e:
+                    if not str(e).startswith('VALUE_ERROR'):
+                        error = error or e
+                        continue
+                    # The device lost its program: upload it again and start alone
+                    d._execute(d._start_working_steps())
+                else:
+                    d._program_started(epoch, start)
+        if error is not None:
+            raise error
+        return self.start_skew
+
+    def timed_shutter(self, exec=True, **keys):
+        """Program (and start) the same timed sequence on all controllers.
+
+        Keyword arguments are passed to SmartIris.timed_shutter.
+        """
+        self.map(lambda d: d.timed_shutter(exec=False, **keys))
+        if exec:
+            self.start_program()
+
+    def open_shutter(self, exec=True, **keys):
+        """Open the shutters of all controllers, see SmartIris.open_shutter."""
+        self.map(lambda d: d.open_shutter(exec=False, **keys))
+        if exec:
+            self.start_program()
+
+    def close_shutter(self, exec=True, **keys):
+        """Close the shutters of all controllers, see SmartIris.close_shutter."""
+        self.map(lambda d: d.close_shutter(exec=False, **keys))
+        if exec:
+            self.start_program()
+
+    def status(self):
+        """Return the list of the controllers status."""
+        return self.map(lambda d: d.status())
+
+    def wait(self, **keys):
+        """Wait for the completion of all programs, see SmartIris.wait."""
+        return self.map(lambda d: d.wait(**keys))
+
+# The maximum number of programmable control pin changes (MAX_N_EVENTS in the firmware)
+MAX_N_EVENTS = 16
+
+# The size of the sensor record of the device (MAX_N_RECORDS in the
+# firmware), whose last slot is overwritten by each new event
+MAX_N_RECORDS = 16
+
+# The number of resident program banks (N_BANKS in the firmware)
+N_BANKS = 4
+
+# Relative accuracy assumed on the mcu clock frequency when predicting
+# the end of a program
+clock_tolerance = 1e-3
+
+# Layout of a program for use with numpy: np.array(events, dtype=program_dtype)
+program_dtype = [('timing', '<u4'), ('pin', 'u1')]
+
+def _as_events(events):
+    """Convert a program to a list of (timing_counts, pin_mask) tuples of python ints."""
+    if hasattr(events, 'tolist'):
+        events = events.tolist()
+    return [(int(timing), int(pin)) for timing, pin in events]
 
 # This is the portB mask corresponding to each pins
 pin_map = {8: 1 << 0,
@@ -285,6 +1302,7 @@ adc_pin_maps = {'TMP36': 0,
                 }
 
 def restricted_float(x, min_val=5., max_val=35.):
+    import argparse
     try:
         x = float(x)  # Convert string input to float
     except ValueError:
@@ -295,6 +1313,7 @@ def restricted_float(x, min_val=5., max_val=35.):
 
 def test():
     ''' Operate the shutter from the command line'''
+    import argparse
     parser = argparse.ArgumentParser(
         description='Operate an iris blade shutter')
     parser.add_argument(
@@ -313,6 +1332,9 @@ def test():
     parser.add_argument(
         '-r', '--reset', action='store_true',
         help='Hard reset the device at startup')
+    parser.add_argument(
+        '-n', '--no-cache', action='store_true',
+        help='Do not reuse the device description cached at previous connections')
     
     # Create subparsers for the commands
     subparsers = parser.add_subparsers(dest='command', help='Available commands')
@@ -346,6 +1368,7 @@ def test():
 
     parser_status = subparsers.add_parser('status', help='Print the shutter status')
     parser_status.add_argument('--raw', action='store_true', help='Display raw (unprocess) device status')
+    parser_status.add_argument('-s', '--snapshot', action='store_true', help='Read the status published by a "serve --snapshot" daemon, without using the serial port')
 
     parser_disable = subparsers.add_parser('disable_buttons', help='Disable device buttons for the session to avoid interference with remote controle.')
     parser_enable = subparsers.add_parser('enable_buttons', help='Re-enable device buttons for the session, They will have precedence over remote operations.')
@@ -353,14 +1376,45 @@ def test():
     parser_calibrate.add_argument(
         '-d', '--duration', type=float, default=1,
         help='Duration of the calibration procedure (in minutes)')
+    parser_calibrate.add_argument(
+        '-p', '--precision', type=float, default=0,
+        help='Stop before the end of the duration once the relative uncertainty on the clock rate is below this value (e.g. 1e-7)')
     parser_calibrate.add_argument(
         '-o', '--output-file', default="",
-        help='Instead of calibrating the MCU clock register the calibration data into the provided file')
+        help='Instead of calibrating the MCU clock register the calibration data into the provided directory')
     parser_read = subparsers.add_parser('read', help='Report measured timings of sensor events')
+    parser_serve = subparsers.add_parser('serve', help='Keep the connection open and serve the other smartiris commands through a local socket')
+    parser_serve.add_argument('-s', '--snapshot', action='store_true', help='Also publish the status, temperatures and bank voltage in shared memory for other processes')
+    parser_stats = subparsers.add_parser('stats', help='Print the communication statistics (of the daemon when one is running)')
+    parser_stats.add_argument('--format', choices=['prometheus', 'json'], default='prometheus', help='Output format')
     
     args = parser.parse_args()
-        
-    d = SmartIris(dev=args.tty, baudrate=115200, debug=args.verbose, reset=args.reset)
+
+    import smartiris.daemon
+    if args.command == 'serve':
+        d = SmartIris(dev=args.tty, baudrate=115200, debug=args.verbose, reset=args.reset, cache=not args.no_cache)
+        if args.snapshot:
+            import smartiris.snapshot
+            d.publish_snapshot(smartiris.snapshot.snapshot_path(args.tty))
+        smartiris.daemon.serve(d, smartiris.daemon.socket_path(args.tty))
+        return
+    if args.command == 'status' and args.snapshot:
+        import smartiris.snapshot
+        with smartiris.snapshot.SnapshotReader(dev=args.tty) as reader:
+            snapshot = reader.read()
+        print(snapshot['raw_status'] if args.raw else snapshot['status'])
+        print(f"Temperature: {snapshot['temperature']:.1f} °C, MCU: {snapshot['mcu_temperature']:.1f} °C, capacitor bank: {snapshot['capacitor_bank_voltage']:.2f} V")
+        print(f"Age: {time.time() - snapshot['time']:.3f} s")
+        return
+    # Go through the daemon if one is serving the device
+    try:
+        d = smartiris.daemon.connect(args.tty, baudrate=115200, debug=args.verbose, reset=args.reset, cache=not args.no_cache)
+    except RuntimeError as e:
+        parser.error(str(e))
+    if (args.command == 'calibrate') and isinstance(d, smartiris.daemon.SmartIrisClient):
+        # It would run, and print its progress, in the daemon for minutes
+        d.close()
+        parser.error('The device is served by a daemon, stop it to calibrate the clock')
     if args.command == 'open':
         d.open_shutter(port=args.port, pulsewidth_sec=args.pulse_width, echo=args.echo)
     elif args.command == 'close':
@@ -379,7 +1433,9 @@ def test():
     elif args.command == 'enable_buttons':
         d.enable_buttons()
     elif args.command == 'calibrate':
-        d.calibrate(args.duration, args.output_file)
+        d.calibrate(args.duration, args.output_file, args.precision)
+    elif args.command == 'stats':
+        print(d.stats(args.format), end='\n' if args.format == 'json' else '')
     elif args.command == 'read':
         record = d.read_timing_record()
         print(f'Recorded sensor events: {record}')
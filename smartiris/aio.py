@@ -0,0 +1,93 @@
+# Copyright 2024 Marc Betoule
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+''' asyncio version of the SmartIris controller
+
+Example:
+    import asyncio
+    from smartiris.aio import AsyncSmartIris
+
+    async def main():
+        d = await AsyncSmartIris.connect()
+        await d.timed_shutter(duration_sec=2)
+        await d.wait()
+        print(await d.read_timing_record())
+
+    asyncio.run(main())
+'''
+
+import asyncio
+
+from bincoms.aio import AsyncSerialBC
+from smartiris import SmartIrisBase
+
+
+class AsyncSmartIris(AsyncSerialBC, SmartIrisBase):
+    """Control an iris blade shutter from an asyncio event loop.
+
+    The connection (command registration, clock calibration) is done
+    synchronously as for SmartIris, then the device functions and the
+    high level methods return awaitables. Their arguments and results
+    are the same as for their SmartIris counterparts, whose program
+    logic they share, and the program starts are delayed by the
+    scheduler of schedule_actuations without blocking the loop. The
+    methods of SmartIris relying on a background thread (calibrate,
+    start_timesync, start_worker, publish_snapshot) are not available.
+    """
+
+    def __init__(self, *args, **keys):
+        super().__init__(*args, **keys)
+        # The device functions were rebound as coroutines
+        self.program_pulse = self._writing_program(self.program_pulse)
+
+    async def _execute(self, steps):
+        """Coroutine version of SmartIrisBase._execute, awaiting the exchanges."""
+        result = error = None
+        while True:
+            try:
+                request = steps.send(result) if error is None else steps.throw(error)
+            except StopIteration as stop:
+                return stop.value
+            result = error = None
+            try:
+                kind = request[0]
+                if kind == 'call':
+                    result = await getattr(self, request[1])(*request[2])
+                elif kind == 'many':
+                    result = await self.call_many(request[1], return_exceptions=request[2])
+                else:
+                    await asyncio.sleep(max(request[1], 0))
+            except Exception as e:
+                error = e
+
+    async def stream_events(self, capacity=65536):
+        '''Collect the events pushed by the firmware, see SmartIris.stream_events
+
+        The frames are read by the event loop, no thread is involved.
+        Stop the stream with stop_events.
+        '''
+        if 'set_event_stream' not in self._command_names:
+            raise IOError('The firmware does not support event streaming, please update it')
+        if self.event_stream is None:
+            from smartiris.events import EventStream
+            self.event_stream = EventStream(self, capacity, thread=False)
+            self.on_event = self.event_stream._on_event
+            await self.set_event_stream(1)
+        return self.event_stream
+
+    async def stop_events(self):
+        if self.event_stream is not None:
+            await self.set_event_stream(0)
+            self.on_event = None
+            self.event_stream = None
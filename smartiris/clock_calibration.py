@@ -1,15 +1,215 @@
-import ntplib
+import collections
+import json
+import os
 import time
 import numpy as np
-import matplotlib.pyplot as plt
-import tqdm
+import smartiris
 
+# Plotting and NTP dependencies are imported when needed only, so that
+# calibrating the device does not pay for them
 server="pool.ntp.org"
-client = ntplib.NTPClient()
-        
-def acquire_clock_data(device, duration=600, ntp=0, interval=0.1):
+
+# Content of the files written by acquire_clock_data
+timing_dtype = [('start', 'f8'), ('counts', 'u4'), ('stop', 'f8')]
+housekeeping_dtype = [('time', 'f8'), ('mcu_temp', 'f8'), ('temp', 'f8'), ('ubank', 'f8')]
+ntp_dtype = [('start', 'f8'), ('nntp', 'f8'), ('stop', 'f8')]
+
+
+class StreamFile(object):
+    """ Append records to a .npy file as they are acquired
+
+    The file is a regular NumPy array file which can be read at any time
+    with np.load(filename, mmap_mode='r'), including while it is written
+    or after a crash. Records are buffered for at most flush_interval
+    seconds, then written in place in space preallocated by chunks. The
+    shape in the header is updated after the data, so that it always
+    describes complete records.
+
+    Args:
+        filename (str): path of the file, overwritten.
+        dtype: numpy dtype of the records.
+        chunk (int): number of records preallocated at once.
+        flush_interval (float): maximum time in seconds records are kept
+            in memory only.
+    """
+    # Fixed size of the header, leaving room for the shape to grow
+    header_size = 256
+
+    def __init__(self, filename, dtype, chunk=65536, flush_interval=1.):
+        self.dtype = np.dtype(dtype)
+        self.chunk = chunk
+        self.flush_interval = flush_interval
+        self.count = 0
+        self.capacity = 0
+        self._buffer = np.zeros(1024, dtype=self.dtype)
+        self._nbuffer = 0
+        self._last_flush = time.monotonic()
+        self._file = open(filename, 'w+b')
+        self._write_header()
+
+    def _write_header(self):
+        header = repr({'descr': np.lib.format.dtype_to_descr(self.dtype),
+                       'fortran_order': False,
+                       'shape': (self.count,)})
+        prefix = b'\x93NUMPY\x01\x00'
+        n = self.header_size - len(prefix) - 2
+        if len(header) >= n:
+            raise ValueError(f'Record type too long for a {self.header_size} bytes header: {self.dtype}')
+        header = header.ljust(n - 1).encode('latin1') + b'\n'
+        self._file.seek(0)
+        self._file.write(prefix + n.to_bytes(2, 'little') + header)
+
+    def append(self, record):
+        self._buffer[self._nbuffer] = record
+        self._nbuffer += 1
+        if (self._nbuffer == len(self._buffer)) or (time.monotonic() - self._last_flush > self.flush_interval):
+            self.flush()
+
+    def flush(self):
+        n = self._nbuffer
+        if self.count + n > self.capacity:
+            self.capacity += max(self.chunk, n)
+            self._file.truncate(self.header_size + self.capacity * self.dtype.itemsize)
+        self._file.seek(self.header_size + self.count * self.dtype.itemsize)
+        self._file.write(self._buffer[:n].tobytes())
+        self._file.flush()
+        self.count += n
+        self._write_header()
+        self._file.flush()
+        self._nbuffer = 0
+        self._last_flush = time.monotonic()
+
+    def close(self):
+        self.flush()
+        # Drop the preallocated space
+        self._file.truncate(self.header_size + self.count * self.dtype.itemsize)
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+# Period of the 32 bits mcu timer in counts
+rollover = 2**32
+
+
+def unwrap(counts, period=rollover):
+    ''' Remove the rollovers of a sequence of timer readings
+
+    Readings are assumed to be in chronological order and separated by
+    less than one period.
+    '''
+    counts = np.asarray(counts, dtype='f8')
+    return counts + period * np.cumsum(np.diff(counts, prepend=counts[:1]) < 0)
+
+
+class OnlineClockFit(object):
+    """ Incremental robust fit of the mcu clock against the host clock
+
+    Each sample is a mcu timer reading bracketed by the host times of the
+    request and of the answer. The host time of the reading is taken at
+    the middle of the round trip, with an uncertainty given by the round
+    trip time (uniform distribution) added in quadrature to sigma0, and
+    the sample is weighted accordingly. Timer rollovers are removed as
+    they come. Samples whose residual to the current fit exceeds nsigma
+    times a robust estimate of the residual scale (median absolute
+    deviation of the last samples) are rejected. The fit is a weighted
+    linear regression accumulated in constant memory and time per sample.
+
+    Args:
+        frequency (float): frequency of the mcu clock used to convert
+            counts to seconds.
+        sigma0 (float): uncertainty floor on each sample in seconds.
+        nsigma (float): rejection threshold.
+        min_samples (int): number of samples accepted before rejection starts.
+
+    Attributes:
+        slope (float): mcu clock rate relative to the host clock.
+        eslope (float): uncertainty on the slope.
+        n (int): number of samples in the fit.
+        rejected (int): number of rejected samples.
+    """
+    def __init__(self, frequency, sigma0=1e-6, nsigma=5., min_samples=20, window=255):
+        self.frequency = frequency
+        self.sigma0 = sigma0
+        self.nsigma = nsigma
+        self.min_samples = min_samples
+        self._residuals = collections.deque(maxlen=window)
+        self._last = None
+        self._offset = 0
+        self.n = 0
+        self.rejected = 0
+        # Weighted means and centered sums of the accepted samples
+        self._w = self._mx = self._my = 0.
+        self._sxx = self._sxy = self._syy = 0.
+
+    def add(self, start, counts, stop):
+        ''' Add one sample, return False if rejected '''
+        if self._last is not None and counts < self._last:
+            self._offset += rollover
+        self._last = counts
+        if self.n == 0:
+            # Work relative to the first sample to preserve precision
+            self._x0 = (start + stop) * 0.5
+            self._y0 = (counts + self._offset) / self.frequency
+        x = (start + stop) * 0.5 - self._x0
+        y = (counts + self._offset) / self.frequency - self._y0
+        rtt = stop - start
+        sigma = np.sqrt(self.sigma0**2 + rtt**2 / 12)
+        if self.n >= 2:
+            r = abs(y - self.predict(x)) / sigma
+            self._residuals.append(r)
+            if self.n >= self.min_samples and r > self.nsigma * 1.4826 * np.median(self._residuals):
+                self.rejected += 1
+                return False
+        w = 1 / sigma**2
+        self._w += w
+        dx = x - self._mx
+        dy = y - self._my
+        self._mx += dx * w / self._w
+        self._my += dy * w / self._w
+        self._sxx += w * dx * (x - self._mx)
+        self._sxy += w * dx * (y - self._my)
+        self._syy += w * dy * (y - self._my)
+        self.n += 1
+        return True
+
+    def predict(self, x):
+        return self._my + self.slope * (x - self._mx)
+
+    @property
+    def slope(self):
+        return self._sxy / self._sxx if self._sxx > 0 else 1.
+
+    @property
+    def eslope(self):
+        ''' Uncertainty on the slope scaled by the reduced chi2 of the fit '''
+        if self.n < 3 or self._sxx <= 0:
+            return np.inf
+        chi2 = max(self._syy - self._sxy**2 / self._sxx, 0)
+        return np.sqrt(chi2 / (self.n - 2) / self._sxx)
+
+
+def acquire_clock_data(device, duration=600, ntp=0, interval=0.1, output='', housekeeping_interval=10., progress=True,
+                       precision=0, min_duration=60, fit=None):
     ''' Acquire clock synchronisation data from the host and mcu.
-    
+
+    The mcu clock is sampled every interval seconds, each request being
+    bracketed by host timestamps. The temperatures and capacitor bank
+    voltage are sampled every housekeeping_interval seconds only, in a
+    single pipelined exchange. Samples are streamed to files in the
+    output directory as they come (see StreamFile), so that the memory
+    use does not grow with the duration and a crash loses at most one
+    second of data.
+
+    The clock samples are fed to an OnlineClockFit as they come. Its
+    current slope and uncertainty are displayed in the progress bar and
+    the acquisition stops before duration once the uncertainty falls
+    below precision.
+
     Note:
     -----
     Keep in mind that the mcu ~2MHz clock roll over after ~35.79 minutes (2**32/2e6)
@@ -23,66 +223,168 @@ def acquire_clock_data(device, duration=600, ntp=0, interval=0.1):
       If non zero, attempt to perform ntp queries at the provided interval to check the host clock calibration as well
     interval: float
       Approximate interval between 2 mcu queries in seconds
+    output: str
+      Directory receiving the data, see load(). If empty, the data are only returned.
+    housekeeping_interval: float
+      Approximate interval between 2 temperature and voltage readings in seconds
+    progress: bool
+      Display a progress bar
+    precision: float
+      If non zero, stop as soon as the uncertainty on the clock slope is below this value
+    min_duration: float
+      Minimal acquisition duration in seconds before stopping on precision. Residuals
+      are correlated on short time scales, making early uncertainties optimistic
+    fit: OnlineClockFit
+      The fit to update, a new one by default
 
     return:
     -------
     mcu_data: numpy record array
     ntp_data: numpy record array
     '''
-    def mcu_tic():
-        start = time.time()
-        devtime = device.get_time()
-        stop = time.time()
-        mcu_temp = device.read_mcu_temperature()
-        temp = device.read_temperature()
-        ubank = device.read_capacitor_bank_voltage()
-        return start, devtime/device.frequency, stop, mcu_temp, temp, ubank
+    if not output:
+        import tempfile
+        with tempfile.TemporaryDirectory(prefix='clock_calibration') as output:
+            return acquire_clock_data(device, duration, ntp, interval, output, housekeeping_interval, progress,
+                                      precision, min_duration, fit)
+    if fit is None:
+        fit = OnlineClockFit(device.frequency)
+    os.makedirs(output, exist_ok=True)
+    with open(os.path.join(output, 'metadata.json'), 'w') as fid:
+        json.dump({'frequency': device.frequency, 'interval': interval,
+                   'housekeeping_interval': housekeeping_interval, 'ntp': ntp, 'server': server}, fid)
+    adc = [('read_adc', (smartiris.adc_pin_maps[name],)) for name in ('MCU_TEMP', 'TMP36', 'U_BANK')]
+    get_time = device.get_time
+    clock = time.time
 
     def ntp_tic():
-        start = time.time()
-        devtime = device.get_time()
+        import ntplib
+        client = ntplib.NTPClient()
+        start = clock()
         response = client.request(server, version=4)
-        stop = time.time()
+        stop = clock()
         return start, response.tx_time, stop
 
-    mcu_data = []
-    ntp_data = []
-    last_ntp = 0
-    start = time.time()
-    device._start_timer()
-    total_steps = int(duration / interval)
-    with tqdm.tqdm(total=total_steps, desc="Clock calibration", unit="s") as pbar:
-        while(time.time() - start < duration):
-            mcu_data.append(mcu_tic())
-            if (ntp != 0) and ((time - last_ntp) > ntp):
+    if progress:
+        import tqdm
+        pbar = tqdm.tqdm(total=int(duration), desc="Clock calibration", unit="s")
+    with StreamFile(os.path.join(output, 'timing.npy'), timing_dtype) as timing, \
+         StreamFile(os.path.join(output, 'housekeeping.npy'), housekeeping_dtype) as housekeeping, \
+         StreamFile(os.path.join(output, 'ntp.npy'), ntp_dtype) as ntp_data:
+        device._start_timer()
+        start = clock()
+        next_timing = next_housekeeping = next_ntp = start
+        while True:
+            now = clock()
+            if now - start >= duration:
+                break
+            if precision and (now - start >= min_duration) and (fit.eslope < precision):
+                break
+            if now >= next_timing:
+                t1 = clock()
+                counts = get_time()
+                t2 = clock()
+                timing.append((t1, counts, t2))
+                fit.add(t1, counts, t2)
+                next_timing = max(next_timing + interval, now)
+            if now >= next_housekeeping:
+                mcu_temp, temp, ubank = device.call_many(adc)
+                housekeeping.append((clock(), device._mcu_temperature(mcu_temp),
+                                     device._temperature(temp), device._capacitor_bank_voltage(ubank)))
+                next_housekeeping = max(next_housekeeping + housekeeping_interval, now)
+            if ntp and (now >= next_ntp):
                 try:
                     ntp_data.append(ntp_tic())
-                except:
+                except Exception:
                     pass
-            progress = int(((time.time() - start) / duration) * total_steps)
-            pbar.n = min(progress, total_steps)
-            pbar.refresh()
-            time.sleep(interval)
-    if not ntp_data:
-        ntp_data = [[np.nan, np.nan, np.nan]]
-    return (np.rec.fromrecords(mcu_data, names=['start', 'mcu', 'stop', 'mcu_temp', 'temp', 'ubank']),
-            np.rec.fromrecords(ntp_data, names=['start', 'nntp', 'stop']))
+                next_ntp = max(next_ntp + ntp, now)
+            if progress:
+                pbar.n = min(int(now - start), pbar.total)
+                pbar.set_postfix_str(f'slope-1={fit.slope - 1:.3e}±{fit.eslope:.1e}', refresh=False)
+                pbar.refresh()
+            wake = min(next_timing, next_housekeeping, next_ntp if ntp else next_timing)
+            time.sleep(max(0, wake - clock()))
+    if progress:
+        pbar.close()
+    return load(output)
+
+
+def load_stream(dirname):
+    ''' Memory map the files written by acquire_clock_data
+
+    return:
+    -------
+    timing, housekeeping, ntp: numpy arrays of timing_dtype, housekeeping_dtype and ntp_dtype
+    metadata: dict
+    '''
+    with open(os.path.join(dirname, 'metadata.json')) as fid:
+        metadata = json.load(fid)
+    arrays = [np.load(os.path.join(dirname, name), mmap_mode='r') for name in ('timing.npy', 'housekeeping.npy', 'ntp.npy')]
+    return arrays + [metadata]
 
 
 def save(mcu_data, ntp_data, filename='timing.npz'):
     np.savez(filename, ntp_data=ntp_data, mcu_data=mcu_data)
 
 def load(filename='timing.npz'):
-    data = np.load(filename)
-    return data['mcu_data'], data['ntp_data']
+    ''' Load calibration data
 
-def clock_calibration_fit(t1, t2, show=False, axes=None, **keys):
-    x = t1 - t1.min()
+    filename is either a directory written by acquire_clock_data or a
+    file written by save. In the first case the housekeeping data are
+    interpolated at the time of the mcu clock samples.
+    '''
+    if not os.path.isdir(filename):
+        data = np.load(filename)
+        return data['mcu_data'], data['ntp_data']
+    timing, housekeeping, ntp, metadata = load_stream(filename)
+    mcu_data = np.recarray(len(timing), dtype=[('start', 'f8'), ('mcu', 'f8'), ('stop', 'f8'), ('mcu_temp', 'f8'), ('temp', 'f8'), ('ubank', 'f8')])
+    mcu_data['start'] = timing['start']
+    mcu_data['mcu'] = unwrap(timing['counts']) / metadata['frequency']
+    mcu_data['stop'] = timing['stop']
+    for name in ('mcu_temp', 'temp', 'ubank'):
+        if len(housekeeping):
+            mcu_data[name] = np.interp(timing['start'], housekeeping['time'], housekeeping[name])
+        else:
+            mcu_data[name] = np.nan
+    if len(ntp):
+        ntp_data = np.rec.array(np.array(ntp))
+    else:
+        ntp_data = np.rec.fromrecords([[np.nan, np.nan, np.nan]], names=['start', 'nntp', 'stop'])
+    return mcu_data, ntp_data
+
+def clock_calibration_fit(t1, t2, show=False, axes=None, stop=None, sigma0=1e-6, nsigma=5., **keys):
+    ''' Fit the mcu clock t2 against the host clock
+
+    With stop, the host time of each sample is taken in the middle of
+    [t1, stop] and samples are weighted according to the round-trip
+    time, as in OnlineClockFit. Samples deviating by more than nsigma
+    times the median absolute deviation of the residuals are rejected
+    iteratively.
+
+    return:
+    -------
+    slope, eslope (, axes if show)
+    '''
+    if stop is None:
+        x, sigma = t1, np.full(len(t1), sigma0)
+    else:
+        x = (t1 + stop) * 0.5
+        sigma = np.sqrt(sigma0**2 + (stop - t1)**2 / 12)
+    x = x - x.min()
     y = t2 - t2.min()
-    p, cov = np.polyfit(x, y, 1, cov=True)
+    keep = np.ones(len(x), dtype=bool)
+    for iteration in range(10):
+        p, cov = np.polyfit(x[keep], y[keep], 1, w=1/sigma[keep], cov=True)
+        pull = (y - np.polyval(p, x)) / sigma
+        good = np.abs(pull) <= nsigma * 1.4826 * np.median(np.abs(pull[keep]))
+        if (good == keep).all():
+            break
+        keep = good
+    x, y = x[keep], y[keep]
     res = y - np.polyval(p, x)
     eslope = np.sqrt(cov[0,0])
     if show: 
+        import matplotlib.pyplot as plt
         if axes is None:
             axes = plt.gcf().subplots(2,1,sharex=True)
         ax1, ax2 = axes
@@ -100,6 +402,74 @@ def clock_calibration_fit(t1, t2, show=False, axes=None, **keys):
         return p[0], eslope, axes 
     else:
         return p[0], eslope
+def sliding_fit(x, y, window, step=None, sigma=None, temp=None):
+    """ Linear fits of y against x in sliding windows of successive samples
+
+    All windows are computed at once from cumulative sums of the
+    weighted moments, so that the cost does not depend on the window
+    size. To limit the cancellation in the differences of cumulative
+    sums, y is first replaced by its residuals to a global linear fit
+    and the sums are accumulated in extended precision (np.longdouble).
+
+    Args:
+        x (array): host times, in the middle of the requests.
+        y (array): mcu times, rollovers removed.
+        window (int): number of samples per window.
+        step (int): number of samples between the starts of two windows
+            (default window, i.e. no overlap).
+        sigma (array): uncertainty of each sample, unweighted if None.
+        temp (array): temperature at each sample.
+
+    Returns:
+        numpy record array with one entry per window: the weighted mean
+        host time t, the slope and its uncertainty eslope (scaled by the
+        reduced chi2), the number of samples n, and the mean temperature
+        temp and its uncertainty etemp (NaN if temp is None).
+    """
+    x = np.asarray(x, dtype='f8')
+    y = np.asarray(y, dtype='f8')
+    step = step or window
+    n = len(x)
+    w = np.ones(n) if sigma is None else 1 / np.asarray(sigma, dtype='f8')**2
+    u = x - x[0]
+    p = np.polyfit(u, y, 1, w=np.sqrt(w))
+    v = y - np.polyval(p, u)
+    T = np.zeros(n) if temp is None else np.asarray(temp, dtype='f8')
+    moments = np.vstack([w, w * u, w * v, w * u * u, w * u * v, w * v * v, T, T * T])
+    cumsums = np.zeros((len(moments), n + 1), dtype=np.longdouble)
+    np.cumsum(moments, axis=1, dtype=np.longdouble, out=cumsums[:, 1:])
+    starts = np.arange(0, n - window + 1, step)
+    W, Su, Sv, Suu, Suv, Svv, ST, STT = (cumsums[:, starts + window] - cumsums[:, starts]).astype('f8')
+    Sxx = Suu - Su * Su / W
+    Sxy = Suv - Su * Sv / W
+    chi2 = np.maximum(Svv - Sv * Sv / W - Sxy * Sxy / Sxx, 0)
+    result = np.recarray(len(starts), dtype=[('t', 'f8'), ('slope', 'f8'), ('eslope', 'f8'), ('n', 'i8'),
+                                             ('temp', 'f8'), ('etemp', 'f8')])
+    result['t'] = x[0] + Su / W
+    result['slope'] = p[0] + Sxy / Sxx
+    result['eslope'] = np.sqrt(chi2 / (window - 2) / Sxx)
+    result['n'] = window
+    if temp is None:
+        result['temp'] = result['etemp'] = np.nan
+    else:
+        result['temp'] = ST / window
+        result['etemp'] = np.sqrt(np.maximum(STT / window - result['temp']**2, 0) / window)
+    return result
+
+
+def temperature_fit(windows, deg=1):
+    """ Fit the clock slope of sliding_fit windows as a polynomial of the temperature
+
+    Windows are weighted by the uncertainty on their slope.
+
+    Returns:
+        p, cov: polynomial coefficients (highest degree first, as
+        np.polyfit) and their covariance matrix.
+    """
+    good = np.isfinite(windows['temp']) & (windows['eslope'] > 0)
+    return np.polyfit(windows['temp'][good], windows['slope'][good], deg, w=1/windows['eslope'][good], cov=True)
+
+
 def binplot(x, y, binsize=10, ls='None', marker='.', ax=None, **kwargs):
     """
     Plot the average of y data in bins of binsize successive x values.
@@ -108,28 +478,30 @@ def binplot(x, y, binsize=10, ls='None', marker='.', ax=None, **kwargs):
     x (array-like): x-coordinates of the data points
     y (array-like): y-coordinates of the data points
     binsize (int): Number of x values per bin (default: 10)
-    **kwargs: Additional keyword arguments passed to plt.plot
+    ax: matplotlib axes, current axes by default
+    **kwargs: Additional keyword arguments passed to plt.errorbar
+
+    Returns:
+    x_means, y_means and the uncertainty on y_means in each bin
     """
     if ax is None:
+        import matplotlib.pyplot as plt
         ax = plt.gca()
-    # Convert inputs to numpy arrays
-    x = np.array(x)
-    y = np.array(y)
-    
-    # Sort data by x values
-    sort_idx = np.argsort(x)
-    x_sorted = x[sort_idx]
-    y_sorted = y[sort_idx]
-    
-    # Calculate number of bins
-    n = len(x)
-    nbins = n // binsize + (1 if n % binsize else 0)
+    x = np.asarray(x, dtype='f8')
+    y = np.asarray(y, dtype='f8')
+    # Data are usually already sorted by x
+    if (np.diff(x) < 0).any():
+        sort_idx = np.argsort(x)
+        x = x[sort_idx]
+        y = y[sort_idx]
 
-    bins = np.repeat(np.arange(nbins), binsize)[:n]
-    N = np.bincount(bins)
-    x_means = np.bincount(bins, x)/N
-    y_means = np.bincount(bins, y)/N
-    y_rms = np.sqrt(np.bincount(bins, y**2) / N - y_means**2)
+    # Sums of all bins in one pass
+    edges = np.arange(0, len(x), binsize)
+    N = np.diff(np.append(edges, len(x)))
+    Sx, Sy, Syy = np.add.reduceat(np.vstack([x, y, y * y]), edges, axis=1)
+    x_means = Sx / N
+    y_means = Sy / N
+    y_rms = np.sqrt(np.maximum(Syy / N - y_means**2, 0))
     # Create the plot
     ax.errorbar(x_means, y_means, y_rms/np.sqrt(N), ls=ls, marker=marker, **kwargs)
     return x_means, y_means, y_rms/np.sqrt(N)
@@ -138,6 +510,7 @@ def binplot(x, y, binsize=10, ls='None', marker='.', ax=None, **kwargs):
 if __name__ == '__main__':
     import smartiris
     import sys
+    import matplotlib.pyplot as plt
     plt.rc('axes.spines', right=False, top=False)
     plt.rc('text', usetex=True)
 
@@ -152,29 +525,29 @@ if __name__ == '__main__':
     calibrated_frequency = 2e6 * slope1
     plt.tight_layout()
     binsize = 300
-    t = []
-    slope = []
-    eslope = []
-    for i in range(len(mcu_data)//binsize):
-        cutout = slice(i*binsize,(i+1)*binsize)
-        s, e = clock_calibration_fit(mcu_data['start'][cutout], mcu_data['mcu'][cutout])
-        t.append((mcu_data['start'][cutout] - mcu_data['start'][0]).mean())
-        slope.append(s)
-        eslope.append(e)
+    x = (mcu_data['start'] + mcu_data['stop']) * 0.5
+    windows = sliding_fit(x, mcu_data['mcu'], binsize, sigma=np.sqrt(1e-12 + (mcu_data['stop'] - mcu_data['start'])**2 / 12),
+                          temp=mcu_data['temp'])
     f = plt.figure('temp evolution')
     if not f.axes:
         ax1, ax2 = f.subplots(2,1,sharex=True)
     else:
         ax1, ax2 = f.axes
-    t0, temp, etemp = binplot(mcu_data['start'] - mcu_data['start'].min(), mcu_data['temp'], binsize, ax=ax1)
-    plt.xlabel('mcu clock [s]')
-    plt.ylabel('temperature [°C]')
-    
-    ax2.errorbar(t, slope, eslope)
+    ax1.errorbar(windows['t'] - x.min(), windows['temp'], windows['etemp'], ls='None', marker='.')
+    ax1.set_ylabel('temperature [°C]')
+    ax2.errorbar(windows['t'] - x.min(), windows['slope'], windows['eslope'])
+    ax2.set_xlabel('host clock [s]')
+    ax2.set_ylabel('slope')
     plt.tight_layout()
 
     plt.figure('temp')
-    plt.errorbar(temp[:-1], slope, xerr=etemp[:-1], yerr=eslope, ls='None', marker='.')
+    plt.errorbar(windows['temp'], windows['slope'], xerr=windows['etemp'], yerr=windows['eslope'], ls='None', marker='.')
+    p, cov = temperature_fit(windows)
+    v = np.array([windows['temp'].min(), windows['temp'].max()])
+    plt.plot(v, np.polyval(p, v), 'k-', label=rf'${p[0]:.2e}\pm{np.sqrt(cov[0,0]):.1e}$ /°C')
+    plt.legend(frameon=False)
+    plt.xlabel('temperature [°C]')
+    plt.ylabel('slope')
     #plt.savefig('doc/clock_calibration.png', dpi=300)
     
 #axes = calib(mcu_data['start'] - mcu_data['start'].min(), mcu_data['mcu'] - mcu_data['mcu'].min())
@@ -0,0 +1,197 @@
+# Copyright 2024 Marc Betoule
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+''' Share one connection to the controller between processes
+
+The daemon started by "smartiris serve" owns the serial connection and
+listens on a local Unix socket. Clients send one JSON line per call:
+    {"method": "timed_shutter", "args": [], "kwargs": {"duration_sec": 2}}
+and receive one JSON line in return, either {"result": ...} or
+{"error": "ValueError", "message": "..."}.
+
+connect() returns a client when the daemon is running and a direct
+SmartIris connection otherwise.
+'''
+
+import json
+import os
+import signal
+import socket
+
+# Exceptions re-raised with their own type on the client side
+_exceptions = {e.__name__: e for e in (ValueError, OSError, IOError, TimeoutError, RuntimeError, AttributeError, TypeError)}
+
+
+def socket_path(dev=''):
+    """Return the path of the socket serving the device dev.
+
+    Symbolic links (e.g. /dev/serial/by-id/...) are resolved, so that all
+    the paths of a device lead to the same socket.
+    """
+    root = os.environ.get('XDG_RUNTIME_DIR')
+    if not root:
+        import tempfile
+        root = tempfile.gettempdir()
+    key = ''.join(c if c.isalnum() else '_' for c in os.path.basename(os.path.realpath(dev) if dev else 'auto'))
+    return os.path.join(root, f'smartiris-{key}.sock')
+
+
+def _jsonable(o):
+    # numpy scalars and arrays
+    if hasattr(o, 'tolist'):
+        return o.tolist()
+    return str(o)
+
+
+class SmartIrisClient(object):
+    """Forward method calls to a running smartiris daemon.
+
+    Calling any SmartIris method or device function on the client
+    executes it in the daemon and returns the result decoded from JSON
+    (tuples are therefore returned as lists). Attributes other than
+    methods are not available.
+    """
+
+    def __init__(self, path):
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            self._socket.connect(path)
+        except OSError:
+            self._socket.close()
+            raise
+        self._file = self._socket.makefile('rwb')
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        def remote(*args, **kwargs):
+            return self._call(name, args, kwargs)
+        return remote
+
+    def _call(self, method, args, kwargs):
+        request = json.dumps({'method': method, 'args': args, 'kwargs': kwargs}, default=_jsonable)
+        self._file.write(request.encode() + b'\n')
+        self._file.flush()
+        line = self._file.readline()
+        if not line:
+            raise ConnectionError('The smartiris daemon closed the connection')
+        answer = json.loads(line)
+        if 'error' in answer:
+            raise _exceptions.get(answer['error'], RuntimeError)(answer['message'])
+        return answer['result']
+
+    def close(self):
+        self._file.close()
+        self._socket.close()
+
+
+def connect(dev='', **keys):
+    """Return a client of the daemon serving dev if running, else a SmartIris.
+
+    Args:
+        dev (str): path to the device, as given to "smartiris -t dev serve".
+        **keys: Keyword arguments passed to SmartIris for direct connections.
+
+    Raises:
+        RuntimeError: If a daemon is running and keys ask for a reset
+            or for not using the cache, which only apply when connecting.
+    """
+    try:
+        client = SmartIrisClient(socket_path(dev))
+    except OSError:
+        import smartiris
+        return smartiris.SmartIris(dev=dev, **keys)
+    if keys.get('reset') or not keys.get('cache', True):
+        client.close()
+        raise RuntimeError('The device is already connected by a daemon, stop it to reset the device or refresh its cache')
+    return client
+
+
+def _locked(device):
+    """Make every exchange of the device atomic with respect to its lock.
+
+    The lock, a bincoms.worker.DeviceLock, is created by the first call
+    for the device and returned by the next ones.
+    """
+    if getattr(device, '_lock', None) is not None:
+        return device._lock
+    from bincoms.worker import DeviceLock
+    lock = device._lock = DeviceLock()
+    transact, snd, pipeline = device._transact, device.snd, device._pipeline
+    def locked_transact(codec, args):
+        with lock:
+            return transact(codec, args)
+    def locked_snd(data):
+        with lock:
+            return snd(data)
+    def locked_pipeline(requests):
+        with lock:
+            return pipeline(requests)
+    device._transact = locked_transact
+    device.snd = locked_snd
+    device._pipeline = locked_pipeline
+    return lock
+
+
+def serve(device, path):
+    """Serve the SmartIris instance device on the Unix socket path until interrupted."""
+    if os.path.exists(path):
+        try:
+            SmartIrisClient(path).close()
+        except OSError:
+            # Left over by a daemon that did not exit cleanly
+            os.unlink(path)
+        else:
+            raise RuntimeError(f'A daemon is already serving {path}')
+    import socketserver
+
+    class Handler(socketserver.StreamRequestHandler):
+        def handle(self):
+            device, lock = self.server.device, self.server.lock
+            for line in self.rfile:
+                try:
+                    request = json.loads(line)
+                    method = request['method']
+                    if method.startswith('_'):
+                        raise AttributeError(f'{method} is private')
+                    func = getattr(device, method)
+                    if method == 'wait':
+                        # Each exchange is protected, let others use the device meanwhile
+                        result = func(*request['args'], **request['kwargs'])
+                    else:
+                        with lock:
+                            result = func(*request['args'], **request['kwargs'])
+                    answer = {'result': result}
+                except Exception as e:
+                    answer = {'error': type(e).__name__, 'message': str(e)}
+                self.wfile.write(json.dumps(answer, default=_jsonable).encode() + b'\n')
+                self.wfile.flush()
+
+    class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+        daemon_threads = True
+
+    def terminate(signum, frame):
+        raise KeyboardInterrupt
+    signal.signal(signal.SIGTERM, terminate)
+    server = Server(path, Handler)
+    server.device = device
+    server.lock = _locked(device)
+    print(f'Serving on {path}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.unlink(path)
@@ -0,0 +1,589 @@
+# Copyright 2024 Marc Betoule
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+''' Emulation of the smartiris firmware on a pseudo-terminal
+
+The Emulator implements the command set of smartiris.ino (program
+table, 2 MHz timer, sensor records, buttons, ADC, clock calibration in
+EEPROM) and serves it with the bincoms protocol on a pty, so that the
+host software can be exercised without a controller:
+
+    with Emulator(latency=1e-3) as e:
+        d = smartiris.SmartIris(dev=e.path)
+        d.timed_shutter(duration_sec=0.1)
+
+The shutters are modelled as moving 12 ms after the rising edge of the
+corresponding coil pulse. The program execution is evaluated lazily
+from the host clock when the device state is queried.
+
+Running "python -m smartiris.emulator" prints the path of an emulated
+device and serves it until interrupted.
+'''
+
+import math
+import os
+import select
+import struct
+import threading
+import time
+import tty
+
+import bincoms
+
+# Nominal frequency of the timer counting the program timings
+NOMINAL_FREQUENCY = 2e6
+
+MAX_N_EVENTS = 16
+MAX_N_RECORDS = 16
+N_BANKS = 4
+
+# Sensor line (in PORTD) of each shutter, the line is high when closed
+_sensor_lines = {'A': 0b100, 'B': 0b1000}
+# Coil pins (in PORTB) and resulting shutter movements
+_coils = {0b10: ('A', 'open'), 0b1: ('A', 'close'), 0b1000: ('B', 'open'), 0b100: ('B', 'close')}
+# Pin reported in the sensor records
+_record_pins = {'A': 0b1, 'B': 0b10}
+# Button lines (in PORTD), active low
+_buttons = {'A': 0b100000, 'B': 0b1000000}
+
+
+class Emulator(object):
+    """ Emulate a smartiris controller on a pseudo-terminal
+
+    Args:
+        frequency_error (float): relative error of the emulated MCU clock,
+            so that the timer runs at NOMINAL_FREQUENCY * (1 + frequency_error).
+        latency (float): delay in seconds added before each answer to
+            mimic the USB round trip.
+        baudrate (int): if not 0, the transmission time of the requests
+            and answers at this rate (10 bits per byte) is added to the
+            latency.
+        actuation_delay (float): time in seconds for a shutter to move
+            after the start of the coil pulse.
+        fingerprint (bool): answer the command table fingerprint
+            request. Set to False to emulate older firmware.
+        streaming (bool): provide set_event_stream and the commands
+            added after it (program streaming, repeat mode, program
+            banks, program_state). Set to False to emulate firmware
+            without them.
+        bank_model (tuple): if given, (drop, tau) of an emulated
+            capacitor bank read on the U_BANK channel: each coil pulse
+            drains drop volts per second of pulse and coil, recovered
+            exponentially with the time constant tau in seconds.
+
+    Attributes:
+        path (str): device to open on the host side.
+        nframes (int): number of requests processed.
+        adc (dict): raw values returned by read_adc for each channel.
+        min_bank_voltage (float): lowest voltage reached by the emulated
+            capacitor bank, right after a pulse.
+    """
+    def __init__(self, frequency_error=0., latency=0., baudrate=0, actuation_delay=12e-3, fingerprint=True, streaming=True, bank_model=None):
+        self.frequency = NOMINAL_FREQUENCY * (1 + frequency_error)
+        self.latency = latency
+        self.baudrate = baudrate
+        self.actuation_delay = actuation_delay
+        self.fingerprint = fingerprint
+        self.adc = {0: 698, 1: 971, 8: 173}
+        self.bank_model = bank_model
+        self.signature_row = {2: 0, 3: 128}
+        self.eeprom = b'\xff' * 4
+        self.nframes = 0
+        self.commands = [
+            ('command_count', '', 'B', self.command_count),
+            ('get_command_names', 'BB', 's', self.get_command_names),
+            ('program_pulse', 'BBI', 'I', self.program_pulse),
+            ('start_program', '', '', self.start_program),
+            ('stop_program', '', '', self.stop_program),
+            ('get_program', 'BB', 'IB', self.get_program),
+            ('raw_status', '', 'BBBBB', self.raw_status),
+            ('_set_interrupt_mask', 'B', '', self.set_interrupt_mask),
+            ('_start_timer', '', '', self.start_timer),
+            ('get_time', '', 'I', self.get_time),
+            ('get_clock_calibration', '', 'f', self.get_clock_calibration),
+            ('set_clock_calibration', 'f', '', self.set_clock_calibration),
+            ('read_adc', 'B', 'H', self.read_adc),
+            ('read_signature_row', 'H', 'B', self.read_signature_row),
+            ('set_event_stream', 'B', '', self.set_event_stream),
+            ('_start_stream', 'B', '', self.start_stream),
+            ('_extend_stream', 'B', 'B', self.extend_stream),
+            ('_start_repeat', 'HI', '', self.start_repeat),
+            ('_store_bank', 'B', '', self.store_bank),
+            ('_start_program_bank', 'B', '', self.start_program_bank),
+            ('program_state', '', 'BH', self.program_state),
+        ]
+        if not streaming:
+            # Firmware predating the event and program streaming and
+            # the repeat mode and program banks
+            del self.commands[14:]
+        self._lock = threading.Lock()
+        self.reset()
+        self._master, self._slave = os.openpty()
+        tty.setraw(self._slave)
+        self.path = os.ttyname(self._slave)
+        self._stop = False
+        self._thread = threading.Thread(target=self._serve, daemon=True)
+        self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        ''' Stop serving and close the pseudo-terminal '''
+        if self._stop:
+            return
+        self._stop = True
+        self._thread.join()
+        os.close(self._master)
+        os.close(self._slave)
+
+    def reset(self):
+        ''' Emulate a power cycle (the EEPROM content is kept) '''
+        with self._lock:
+            self.program = [[0, 0] for i in range(MAX_N_EVENTS)]
+            self.banks = [[] for i in range(N_BANKS)]
+            self.n_events = 0
+            self.active_program = self.program
+            self.active_nevent = 0
+            self.event = 0
+            self.start = None
+            # Timer value since it was stopped, None while running
+            self.stopped = 0
+            self.portb = 0
+            # Pull-ups, shutters closed
+            self.pind = 0b01111100
+            self.records = [[0, 0] for i in range(MAX_N_RECORDS)]
+            self.n_record = 0
+            self.interrupt_mask = 0b1100000
+            self.recording = False
+            # Pending shutter movements: (count, shutter, movement)
+            self.movements = []
+            self.streaming = False
+            # Streaming program state, see start_stream
+            self.streaming_program = False
+            self.committed = self.consumed = 0
+            self.stream_last = 0
+            # Repeat mode state, see start_repeat
+            self.cycles_left = 0
+            self.period = 0
+            # Number of programs started and event frames not sent yet
+            self.run = 0
+            self.events = bytearray()
+            # Coil pulses: start of the pulses in progress and (host
+            # time, energy) of the completed ones
+            self.coils_on = {}
+            self.discharges = []
+            self.min_bank_voltage = self._bank_voltage(0.)
+
+    def press(self, button='A'):
+        ''' Emulate a push on the button of the given port '''
+        with self._lock:
+            if not (self.interrupt_mask & _buttons[button]):
+                return
+            self._update()
+            closed = self.pind & _sensor_lines[button]
+            pins = {('A', True): 0b10, ('A', False): 0b1, ('B', True): 0b1000, ('B', False): 0b100}
+            pin = pins[(button, bool(closed))]
+            self._stop_program()
+            self.event = 1
+            self.active_program = [[20000, pin], [0x15f90, pin]]
+            self.active_nevent = 2
+            self._start_program()
+
+    def inject(self, data):
+        ''' Send raw bytes to the host, as a noisy link would '''
+        self._write(data)
+
+    # Timer and program execution
+    def counts(self):
+        ''' Current value of the 32 bit timer '''
+        if self.stopped is not None:
+            return self.stopped & 0xFFFFFFFF
+        return int((time.perf_counter() - self.start) * self.frequency) & 0xFFFFFFFF
+
+    def _update(self):
+        # Play the program and shutter movements up to now, in order
+        if self.start is None:
+            return
+        now = int((time.perf_counter() - self.start) * self.frequency)
+        while True:
+            next_event = self._next_event()
+            next_move = min((m[0] for m in self.movements), default=None)
+            if (next_move is not None) and (next_move <= now) and ((next_event is None) or (next_move <= next_event)):
+                self._move(next_move)
+            elif (next_event is not None) and (next_event <= now):
+                t, pin = next_event, self.active_program[self.event - 1][1]
+                self._toggle(pin, t)
+                if self.streaming_program:
+                    self.consumed = (self.consumed + 1) & 0xFF
+                    self.stream_last = t
+                    if self.consumed == self.committed:
+                        self._event(1, t, 0)
+                        self._stop_program(t)
+                    else:
+                        self.event = (self.consumed % MAX_N_EVENTS) + 1
+                elif self.cycles_left:
+                    # Shift the executed event to the next cycle
+                    self.active_program[self.event - 1][0] += self.period
+                    if self.event == self.active_nevent:
+                        self.cycles_left -= 1
+                        self.event = 1
+                    else:
+                        self.event += 1
+                elif self.event == self.active_nevent:
+                    self._event(1, t, 0)
+                    self._stop_program(t)
+                else:
+                    self.event += 1
+            else:
+                break
+
+    def _toggle(self, pin, t):
+        rising = pin & ~self.portb
+        self._end_pulses(pin & self.portb, t)
+        self.coils_on.update((coil, t) for coil in _coils if rising & coil)
+        self.portb ^= pin
+        for coil, (shutter, movement) in _coils.items():
+            if rising & coil:
+                self.movements.append((t + int(self.actuation_delay * self.frequency), shutter, movement))
+
+    def _move(self, t):
+        pending = []
+        for m in self.movements:
+            if m[0] > t:
+                pending.append(m)
+                continue
+            shutter, movement = m[1:]
+            line = _sensor_lines[shutter]
+            before = self.pind & line
+            if movement == 'open':
+                self.pind &= ~line
+            else:
+                self.pind |= line
+            if ((self.pind & line) != before) and self.recording:
+                self.records[self.n_record] = [t & 0xFFFFFFFF, _record_pins[shutter]]
+                self._event(0, t, _record_pins[shutter])
+                if self.n_record < MAX_N_RECORDS - 1:
+                    self.n_record += 1
+        self.movements = pending
+
+    def _end_pulses(self, mask, t):
+        # Account for the discharge of the bank by the coil pulses ending at t
+        if self.bank_model is None:
+            return
+        host_time = self.start + t / self.frequency
+        for coil in _coils:
+            if (mask & coil) and (coil in self.coils_on):
+                self.discharges.append((host_time, (t - self.coils_on.pop(coil)) / self.frequency))
+        self.min_bank_voltage = min(self.min_bank_voltage, self._bank_voltage(host_time))
+
+    def _bank_voltage(self, host_time):
+        full = self.adc[1] * 1.1 / 1024 * 4.6
+        if self.bank_model is None:
+            return full
+        drop, tau = self.bank_model
+        self.discharges = [d for d in self.discharges if host_time - d[0] < 50 * tau]
+        return full - sum(drop * energy * math.exp(-(host_time - end) / tau) for end, energy in self.discharges if end <= host_time)
+
+    def _restart_timer(self):
+        # Shutters still moving keep their schedule in the new time base
+        now = time.perf_counter()
+        if self.start is not None:
+            shift = int((now - self.start) * self.frequency)
+            self.movements = [(t - shift, shutter, movement) for t, shutter, movement in self.movements]
+            self.coils_on = {coil: t - shift for coil, t in self.coils_on.items()}
+        self.start = now
+        self.stopped = None
+
+    def _event(self, kind, t, pin):
+        # Queue an unsolicited event frame if streaming is enabled
+        if self.streaming:
+            self.events += b'e' + bytes([kind, 7]) + struct.pack('<IBH', t & 0xFFFFFFFF, pin, self.run)
+
+    def _next_change(self):
+        # Host time (perf_counter) of the next program event or shutter movement
+        if self.start is None:
+            return None
+        counts = [m[0] for m in self.movements]
+        if self.event:
+            counts.append(self._next_event())
+        return self.start + min(counts) / self.frequency if counts else None
+
+    def _next_event(self):
+        # Timer count of the next program event, None if not running
+        if not self.event:
+            return None
+        t = self.active_program[self.event - 1][0]
+        if self.streaming_program:
+            # Timings are given modulo 2**32 in streaming mode
+            t = self.stream_last + ((t - self.stream_last) & 0xFFFFFFFF)
+        return t
+
+    def _start_program(self):
+        self.run = (self.run + 1) & 0xFFFF
+        self._restart_timer()
+        self.n_record = 0
+        self.recording = True
+
+    def _stop_program(self, t=None):
+        # As the firmware, the timer stops with the program
+        if self.stopped is None:
+            self.stopped = int((time.perf_counter() - self.start) * self.frequency) if t is None else t
+        self.event = 0
+        self.streaming_program = False
+        self.cycles_left = 0
+        if self.start is not None:
+            self._end_pulses(self.portb, self.stopped)
+        self.portb = 0
+        self.recording = False
+
+    # Device functions
+    def command_count(self):
+        return struct.pack('B', len(self.commands))
+
+    def get_command_names(self, nfunc, par):
+        if nfunc >= len(self.commands):
+            return 'UNDEFINED_FUNCTION_ERROR'
+        if (par == 3) and self.fingerprint:
+            return bincoms.table_fingerprint([c[:3] for c in self.commands]).encode()
+        if par > 2:
+            return 'VALUE_ERROR'
+        return self.commands[nfunc][par].encode()
+
+    def program_pulse(self, pin, n_events, duration):
+        # As the firmware, the slot number is stored before being checked
+        self.n_events = n_events
+        if (n_events >= MAX_N_EVENTS) or (pin & 0b11000000):
+            return 'VALUE_ERROR', struct.pack('<I', duration)
+        self.program[n_events] = [duration, pin]
+        self.n_events += 1
+        return struct.pack('<I', duration)
+
+    def start_program(self):
+        if (self.n_events == 0) or (self.n_events > MAX_N_EVENTS):
+            return 'VALUE_ERROR'
+        self._update()
+        self._stop_program()
+        self.event = 1
+        self.active_program = self.program
+        self.active_nevent = self.n_events
+        self._start_program()
+        return b''
+
+    def stop_program(self):
+        self._update()
+        self._stop_program()
+        return b''
+
+    def get_program(self, i, program_num):
+        self._update()
+        if program_num >= 2 + N_BANKS:
+            return 'VALUE_ERROR'
+        slots = self.records if program_num == 1 else self.banks[program_num - 2] if program_num else self.program
+        duration, pin = slots[i] if i < len(slots) else (0, 0)
+        return struct.pack('<IB', duration, pin)
+
+    def raw_status(self):
+        self._update()
+        return struct.pack('5B', self.portb, self.pind, self.event, self.active_nevent, self.n_record)
+
+    def program_state(self):
+        return struct.pack('<BH', self.n_events, self.run)
+
+    def set_interrupt_mask(self, mask):
+        self.interrupt_mask = mask
+        return b''
+
+    def start_timer(self):
+        self._update()
+        self._stop_program()
+        self._restart_timer()
+        return b''
+
+    def set_event_stream(self, enable):
+        self.streaming = bool(enable)
+        self.events.clear()
+        return b''
+
+    def start_stream(self, n):
+        if (n == 0) or (n > MAX_N_EVENTS):
+            return 'VALUE_ERROR'
+        self._update()
+        self._stop_program()
+        self.event = 1
+        self.active_program = self.program
+        self.active_nevent = MAX_N_EVENTS
+        self.consumed = 0
+        self.committed = n
+        self.stream_last = 0
+        self.streaming_program = True
+        self._start_program()
+        return b''
+
+    def extend_stream(self, n):
+        self._update()
+        if (not self.streaming_program) or ((self.committed + n - self.consumed) & 0xFF) > MAX_N_EVENTS:
+            return 'VALUE_ERROR'
+        self.committed = (self.committed + n) & 0xFF
+        return struct.pack('B', self.event)
+
+    def start_repeat(self, n, period):
+        if (self.n_events == 0) or (self.n_events > MAX_N_EVENTS) or (n == 0) or (period <= self.program[self.n_events - 1][0]):
+            return 'VALUE_ERROR'
+        self._update()
+        self._stop_program()
+        # The timer is not reset between cycles, the copy is shifted by
+        # one period as the events are executed
+        self.active_program = [list(e) for e in self.program[:self.n_events]]
+        self.period = period
+        self.cycles_left = n - 1
+        self.event = 1
+        self.active_nevent = self.n_events
+        self._start_program()
+        return b''
+
+    def store_bank(self, i):
+        if (i >= N_BANKS) or (self.n_events == 0) or (self.n_events > MAX_N_EVENTS):
+            return 'VALUE_ERROR'
+        self.banks[i] = [list(e) for e in self.program[:self.n_events]]
+        return b''
+
+    def start_program_bank(self, i):
+        if (i >= N_BANKS) or (not self.banks[i]):
+            return 'VALUE_ERROR'
+        self._update()
+        self._stop_program()
+        self.event = 1
+        self.active_program = self.banks[i]
+        self.active_nevent = len(self.banks[i])
+        self._start_program()
+        return b''
+
+    def get_time(self):
+        self._update()
+        return struct.pack('<I', self.counts())
+
+    def get_clock_calibration(self):
+        return self.eeprom
+
+    def set_clock_calibration(self, calibration):
+        self.eeprom = struct.pack('<f', calibration)
+        return b''
+
+    def read_adc(self, channel):
+        if ((channel & 0x0F) == 1) and (self.bank_model is not None):
+            self._update()
+            voltage = self._bank_voltage(time.perf_counter())
+            return struct.pack('<H', max(0, round(voltage / 4.6 * 1024 / 1.1)))
+        return struct.pack('<H', self.adc.get(channel & 0x0F, 0))
+
+    def read_signature_row(self, address):
+        return struct.pack('B', self.signature_row.get(address, 0xFF))
+
+    # Communication
+    def _serve(self):
+        buffer = bytearray()
+        while not self._stop:
+            timeout = 0.05
+            with self._lock:
+                if self.streaming:
+                    # Wake up in time to push the next events
+                    self._update()
+                    next_change = self._next_change()
+                    if next_change is not None:
+                        timeout = min(timeout, max(next_change - time.perf_counter(), 0))
+                    if self.events:
+                        self._write(bytes(self.events))
+                        self.events.clear()
+            if not select.select([self._master], [], [], timeout)[0]:
+                continue
+            try:
+                data = os.read(self._master, 4096)
+            except OSError:
+                # No client has the device open
+                time.sleep(0.01)
+                continue
+            buffer += data
+            answer = bytearray()
+            while len(buffer) >= 3:
+                if (buffer[0] != ord('b')) or (buffer[1] != 0):
+                    # As the firmware, flush and complain
+                    buffer.clear()
+                    answer += self._frame('COMMUNICATION_ERROR')
+                    break
+                n = buffer[2]
+                if len(buffer) < 3 + n:
+                    break
+                message = bytes(buffer[3:3 + n])
+                del buffer[:3 + n]
+                self.nframes += 1
+                answer += self._process(message)
+            if answer:
+                delay = self.latency
+                if self.baudrate:
+                    delay += (len(data) + len(answer)) * 10 / self.baudrate
+                if delay:
+                    time.sleep(delay)
+                # As the firmware, events are sent when no request is waiting
+                with self._lock:
+                    answer += self.events
+                    self.events.clear()
+                self._write(answer)
+
+    def _write(self, data):
+        try:
+            os.write(self._master, data)
+        except OSError:
+            pass
+
+    def _process(self, message):
+        if not message:
+            return self._frame(b'')
+        f = message[0]
+        if f >= len(self.commands):
+            return self._frame('UNDEFINED_FUNCTION_ERROR')
+        name, arg_format, answer_format, func = self.commands[f]
+        if len(message) - 1 != struct.calcsize('<' + arg_format):
+            return self._frame('BYTE_COUNT_ERROR')
+        with self._lock:
+            answer = func(*struct.unpack('<' + arg_format, message[1:]))
+        if isinstance(answer, tuple):
+            return self._frame(answer[1], answer[0])
+        return self._frame(answer)
+
+    @staticmethod
+    def _frame(answer, status='STATUS_OK'):
+        # answer is either a payload or the name of an error status
+        if isinstance(answer, str):
+            answer, status = b'', answer
+        return bytes([ord('b'), bincoms.status_codes.index(status), len(answer)]) + answer
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Serve an emulated smartiris controller on a pseudo-terminal')
+    parser.add_argument('-l', '--latency', type=float, default=1e-3, help='Answer latency in seconds')
+    parser.add_argument('-b', '--baudrate', type=int, default=115200, help='Emulated link speed (0 for infinite)')
+    parser.add_argument('-f', '--frequency-error', type=float, default=0., help='Relative error of the emulated MCU clock')
+    args = parser.parse_args()
+    with Emulator(args.frequency_error, args.latency, args.baudrate) as e:
+        print(f'Emulated controller on {e.path}, try: smartiris -t {e.path} status')
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            pass
@@ -0,0 +1,288 @@
+# Copyright 2024 Marc Betoule
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+''' Continuous streaming of the sensor events
+
+With set_event_stream enabled, the firmware pushes each sensor edge and
+each program end as an unsolicited frame instead of only keeping the 16
+first edges of a program in its record. An EventStream collects them in
+an EventBuffer, a ring buffer backed by a numpy structured array, from a
+background thread that reads the device while it is idle. Frames
+arriving in the middle of the answers to other requests are
+demultiplexed by bincoms and end up in the same buffer.
+
+Consumers either register a callback, invoked in the reader thread for
+each event, or take a Subscription and fetch the new events as an array
+when they need them:
+
+    stream = d.stream_events()
+    new = stream.subscribe()
+    for i in range(1000):
+        d.timed_shutter(duration_sec=0.1)
+        d.wait()
+    events = new.get()
+    stream.stop()
+
+With firmware predating event streaming, the thread polls the status
+and the record instead, which costs round trips and is limited to the
+16 first edges of each program.
+'''
+
+import select
+import threading
+import time
+import numpy as np
+
+from smartiris.daemon import _locked
+
+# Kinds of events (code of the event frame)
+SENSOR_EVENT = 0
+PROGRAM_END_EVENT = 1
+EVENTS_LOST = 2
+
+# time: timer counts since the program start
+# pin: sensor line (1 for sensorA, 2 for sensorB, 0 for a program end)
+# kind: SENSOR_EVENT or PROGRAM_END_EVENT
+# run: number of programs started by the device, modulo 2**16
+# host: host time (time.time) of the event, see SmartIris.mcu_to_host, NaN if unknown
+event_dtype = [('time', '<u4'), ('pin', 'u1'), ('kind', 'u1'), ('run', '<u2'), ('host', '<f8')]
+
+
+class EventBuffer(object):
+    """ Ring buffer keeping the last capacity events
+
+    Events are numbered from 0 in arrival order. count is the number of
+    events appended so far, the oldest ones being overwritten once
+    capacity is reached.
+    """
+    def __init__(self, capacity=65536):
+        self.capacity = capacity
+        self.data = np.zeros(capacity, dtype=event_dtype)
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return min(self.count, self.capacity)
+
+    def append(self, event):
+        with self._lock:
+            self.data[self.count % self.capacity] = event
+            self.count += 1
+
+    def since(self, index):
+        ''' Return the events numbered index and above still in the buffer
+
+        Returns:
+            events (numpy array of event_dtype), next index, number of
+            events overwritten before being read.
+        '''
+        with self._lock:
+            count = self.count
+            start = max(index, count - self.capacity)
+            events = self.data[np.arange(start, count) % self.capacity]
+        return events, count, start - index
+
+    def latest(self, n=None):
+        ''' Return the n last events (all those in the buffer by default) '''
+        n = len(self) if n is None else min(n, len(self))
+        return self.since(self.count - n)[0]
+
+
+class Subscription(object):
+    """ Cursor on an EventBuffer returning the events not read yet
+
+    Attributes:
+        lost (int): number of events overwritten before being read.
+    """
+    def __init__(self, buffer):
+        self.buffer = buffer
+        self.index = buffer.count
+        self.lost = 0
+
+    def get(self):
+        ''' Return the events arrived since the previous call '''
+        events, self.index, lost = self.buffer.since(self.index)
+        self.lost += lost
+        return events
+
+
+class EventStream(object):
+    """ Collect the events of a SmartIris in a ring buffer
+
+    Usually obtained with SmartIris.stream_events. The device exchanges
+    are made thread-safe (see daemon._locked).
+
+    Args:
+        device (SmartIris): the controller.
+        capacity (int): number of events kept.
+        poll_interval (float): period of the status polling with firmware
+            that cannot stream events.
+        thread (bool): enable the streaming and start the reader thread.
+            The asyncio version sets it to False, its event loop reading
+            the device continuously.
+
+    Attributes:
+        buffer (EventBuffer): the events received.
+        lost (int): number of events dropped by the firmware because its
+            queue was full.
+        streaming (bool): False if the firmware does not stream events
+            and the record is polled instead.
+        error (Exception): the error that stopped the reader thread
+            (device unplugged or closed), None while it runs.
+    """
+    def __init__(self, device, capacity=65536, poll_interval=0.05, thread=True):
+        self.device = device
+        self.buffer = EventBuffer(capacity)
+        self.poll_interval = poll_interval
+        self.lost = 0
+        self.error = None
+        self._callbacks = []
+        self.streaming = 'set_event_stream' in device._command_names
+        self._thread = None
+        if not thread:
+            return
+        self._lock = _locked(device)
+        self._stop = threading.Event()
+        with self._lock:
+            if self.streaming:
+                device.on_event = self._on_event
+                device.set_event_stream(1)
+                target = self._read
+            else:
+                self._epoch = device.program_epoch
+                self._seen = device.status()['events_recorded']
+                self._busy = False
+                self._run = 0
+                self._started = None
+                target = self._poll
+        self._thread = threading.Thread(target=target, name='smartiris-events', daemon=True)
+        self._thread.start()
+
+    def subscribe(self, callback=None):
+        ''' Register a consumer of the events
+
+        Args:
+            callback: if given, called as callback(event) for each new
+                event (a record of event_dtype) from the reader thread.
+                It must return quickly.
+
+        Returns:
+            The callback, or a new Subscription if callback is None.
+        '''
+        if callback is None:
+            return Subscription(self.buffer)
+        self._callbacks.append(callback)
+        return callback
+
+    def unsubscribe(self, callback):
+        self._callbacks.remove(callback)
+
+    def _push(self, counts, pin, kind, run):
+        try:
+            host = self.device.mcu_to_host(counts)
+        except ValueError:
+            host = np.nan
+        event = np.array((counts, pin, kind, run, host), dtype=event_dtype)
+        self.buffer.append(event)
+        for callback in self._callbacks:
+            callback(event)
+
+    def _on_event(self, code, payload):
+        if code == EVENTS_LOST:
+            self.lost += payload[0]
+        elif len(payload) == 7:
+            counts, pin, run = int.from_bytes(payload[:4], 'little'), payload[4], int.from_bytes(payload[5:], 'little')
+            self._push(counts, pin, code, run)
+
+    def _read(self):
+        device = self.device
+        fd = device.com.fd
+        stalled = False
+        while not self._stop.is_set():
+            try:
+                # Events may already sit in the read buffer, received along
+                # with the answer to another request
+                if (stalled or device._tail == device._head) and not select.select([fd], [], [], 0.1)[0]:
+                    continue
+                with self._lock:
+                    if not device.com.is_open:
+                        raise IOError('The device was closed')
+                    n = device.poll_events()
+                    # Incomplete frame, wait for the rest
+                    stalled = (not n) and (device._tail != device._head)
+            except (IOError, ValueError, TypeError) as e:
+                # The device is gone (TypeError if closed by another
+                # thread while reading), the stream ends here
+                self.error = e
+                return
+            if not (n or stalled):
+                # The data was an answer read by another thread, let it go on
+                time.sleep(1e-3)
+
+    def _poll(self):
+        # Fallback for firmware without event streaming
+        device = self.device
+        while not self._stop.wait(self.poll_interval):
+            try:
+                with self._lock:
+                    status = device.status()
+                    nrecords = status['events_recorded']
+                    ended = None
+                    if (device.program_epoch is not self._epoch) or (nrecords < self._seen):
+                        # A new program was started, the records of the
+                        # previous one not read yet are lost
+                        if self._busy:
+                            ended = self._end(self._started)
+                        self._epoch = device.program_epoch
+                        self._seen = 0
+                        self._run = (self._run + 1) & 0xFFFF
+                        self._busy = True
+                    records = device.call_many([('get_program', (i, 1)) for i in range(self._seen, nrecords)])
+                    self._started = started = device._started
+            except (IOError, ValueError):
+                continue
+            if ended is not None:
+                self._push(ended, 0, PROGRAM_END_EVENT, (self._run - 1) & 0xFFFF)
+            for counts, pin in records:
+                self._push(counts, pin, SENSOR_EVENT, self._run)
+            self._seen = nrecords
+            if self._busy and not status['busy']:
+                self._busy = False
+                self._push(self._end(started), 0, PROGRAM_END_EVENT, self._run)
+
+    @staticmethod
+    def _end(started):
+        # Timing of the last event of the program (unknown if 0)
+        return started[1][-1][0] if started is not None else 0
+
+    def stop(self):
+        ''' Stop collecting events and disable the streaming on the device '''
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+        if self.streaming:
+            with self._lock:
+                if self.error is None:
+                    self.device.set_event_stream(0)
+                self.device.on_event = None
+        if self.device.event_stream is self:
+            self.device.event_stream = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
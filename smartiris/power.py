@@ -0,0 +1,368 @@
+# Copyright 2024 Marc Betoule
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+''' Pace the actuations on the charge of the capacitor bank
+
+The shutter coils are powered by a capacitor bank (U_BANK) recharged
+from the USB supply. Each pulse drains it in proportion to its energy,
+counted here as the pulse width times the number of coils energized,
+and the bank then recovers exponentially. Pulses too long or too close
+together discharge it deeply enough to reset the device.
+
+RechargeModel learns this behaviour from the voltage readings:
+
+    V(t) = V_full - drop * sum_i E_i exp(-(t - t_i) / tau)
+
+summed over the pulses of energy E_i ended at t_i before t. For a given
+time constant the deficit is linear in drop, which is fitted by
+accumulating sums over the readings. This is done for a grid of time
+constants and the one leaving the smallest residuals is retained.
+
+ActuationScheduler uses the model to delay each program start just
+enough for the bank to stay above a threshold during the whole program,
+and predicts the maximum rate at which a program can be repeated. Until
+enough readings have been fitted, the model relies on a rough prior:
+programs are then delayed as it predicts, but never refused.
+
+Example:
+    d = SmartIris()
+    scheduler = d.schedule_actuations(threshold=3.8)
+    for i in range(100):
+        d.open_shutter()  # delayed as needed
+        d.close_shutter()
+    print(scheduler.max_rate(d.read_program()))
+'''
+
+import collections
+import math
+import time
+import numpy as np
+
+# PORTB bits driving the coils (opening and closing of ports A and B)
+coil_mask = 0b1111
+
+
+def program_pulses(events, frequency):
+    ''' Return the coil pulses of a program
+
+    Args:
+        events: sequence of (timing_counts, pin_mask) pairs.
+        frequency (float): timer frequency in Hz.
+
+    Returns:
+        list of (end, energy) pairs sorted by end: the end of each pulse
+        in seconds from the program start and its energy in coil.seconds.
+    '''
+    state = 0
+    on = {}
+    pulses = []
+    for timing, pin in events:
+        t = timing / frequency
+        coils = pin & coil_mask
+        for coil in (1, 2, 4, 8):
+            if coils & coil:
+                if state & coil:
+                    pulses.append((t, t - on.pop(coil)))
+                else:
+                    on[coil] = t
+        state ^= coils
+    if on:
+        # The firmware clears the port at the end of the program
+        end = events[-1][0] / frequency
+        pulses += [(end, end - start) for start in on.values()]
+    return sorted(pulses)
+
+
+def program_deficits(pulses, drop, tau):
+    ''' Return the deficit caused by a program right after each of its pulses
+
+    Args:
+        pulses: list of (end, energy) as returned by program_pulses.
+        drop (float): voltage drop per unit of energy.
+        tau (float): recharge time constant in seconds.
+    '''
+    deficit = 0.
+    last = 0.
+    deficits = []
+    for end, energy in pulses:
+        deficit = deficit * math.exp(-(end - last) / tau) + drop * energy
+        last = end
+        deficits.append(deficit)
+    return deficits
+
+
+class RechargeModel(object):
+    """ Online model of the capacitor bank voltage
+
+    Args:
+        drop (float): prior voltage drop per unit of pulse energy
+            (V / (coil.s)), used until min_samples readings are fitted.
+        tau (float): prior recharge time constant in seconds.
+        taus: grid of time constants tried by the fit.
+        min_samples (int): number of readings taken while the bank
+            recharges needed before trusting the fit.
+
+    Attributes:
+        full (float): resting voltage of the bank, None before the first reading.
+        n (int): number of readings taken while the bank was recharging.
+    """
+    def __init__(self, drop=30., tau=1., taus=None, min_samples=5):
+        self.taus = np.geomspace(0.02, 50., 35) if taus is None else np.asarray(taus, dtype=float)
+        self.drop = drop
+        self._prior = int(np.argmin(abs(np.log(self.taus / tau))))
+        self.min_samples = min_samples
+        self.full = None
+        self.n = 0
+        # Energy of the past pulses decayed to time _t, for each tau
+        self._t = None
+        self._s = np.zeros(len(self.taus))
+        # Pulses (host time of the end, energy) not ended yet at _t
+        self._pending = collections.deque()
+        self._sxy = np.zeros(len(self.taus))
+        self._sxx = np.zeros(len(self.taus))
+        self._syy = np.zeros(len(self.taus))
+
+    def add_pulses(self, start, pulses):
+        ''' Account for the pulses of a program started at host time start (time.time) '''
+        # The start of a program aborts the previous one
+        while self._pending and self._pending[-1][0] > start:
+            self._pending.pop()
+        self._pending.extend((start + end, energy) for end, energy in pulses)
+
+    def _decay(self, t):
+        if t > self._t:
+            self._s *= np.exp(-(t - self._t) / self.taus)
+            self._t = t
+
+    def advance(self, t):
+        ''' Bring the model state to host time t '''
+        if self._t is None:
+            self._t = t
+        while self._pending and self._pending[0][0] <= t:
+            end, energy = self._pending.popleft()
+            self._decay(end)
+            self._s += energy * np.exp(-(self._t - end) / self.taus)
+        self._decay(t)
+
+    @property
+    def trusted(self):
+        ''' True once enough readings were fitted to rely on the fit rather than the prior '''
+        return self.n >= self.min_samples
+
+    def parameters(self):
+        ''' Return the current estimate of drop and tau '''
+        drop, i = self._best()
+        return drop, self.taus[i]
+
+    def _best(self):
+        # Voltage drop and index of the time constant
+        if not self.trusted:
+            return self.drop, self._prior
+        fitted = self._sxx > 0
+        sse = np.where(fitted, self._syy - self._sxy**2 / np.where(fitted, self._sxx, 1), np.inf)
+        i = int(np.argmin(sse))
+        return max(self._sxy[i] / self._sxx[i], 0.), i
+
+    def deficit(self, t):
+        ''' Predicted voltage deficit of the bank at host time t, from the pulses ended before '''
+        self.advance(t)
+        drop, i = self._best()
+        return drop * self._s[i]
+
+    def observe(self, t, voltage):
+        ''' Fit a reading of the bank voltage taken at host time t '''
+        self.advance(t)
+        if self.full is None:
+            # Assume the bank is charged at the first reading
+            self.full = voltage
+        recharging = self.deficit(t) > 0.01
+        if not recharging:
+            self.full += 0.2 * (voltage - self.full)
+        # Resting readings also constrain the fit, ruling out the
+        # too long time constants
+        y = self.full - voltage
+        self._sxy += self._s * y
+        self._sxx += self._s * self._s
+        self._syy += y * y
+        self.n += recharging
+
+
+class ActuationScheduler(object):
+    """ Delay the program starts of a SmartIris to protect its capacitor bank
+
+    Usually obtained with SmartIris.schedule_actuations, which makes
+    start_program, run_program and stream_program call admit before
+    starting.
+
+    Args:
+        device (SmartIris): the controller.
+        threshold (float): minimum voltage of the bank in V.
+        measure (bool): read the bank voltage before each program start
+            (one more exchange). Otherwise the voltage is only read when
+            a start has to be delayed, and the model predictions are
+            trusted in between.
+        model (RechargeModel): model of the bank, a new one by default.
+
+    Attributes:
+        delayed (float): total time the program starts were delayed, in seconds.
+    """
+    def __init__(self, device, threshold=3.5, measure=True, model=None):
+        self.device = device
+        self.threshold = threshold
+        self.measure = measure
+        self.model = RechargeModel() if model is None else model
+        self.delayed = 0.
+        self._reading = None
+
+    def read(self):
+        ''' Read the bank voltage and feed the model
+
+        A coroutine with an AsyncSmartIris device.
+        '''
+        return self.device._execute(self._read_steps())
+
+    def _read_steps(self):
+        t1 = time.time()
+        voltage = yield from self.device._adc_steps('U_BANK', self.device._capacitor_bank_voltage)
+        t2 = time.time()
+        self._reading = ((t1 + t2) * 0.5, voltage)
+        self.model.observe(self._reading[0], voltage)
+        return voltage
+
+    def _constraints(self, pulses, deficits):
+        ''' Return the margin of the bank and the (pulse, deficit) that must stay within it
+
+        Pulses discharging the bank below the threshold whatever the
+        start time make the program refused once the model is trusted.
+        Before, they are ignored: the prior may be pessimistic, and
+        running the program gives the readings needed to learn.
+        '''
+        margin = self.model.full - self.threshold
+        over = [d >= margin for d in deficits]
+        if any(over) and self.model.trusted:
+            raise ValueError(f'The program alone would discharge the capacitor bank below {self.threshold} V')
+        return margin, [(p, d) for p, d, o in zip(pulses, deficits, over) if not o]
+
+    def plan(self, pulses):
+        ''' Return the earliest host time at which a program can start safely
+
+        Args:
+            pulses: list of (end, energy) of the program, see program_pulses.
+        '''
+        model = self.model
+        now = time.time()
+        model.advance(now)
+        drop, i = model._best()
+        tau = model.taus[i]
+        margin, constraints = self._constraints(pulses, program_deficits(pulses, drop, tau))
+        # The deficit A left by the past pulses at the start must satisfy
+        # A exp(-end_j / tau) + deficit_j <= margin after each pulse j
+        limit = min((math.log(margin - d) + end / tau for (end, e), d in constraints), default=math.inf)
+        deficit = drop * model._s[i]
+        if (self._reading is not None) and (now - self._reading[0] < 0.1 * tau):
+            # Trust the measurement if it shows a deeper discharge
+            deficit = max(deficit, (model.full - self._reading[1]) * math.exp(-(now - self._reading[0]) / tau))
+        start = now
+        pending = [p for p in model._pending if p[0] > now]
+        while deficit > 0 and math.log(deficit) > limit:
+            ready = start + tau * (math.log(deficit) - limit)
+            if pending and pending[0][0] <= ready:
+                # The running program is not over yet
+                end, energy = pending.pop(0)
+                deficit = deficit * math.exp(-(end - start) / tau) + drop * energy
+                start = end
+            else:
+                return ready
+        return start
+
+    def admit(self, events, repeat=1, period=0):
+        ''' Wait until a program can start safely and account for its pulses
+
+        A coroutine with an AsyncSmartIris device, waiting without
+        blocking the event loop.
+
+        Args:
+            events: the program as (timing_counts, pin_mask) pairs, None if unknown.
+            repeat (int): number of cycles of the program.
+            period (int): period of the cycles in counts.
+
+        Raises:
+            ValueError: If the program discharges the bank below the
+                threshold even when started with a charged bank, once
+                the model is trusted.
+        '''
+        return self.device._execute(self._admit_steps(events, repeat, period))
+
+    def _admit_steps(self, events, repeat, period):
+        pulses = self._pulses(events, repeat, period)
+        if self.measure or (self.model.full is None):
+            yield from self._read_steps()
+        start = self.plan(pulses)
+        while start > time.time():
+            delay = start - time.time()
+            yield ('sleep', delay)
+            self.delayed += max(delay, 0)
+            # The reading of the recovered bank refines the model
+            yield from self._read_steps()
+            start = self.plan(pulses)
+        self.model.add_pulses(time.time(), pulses)
+
+    def _pulses(self, events, repeat, period):
+        frequency = self.device.frequency
+        pulses = program_pulses(events, frequency) if events else []
+        if repeat > 1:
+            pulses = [(k * period / frequency + end, energy) for k in range(repeat) for end, energy in pulses]
+        return pulses
+
+    def max_rate(self, events):
+        ''' Predict the maximum rate at which a program can be repeated
+
+        Args:
+            events: the program as (timing_counts, pin_mask) pairs.
+
+        Returns:
+            float: The number of executions per second sustainable
+            indefinitely, 0 if the program alone discharges the bank too
+            much. Until the model is trusted, the pulses exceeding the
+            margin on their own are ignored, as by admit.
+
+        With an AsyncSmartIris device, the bank must have been read
+        before (await read()).
+        '''
+        if self.model.full is None:
+            self.read()
+        drop, tau = self.model.parameters()
+        pulses = program_pulses(events, self.device.frequency)
+        duration = max(events[-1][0] / self.device.frequency, 1e-9)
+        if not pulses:
+            return 1 / duration
+        deficits = program_deficits(pulses, drop, tau)
+        try:
+            margin, constraints = self._constraints(pulses, deficits)
+        except ValueError:
+            return 0.
+        last_end, last = pulses[-1][0], deficits[-1]
+        def safe(period):
+            # Steady state deficit at the start of the cycles
+            carried = last * math.exp(-(period - last_end) / tau) / (-math.expm1(-period / tau))
+            return all(carried * math.exp(-end / tau) + d <= margin for (end, e), d in constraints)
+        if safe(duration):
+            return 1 / duration
+        low, high = duration, duration + tau
+        while not safe(high):
+            low, high = high, 2 * high
+        while high - low > 1e-4 * high:
+            mid = (low + high) * 0.5
+            low, high = (low, mid) if safe(mid) else (mid, high)
+        return 1 / high
@@ -0,0 +1,298 @@
+# Copyright 2024 Marc Betoule
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+''' Publish the status of a controller to other processes through shared memory
+
+The serial port can only be used by one process. A SnapshotPublisher,
+running in that process, writes the last status and ADC readings of the
+device to a small memory-mapped file with a fixed layout. Any number of
+SnapshotReaders, in any process, map the same file and read it without
+exchanging with the device, nor even making a system call.
+
+The publisher is the only writer. It protects the payload with a
+sequence lock: the sequence number is made odd before writing and even
+again after. A reader copies the payload between two reads of the
+sequence number and retries if they differ or are odd, so that it never
+returns a half-written snapshot and never blocks the publisher.
+
+Besides its own polling, the publisher catches every status read by its
+process (e.g. by SmartIris.wait), which therefore costs no exchange.
+
+Example:
+    # In the process owning the device
+    d = SmartIris()
+    d.publish_snapshot(interval=0.2)
+
+    # In any other process
+    reader = SnapshotReader(dev='/dev/ttyACM0')
+    snapshot = reader.read()
+    print(snapshot['status'], snapshot['capacitor_bank_voltage'], reader.age())
+'''
+
+import math
+import mmap
+import os
+import struct
+import threading
+import time
+
+from smartiris.daemon import _locked, socket_path
+
+# Layout of the file: header, sequence number and payload
+MAGIC = b'SIRS'
+VERSION = 1
+_header = struct.Struct('<4sII')  # magic, version, pid of the publisher
+_seq = struct.Struct('<Q')
+_seq_offset = 16
+# time of the last update, status time, raw status (com_port, read_port,
+# program_cursor, program_length, nrecords), ADC time, TMP36 temperature,
+# MCU temperature, capacitor bank voltage, number of updates, number of
+# failed readings
+_payload = struct.Struct('<dd5B3xddddQQ')
+_payload_offset = 24
+size = _payload_offset + _payload.size
+
+
+def snapshot_path(dev=''):
+    """Return the path of the file publishing the snapshots of the device dev."""
+    return os.path.splitext(socket_path(dev))[0] + '.snapshot'
+
+
+def decode(payload):
+    ''' Decode the payload of a snapshot into a dict
+
+    Times are host times (time.time), NaN values are not measured yet.
+    status is decoded as by SmartIris.status, None if not read yet.
+    '''
+    updated, status_time, com_port, read_port, cursor, length, nrecords, adc_time, temperature, mcu_temperature, voltage, updates, failures = _payload.unpack(payload)
+    from smartiris import SmartIris
+    raw = (com_port, read_port, cursor, length, nrecords)
+    return {
+        'time': updated,
+        'status': SmartIris._status_fields(raw) if status_time else None,
+        'raw_status': raw,
+        'status_time': status_time if status_time else math.nan,
+        'temperature': temperature,
+        'mcu_temperature': mcu_temperature,
+        'capacitor_bank_voltage': voltage,
+        'adc_time': adc_time,
+        'updates': updates,
+        'failures': failures,
+    }
+
+
+class SnapshotPublisher(object):
+    """ Write the status of a SmartIris to a memory-mapped file
+
+    Usually obtained with SmartIris.publish_snapshot. The device
+    exchanges are made thread-safe (see daemon._locked).
+
+    Args:
+        device (SmartIris): the controller.
+        path (str): path of the file, snapshot_path of the device path
+            by default.
+        interval (float): maximum age of the status in seconds. The
+            status is only read when the owner of the device did not
+            read it more recently.
+        adc_interval (float): time between two readings of the ADC
+            (temperatures and bank voltage) in seconds.
+        start (bool): start the background thread immediately, otherwise
+            call start.
+
+    Attributes:
+        updates (int): number of snapshots written.
+        failures (int): number of readings that failed.
+    """
+    def __init__(self, device, path=None, interval=0.1, adc_interval=1., start=True):
+        self.device = device
+        self.path = snapshot_path(device._dev) if path is None else path
+        self.interval = interval
+        self.adc_interval = adc_interval
+        self.updates = 0
+        self.failures = 0
+        self._values = [0., 0., 0, 0, 0, 0, 0, math.nan, math.nan, math.nan, math.nan]
+        # Host time of the next readings by the background thread
+        self._next_status = 0.
+        self._next_adc = 0.
+        self._lock = _locked(device)
+        # Serialize the writers (background thread and status readers)
+        self._write_lock = threading.Lock()
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if os.fstat(fd).st_size < size:
+                os.ftruncate(fd, size)
+            self._map = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+        magic, version, pid = _header.unpack_from(self._map, 0)
+        seq = _seq.unpack_from(self._map, _seq_offset)[0]
+        if (magic, version) != (MAGIC, VERSION):
+            seq = 0
+        # Readers of a previous publisher must see the sequence change
+        self._seq = seq + 2 - (seq & 1)
+        _seq.pack_into(self._map, _seq_offset, self._seq - 1)
+        _payload.pack_into(self._map, _payload_offset, *self._values, 0, 0)
+        _header.pack_into(self._map, 0, MAGIC, VERSION, os.getpid())
+        _seq.pack_into(self._map, _seq_offset, self._seq)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='smartiris-snapshot', daemon=True)
+        if start:
+            self.start()
+
+    def start(self):
+        ''' Start the background thread '''
+        self._thread.start()
+
+    def _write(self, **fields):
+        with self._write_lock:
+            if self._map is None:
+                return
+            values = self._values
+            values[0] = time.time()
+            if 'raw' in fields:
+                values[1] = fields['status_time']
+                values[2:7] = fields['raw']
+                self._next_status = values[1] + self.interval
+            if 'voltage' in fields:
+                values[7:11] = fields['adc_time'], fields['temperature'], fields['mcu_temperature'], fields['voltage']
+            self.updates += 1
+            _seq.pack_into(self._map, _seq_offset, self._seq + 1)
+            _payload.pack_into(self._map, _payload_offset, *values, self.updates, self.failures)
+            self._seq += 2
+            _seq.pack_into(self._map, _seq_offset, self._seq)
+
+    def publish_status(self, raw, t=None):
+        ''' Publish a raw status (as returned by raw_status) read at host time t (now by default) '''
+        self._write(raw=raw, status_time=time.time() if t is None else t)
+
+    def read_adc(self):
+        ''' Read and publish the temperatures and the bank voltage '''
+        from smartiris import adc_pin_maps
+        device = self.device
+        pins = [adc_pin_maps[name] for name in ('TMP36', 'MCU_TEMP', 'U_BANK')]
+        t1 = time.time()
+        tmp36, mcu, bank = device.call_many([('read_adc', (pin,)) for pin in pins])
+        t2 = time.time()
+        self._write(adc_time=(t1 + t2) * 0.5, temperature=device._temperature(tmp36),
+                    mcu_temperature=device._mcu_temperature(mcu), voltage=device._capacitor_bank_voltage(bank))
+
+    def _run(self):
+        while not self._stop.wait(max(min(self._next_status, self._next_adc) - time.time(), 0)):
+            try:
+                if time.time() >= self._next_adc:
+                    self._next_adc = time.time() + self.adc_interval
+                    self.read_adc()
+                if time.time() >= self._next_status:
+                    # Do not retry in a loop while the device is away
+                    self._next_status = time.time() + self.interval
+                    # The status is published by _decode_status
+                    self.device.status()
+            except (IOError, ValueError):
+                self.failures += 1
+
+    def stop(self):
+        ''' Stop the background thread and unmap the file
+
+        The file is left in place: readers keep the last snapshot, and
+        can tell it is stale from its time.
+        '''
+        self._stop.set()
+        if self._thread.is_alive():
+            self._thread.join()
+        if self.device.snapshot is self:
+            self.device.snapshot = None
+        with self._write_lock:
+            if self._map is not None:
+                self._map.close()
+                self._map = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+
+class SnapshotReader(object):
+    """ Read the snapshots published by a SnapshotPublisher
+
+    Args:
+        path (str): path of the file, snapshot_path(dev) by default.
+        dev (str): device of the publishing process, used to find the file.
+        timeout (float): time in seconds after which a read gives up
+            if the snapshot is still being written.
+
+    Raises:
+        IOError: If the file does not exist or has not been written by a
+            publisher.
+    """
+    def __init__(self, path=None, dev='', timeout=1.):
+        self.path = snapshot_path(dev) if path is None else path
+        self.timeout = timeout
+        with open(self.path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size < size:
+                raise IOError(f'{self.path} is not a smartiris snapshot')
+            self._map = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+        magic, version, self.pid = _header.unpack_from(self._map, 0)
+        if (magic, version) != (MAGIC, VERSION):
+            self._map.close()
+            raise IOError(f'{self.path} is not a smartiris snapshot (version {VERSION})')
+
+    def read_payload(self):
+        ''' Return a consistent copy of the raw payload and its sequence number '''
+        m = self._map
+        deadline = None
+        while True:
+            seq = _seq.unpack_from(m, _seq_offset)[0]
+            # Odd while being written
+            if not seq & 1:
+                payload = m[_payload_offset:size]
+                if _seq.unpack_from(m, _seq_offset)[0] == seq:
+                    return payload, seq
+            if deadline is None:
+                deadline = time.perf_counter() + self.timeout
+            elif time.perf_counter() > deadline:
+                raise TimeoutError('No consistent snapshot, the publisher may have died while writing')
+            # Let the writer, possibly in this process, finish
+            time.sleep(0)
+
+    def read(self):
+        ''' Return the last snapshot
+
+        Returns:
+            dict: with keys
+                - 'time': host time (time.time) of the last update.
+                - 'status': the status as returned by SmartIris.status,
+                  None if not published yet.
+                - 'raw_status': the status as returned by SmartIris.raw_status.
+                - 'status_time': host time the status was read.
+                - 'temperature', 'mcu_temperature': in deg C.
+                - 'capacitor_bank_voltage': in V.
+                - 'adc_time': host time the three above were read.
+                - 'updates', 'failures': counters of the publisher.
+        '''
+        return decode(self.read_payload()[0])
+
+    def age(self):
+        ''' Return the time in seconds since the last update of the snapshot '''
+        return time.time() - _payload.unpack(self.read_payload()[0])[0]
+
+    def close(self):
+        self._map.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -0,0 +1,163 @@
+# Copyright 2024 Marc Betoule
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+''' Map the mcu timer to the host clock in the background
+
+The mcu timer is reset at each program start and stopped at its end.
+A TimeSync anchors the mapping on the host times bracketing the last
+start_program exchange (SmartIris.program_epoch) and refines the offset
+and rate with get_time samples taken by a background thread at low duty
+cycle while the timer runs. The samples are fitted with
+clock_calibration.OnlineClockFit, weighted by their round-trip time,
+with outliers rejected and timer rollovers removed.
+
+Conversions read the current estimate without any exchange with the
+device, so that program starts and sensor events can be stamped in host
+time at no cost on the critical path.
+
+Example:
+    d = SmartIris()
+    sync = d.start_timesync(interval=1.)
+    d.timed_shutter(duration_sec=2)
+    d.wait()
+    print(d.read_timing_record(host_time=True))
+    sync.stop()
+'''
+
+import threading
+import time
+import numpy as np
+
+from smartiris.clock_calibration import OnlineClockFit, rollover
+from smartiris.daemon import _locked
+
+
+class TimeSync(object):
+    """ Track the mcu timer of a SmartIris against the host clock
+
+    The device exchanges are made thread-safe (see daemon._locked) so
+    that the owner of the device can keep using it while the background
+    thread samples the timer.
+
+    Args:
+        device (SmartIris): the controller.
+        interval (float): time between two samples in seconds.
+        start (bool): start the background thread immediately.
+
+    Attributes:
+        samples (int): number of timer samples taken.
+        failures (int): number of samples that failed.
+    """
+    def __init__(self, device, interval=1., start=True):
+        self.device = device
+        self.interval = interval
+        self.samples = 0
+        self.failures = 0
+        self._lock = _locked(device)
+        # Protect the fit, which is updated by the thread and reset by readers
+        self._model_lock = threading.Lock()
+        self._epoch = None
+        self._fit = None
+        self._last = None
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='smartiris-timesync', daemon=True)
+        if start:
+            self._thread.start()
+
+    def _new_fit(self, epoch):
+        # Called with _model_lock held
+        self._epoch = epoch
+        self._fit = OnlineClockFit(self.device.frequency)
+        self._last = None
+        if epoch is not None:
+            # The timer was reset to 0 during the start_program exchange
+            self._fit.add(epoch[0], 0, epoch[1])
+
+    def _current_fit(self):
+        epoch = self.device.program_epoch
+        with self._model_lock:
+            if (self._fit is None) or (epoch is not self._epoch):
+                self._new_fit(epoch)
+            return self._fit
+
+    def sample(self):
+        ''' Take one sample of the mcu timer and update the estimate '''
+        with self._lock:
+            epoch = self.device.program_epoch
+            t1 = time.time()
+            counts = self.device.get_time()
+            t2 = time.time()
+        self.samples += 1
+        with self._model_lock:
+            if (self._fit is None) or (epoch is not self._epoch):
+                self._new_fit(epoch)
+            if counts == self._last:
+                # The timer is stopped (end of program)
+                return
+            if (self._last is not None) and (counts < self._last) and (self._last < rollover // 2):
+                # Reset by someone else than start_program (e.g. _start_timer)
+                self._new_fit(None)
+            self._last = counts
+            self._fit.add(t1, counts, t2)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.sample()
+            except (IOError, ValueError):
+                self.failures += 1
+
+    def stop(self):
+        ''' Stop the background thread '''
+        self._stop.set()
+        if self._thread.is_alive():
+            self._thread.join()
+        if self.device.timesync is self:
+            self.device.timesync = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    @property
+    def rate(self):
+        ''' Current estimate of the mcu clock rate relative to the calibrated frequency '''
+        return self._current_fit().slope
+
+    def _model(self):
+        fit = self._current_fit()
+        if fit.n == 0:
+            raise ValueError('No program started, the mcu time is not related to the host time')
+        with self._model_lock:
+            return fit._x0, fit._y0, fit._mx, fit._my, fit.slope, fit.frequency
+
+    def mcu_to_host(self, counts):
+        ''' Convert mcu timer counts since the program start to host time
+
+        Args:
+            counts: scalar or array of counts. Counts beyond a timer
+                rollover must be given unwrapped (see clock_calibration.unwrap).
+
+        Returns:
+            host times (as time.time) in seconds, same shape as counts.
+        '''
+        x0, y0, mx, my, slope, frequency = self._model()
+        return x0 + mx + (np.asarray(counts, dtype='f8') / frequency - y0 - my) / slope
+
+    def host_to_mcu(self, t):
+        ''' Convert host times to (unwrapped) mcu timer counts since the program start '''
+        x0, y0, mx, my, slope, frequency = self._model()
+        return (y0 + my + slope * (np.asarray(t, dtype='f8') - x0 - mx)) * frequency
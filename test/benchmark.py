@@ -0,0 +1,180 @@
+''' Performance benchmarks of the host software on an emulated controller
+
+The benchmarks run against smartiris.emulator, without any hardware, and
+measure the cost of the host-side stack:
+    connect_cold     connection reading the whole command table
+    connect_cached   connection reusing the cached command table
+    rtt              one device function call
+    rtt_pipelined    one call in a batch of 100 pipelined calls
+    upload           upload of a modified 4 events program
+    wait_overhead    time spent in wait() after the end of the program
+    record_readout   read_timing_record() after an exposure
+    cli_startup      import overhead of the command line control path
+    cli_status       complete "smartiris status" command
+By default the emulator answers immediately, so that the results reflect
+the host software rather than the (emulated) link.
+
+Results (median times in seconds) are compared to the baselines stored
+in benchmark_baseline.json and the script exits with a non-zero status
+if one of them regressed by more than the tolerance factor, or if the
+command line control path imports one of the heavy modules. Baselines
+depend on the machine and should be refreshed with --update when moving
+to a new one.
+
+Usage: python test/benchmark.py [-h] [--update] [--tolerance T] [benchmark ...]
+'''
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root)
+import smartiris
+from smartiris.emulator import Emulator
+
+baseline_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmark_baseline.json')
+# Modules that must not be loaded by the command line control path
+forbidden = ['numpy', 'matplotlib', 'ntplib', 'tqdm', 'socketserver']
+control_path = 'import smartiris, smartiris.daemon'
+# Differences below this are considered noise whatever the ratio
+min_slack = 50e-6
+# Except for wait(), which polls the status every 2 ms
+slack = {'wait_overhead': 2e-3}
+
+
+def median_time(func, repeat):
+    times = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+
+def connect_cold(e):
+    return median_time(lambda: smartiris.SmartIris(dev=e.path, cache=False).com.close(), 10)
+
+
+def connect_cached(e):
+    smartiris.SmartIris(dev=e.path).com.close()
+    return median_time(lambda: smartiris.SmartIris(dev=e.path).com.close(), 10)
+
+
+def rtt(e):
+    d = smartiris.SmartIris(dev=e.path)
+    return median_time(d.get_time, 500)
+
+
+def rtt_pipelined(e):
+    d = smartiris.SmartIris(dev=e.path)
+    calls = [('get_time', ())] * 100
+    return median_time(lambda: d.call_many(calls), 20) / len(calls)
+
+
+def upload(e):
+    d = smartiris.SmartIris(dev=e.path)
+    durations = iter([0.1, 0.2] * 50)
+    return median_time(lambda: d.timed_shutter(duration_sec=next(durations), exec=False), 100)
+
+
+def wait_overhead(e):
+    d = smartiris.SmartIris(dev=e.path)
+    d.timed_shutter(duration_sec=0.05)
+    d.wait()
+    end = d.read_program()[-1][0] / e.frequency
+    def run():
+        d.start_program()
+        d.wait()
+    return median_time(run, 20) - end
+
+
+def record_readout(e):
+    d = smartiris.SmartIris(dev=e.path)
+    d.timed_shutter(duration_sec=0.05)
+    d.wait()
+    return median_time(d.read_timing_record, 100)
+
+
+def _run(code, *args):
+    subprocess.run([sys.executable, '-c', code] + list(args), check=True, cwd=root, stdout=subprocess.DEVNULL)
+
+
+def cli_startup(e):
+    loaded = subprocess.run([sys.executable, '-c', f'import sys; {control_path}; print(" ".join(sys.modules))'],
+                            check=True, capture_output=True, text=True, cwd=root).stdout.split()
+    leaks = [m for m in forbidden if m in loaded]
+    if leaks:
+        raise RuntimeError(f'the control path imports {leaks}')
+    _run(control_path) # warm the bytecode cache
+    bare = median_time(lambda: _run('pass'), 20)
+    return median_time(lambda: _run(control_path), 20) - bare
+
+
+def cli_status(e):
+    smartiris.SmartIris(dev=e.path).com.close()
+    status = lambda: _run('import smartiris; smartiris.test()', '-t', e.path, 'status')
+    return median_time(status, 10)
+
+
+benchmarks = [connect_cold, connect_cached, rtt, rtt_pipelined, upload, wait_overhead, record_readout, cli_startup, cli_status]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the host software on an emulated controller')
+    parser.add_argument('names', nargs='*', help='benchmarks to run (default all)')
+    parser.add_argument('--update', action='store_true', help='store the results as the new baselines')
+    parser.add_argument('--tolerance', type=float, default=1.5, help='accepted ratio to the baselines')
+    parser.add_argument('--latency', type=float, default=0., help='emulated answer latency in seconds')
+    parser.add_argument('--baudrate', type=int, default=0, help='emulated link speed (0 for infinite)')
+    args = parser.parse_args()
+
+    selected = [b for b in benchmarks if (not args.names) or (b.__name__ in args.names)]
+    try:
+        with open(baseline_file) as fid:
+            baselines = json.load(fid)
+    except OSError:
+        baselines = {}
+    # Keep the cache of the emulated devices out of the user one
+    os.environ['XDG_CACHE_HOME'] = tempfile.mkdtemp()
+    # Do not talk to a daemon serving the user devices
+    os.environ['XDG_RUNTIME_DIR'] = os.environ['XDG_CACHE_HOME']
+
+    failed = []
+    results = {}
+    print(f'{"benchmark":16s} {"time (ms)":>10s} {"baseline":>10s} {"ratio":>6s}')
+    with Emulator(latency=args.latency, baudrate=args.baudrate) as e:
+        e.set_clock_calibration(e.frequency)
+        for benchmark in selected:
+            name = benchmark.__name__
+            try:
+                results[name] = result = benchmark(e)
+            except Exception as error:
+                print(f'{name:16s} FAILED: {error}')
+                failed.append(name)
+                continue
+            line = f'{name:16s} {result * 1e3:10.3f}'
+            if name in baselines:
+                ratio = result / baselines[name] if baselines[name] > 0 else float('inf')
+                line += f' {baselines[name] * 1e3:10.3f} {ratio:6.2f}'
+                if (ratio > args.tolerance) and (result - baselines[name] > slack.get(name, min_slack)):
+                    line += ' REGRESSION'
+                    failed.append(name)
+            print(line)
+    if args.update:
+        baselines.update(results)
+        with open(baseline_file, 'w') as fid:
+            json.dump(baselines, fid, indent=2, sort_keys=True)
+            fid.write('\n')
+        print(f'Baselines written to {baseline_file}')
+    elif failed:
+        print(f'FAILED: {failed}')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,31 @@
+''' Fixtures running the tests against the emulated controller (see smartiris.emulator) '''
+import warnings
+
+import pytest
+
+import smartiris
+from smartiris.emulator import Emulator
+
+
+@pytest.fixture(autouse=True)
+def cache_home(tmp_path, monkeypatch):
+    # Keep the bincoms cache of the tests away from the user one
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmp_path / 'cache'))
+    monkeypatch.setenv('XDG_RUNTIME_DIR', str(tmp_path))
+    return tmp_path / 'cache'
+
+
+@pytest.fixture
+def emulator():
+    with Emulator() as e:
+        e.set_clock_calibration(2e6)
+        yield e
+
+
+@pytest.fixture
+def device(emulator):
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        d = smartiris.SmartIris(dev=emulator.path)
+    yield d
+    d.com.close()
@@ -0,0 +1,66 @@
+import asyncio
+import gc
+import warnings
+
+import pytest
+
+from smartiris.aio import AsyncSmartIris
+from smartiris.emulator import Emulator
+
+
+def run(coroutine):
+    return asyncio.run(coroutine)
+
+
+async def connect(emulator):
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        return await AsyncSmartIris.connect(dev=emulator.path)
+
+
+def test_timeout_realigns_answers(emulator):
+    async def main():
+        d = await connect(emulator)
+        d.timeout = 0.1
+        emulator.latency = 0.3
+        with pytest.raises(ValueError, match='No answer'):
+            await d.read_adc(1)
+        emulator.latency = 0
+        d.timeout = 3
+        # The late answer of read_adc(1) must not be taken for this one
+        assert await d.read_adc(8) == 173
+        assert await d.read_adc(1) == 971
+        assert d.resync_counters['resyncs'] == 1
+        assert d.resync_counters['stale_answers'] >= 1
+        d.close()
+    loop_errors = []
+    async def checked():
+        asyncio.get_running_loop().set_exception_handler(lambda loop, context: loop_errors.append(context))
+        await main()
+    run(checked())
+    gc.collect()
+    assert not loop_errors
+
+
+def test_disconnect_fails_requests(emulator):
+    async def main():
+        d = await connect(emulator)
+        await d.get_time()
+        emulator.close()
+        with pytest.raises(IOError, match='disconnected'):
+            await d.get_time()
+        # Without waiting for a timeout
+        with pytest.raises(IOError, match='disconnected'):
+            await asyncio.wait_for(d.get_time(), 1)
+    run(main())
+
+
+def test_shutter_program(emulator):
+    async def main():
+        d = await connect(emulator)
+        await d.timed_shutter(duration_sec=0.05)
+        status = await d.wait()
+        assert status['shutter_A'] == 'closed'
+        assert len(await d.read_timing_record()) == 2
+        d.close()
+    run(main())
@@ -0,0 +1,42 @@
+''' On-disk cache of the command table and device constants '''
+import os
+import warnings
+
+import bincoms
+import smartiris
+
+
+def connect(emulator, **keys):
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        return smartiris.SmartIris(dev=emulator.path, **keys)
+
+
+def test_cached_connection(emulator, cache_home, monkeypatch):
+    monkeypatch.setattr(bincoms, 'serial_number', lambda dev: 'A10K2X')
+    d = connect(emulator)
+    d.com.close()
+    assert os.listdir(cache_home / 'bincoms')[0].startswith('A10K2X-')
+    cold = emulator.nframes
+    # The constants come from the cache, not from the device
+    emulator.signature_row[2] = 5
+    d = connect(emulator)
+    d.com.close()
+    assert emulator.nframes - cold < cold / 4
+    assert d.cache['ts_calibration'] == [0, 128]
+    assert d._ts_offset == 0
+
+
+def test_cache_without_serial_number(emulator, cache_home, monkeypatch):
+    monkeypatch.setattr(bincoms, 'serial_number', lambda dev: None)
+    d = connect(emulator)
+    d.com.close()
+    cold = emulator.nframes
+    # Another device with the same firmware on the same path
+    emulator.signature_row[2] = 5
+    d = connect(emulator)
+    d.com.close()
+    assert emulator.nframes - cold < cold / 4
+    assert d._ts_offset == 5
+    assert list(d.cache) == ['commands']
+
@@ -0,0 +1,44 @@
+''' The smartiris command, directly and through a daemon '''
+import os
+import subprocess
+import sys
+import time
+
+import pytest
+
+import smartiris.daemon
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def smartiris_command(*args, **keys):
+    env = dict(os.environ, PYTHONPATH=root)
+    return subprocess.Popen([sys.executable, '-c', 'import smartiris; smartiris.test()'] + list(args),
+                            env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, **keys)
+
+
+@pytest.fixture
+def daemon(emulator):
+    server = smartiris_command('-t', emulator.path, 'serve')
+    path = smartiris.daemon.socket_path(emulator.path)
+    deadline = time.monotonic() + 10
+    while not os.path.exists(path):
+        assert (server.poll() is None) and (time.monotonic() < deadline), 'the daemon did not start'
+        time.sleep(0.05)
+    yield server
+    server.terminate()
+    server.communicate()
+
+
+def test_status_through_daemon(emulator, daemon):
+    out, err = smartiris_command('-t', emulator.path, 'status').communicate(timeout=30)
+    assert "'busy': False" in out
+
+
+def test_calibrate_refused_by_daemon(emulator, daemon):
+    command = smartiris_command('-t', emulator.path, 'calibrate', '-d', '0.01')
+    out, err = command.communicate(timeout=30)
+    assert command.returncode == 2
+    assert 'stop it to calibrate' in err
+    # The daemon is left untouched
+    assert daemon.poll() is None
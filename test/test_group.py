@@ -0,0 +1,71 @@
+''' Synchronized start of several emulated controllers '''
+import pytest
+
+import bincoms
+import smartiris
+from smartiris.emulator import Emulator
+
+
+@pytest.fixture
+def group():
+    with Emulator() as e1, Emulator() as e2:
+        for e in (e1, e2):
+            e.set_clock_calibration(2e6)
+        g = smartiris.SmartIrisGroup([e1.path, e2.path])
+        yield g, (e1, e2)
+        for d in g:
+            d.com.close()
+
+
+def test_group_start(group):
+    g, emulators = group
+    g.timed_shutter(duration_sec=0.05)
+    assert g.start_skew < 0.1
+    g.wait(timeout=2)
+    assert [e.run for e in emulators] == [1, 1]
+    assert [len(d.read_timing_record()) for d in g] == [2, 2]
+
+
+def test_group_start_after_reset(group):
+    g, (e1, e2) = group
+    g.timed_shutter(duration_sec=0.05, exec=False)
+    e1.reset()
+    g.start_program()
+    g.wait(timeout=2)
+    # The program was uploaded again and started alone
+    assert (e1.run, e2.run) == (1, 1)
+    assert g[0].status()['program_length'] == 4
+
+
+def test_group_start_lost_answer(group, monkeypatch):
+    g, (e1, e2) = group
+    g.timed_shutter(duration_sec=0.05, exec=False)
+    d = g[0]
+    rcv = d.rcv
+    def corrupted():
+        rcv()
+        raise bincoms.CommunicationError('Answered string not understood')
+    monkeypatch.setattr(d, 'rcv', corrupted)
+    g.start_program()
+    monkeypatch.undo()
+    # The start was executed, it must not be repeated
+    assert (e1.run, e2.run) == (1, 1)
+    assert d._started is not None
+    g.wait(timeout=2)
+
+
+def test_group_start_dropped_request(group, monkeypatch):
+    g, (e1, e2) = group
+    g.timed_shutter(duration_sec=0.05, exec=False)
+    d = g[0]
+    d.timeout = 0.2
+    send = d._send
+    def dropped(data, nframes=1):
+        d._unanswered += nframes
+        monkeypatch.setattr(d, '_send', send)
+    monkeypatch.setattr(d, '_send', dropped)
+    g.start_program()
+    # The device never saw the start and was started alone
+    assert (e1.run, e2.run) == (1, 1)
+    g.wait(timeout=2)
+    assert [len(d.read_timing_record()) for d in g] == [2, 2]
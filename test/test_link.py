@@ -0,0 +1,62 @@
+''' Recovery of the answer stream after link errors, pipelining '''
+import warnings
+
+import pytest
+
+import bincoms
+import smartiris
+
+
+def test_resync_after_garbage(device, emulator):
+    emulator.inject(b'\x00\x13garbage')
+    with pytest.raises(bincoms.CommunicationError):
+        device.get_time()
+    assert device.get_program(0, 0) == (0, 0)
+    assert device.resync_counters['resyncs'] == 1
+    assert device.resync_counters['discarded_bytes'] > 0
+
+
+def test_resync_after_pipelined_garbage(device, emulator):
+    emulator.inject(b'zzz')
+    answers = device.call_many([('get_time', ())] * 5, return_exceptions=True)
+    assert isinstance(answers[0], bincoms.CommunicationError)
+    assert device.call_many([('read_adc', (8,))] * 5) == [173] * 5
+
+
+def test_stale_answer_after_timeout(device, emulator):
+    emulator.latency = 0.3
+    device.timeout = 0.1
+    with pytest.raises(bincoms.CommunicationError, match='No answer'):
+        device.read_adc(1)
+    emulator.latency = 0.
+    device.timeout = 3
+    # The late answer is discarded, not taken for the next one
+    assert device.read_adc(8) == 173
+    assert device.resync_counters['stale_answers'] >= 1
+    assert device.metrics.timeouts == 1
+
+
+def test_program_kept_after_resync(device, emulator):
+    device.timed_shutter(duration_sec=0.02)
+    device.wait(timeout=2)
+    emulator.inject(b'garbage')
+    with pytest.raises(bincoms.CommunicationError):
+        device.status()
+    device.timed_shutter(duration_sec=0.02)
+    device.wait(timeout=2)
+    assert emulator.run == 2
+    assert len(device.read_timing_record()) == 2
+
+
+def test_cold_connection_is_pipelined(emulator, monkeypatch):
+    inflight = []
+    send = bincoms.SerialBC._send
+    def counted(self, data, nframes=1):
+        inflight.append(self._unanswered + nframes)
+        return send(self, data, nframes)
+    monkeypatch.setattr(bincoms.SerialBC, '_send', counted)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        smartiris.SmartIris(dev=emulator.path, cache=False).com.close()
+    # The command names (strings) are read several at a time
+    assert max(inflight) > 3
@@ -0,0 +1,70 @@
+''' Uploads of the working program and resident programs '''
+import pytest
+
+import smartiris
+
+
+def program(duration):
+    return [(200, 2), (60200, 2), (200 + duration, 1), (60200 + duration, 1)]
+
+
+def test_upload_unchanged_program(device, emulator):
+    device.upload_program(program(100000))
+    frames = emulator.nframes
+    device.upload_program(program(100000))
+    assert emulator.nframes == frames
+
+
+def test_upload_changed_slots(device, emulator):
+    device.upload_program(program(100000))
+    frames = emulator.nframes
+    device.upload_program(program(200000))
+    # Two slots written (the last one sets the length), read back, and
+    # the program length checked before and after
+    assert emulator.nframes - frames == 6
+    assert [tuple(slot) for slot in emulator.program[:4]] == program(200000)
+
+
+def test_upload_after_reset(device, emulator):
+    device.upload_program(program(100000))
+    emulator.reset()
+    # The device lost the program, the start writes it again
+    device.start_program()
+    device.wait(timeout=2)
+    assert emulator.run == 1
+    assert device.read_program() == program(100000)
+
+
+def test_store_unchanged_program(device, emulator):
+    device.store_program('short', program(100000))
+    frames = emulator.nframes
+    device.store_program('short', program(100000))
+    assert emulator.nframes == frames
+
+
+def test_bank_reuse(device):
+    for k in range(smartiris.N_BANKS):
+        device.store_program(f'p{k}', program(100000 * (k + 1)))
+    device.run_program('p0')
+    device.wait(timeout=2)
+    banks = {name: bank for name, (bank, events) in device.programs.items()}
+    # The least recently run program gives its bank
+    device.store_program('new', program(50000))
+    assert 'p1' not in device.programs
+    assert device.programs['new'][0] == banks['p1']
+    for name in ('p0', 'new'):
+        device.run_program(name)
+        device.wait(timeout=2)
+        assert device.read_timing_record()[-1][1] == 'sensorA'
+    with pytest.raises(KeyError):
+        device.run_program('p1')
+
+
+def test_run_program_after_reset(device, emulator):
+    device.store_program('exposure', program(100000))
+    emulator.reset()
+    # The device lost its banks, the program is stored again
+    device.run_program('exposure')
+    device.wait(timeout=2)
+    assert emulator.run == 1
+    assert len(device.read_timing_record()) == 2
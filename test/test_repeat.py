@@ -0,0 +1,47 @@
+''' Programs repeated by the device and their records split by cycle '''
+import pytest
+
+
+def expose(device, cycles):
+    # The pulses outlast the actuation delay of the shutter, so that the
+    # sensor events happen while the program runs
+    device.timed_shutter(duration_sec=0.01, pulsewidth_sec=15e-3, repeat=cycles, period_sec=0.04)
+    device.wait(timeout=3)
+
+
+def test_cycle_records(device, emulator):
+    expose(device, 5)
+    assert emulator.run == 1
+    cycles = device.read_cycle_records()
+    assert len(cycles) == 5
+    for records in cycles:
+        # Timed from the start of each cycle
+        assert [sensor for t, sensor in records] == ['sensorA', 'sensorA']
+        assert records[0][0] == pytest.approx(0.0121, abs=1e-4)
+        assert records[1][0] - records[0][0] == pytest.approx(0.01, abs=1e-4)
+
+
+def test_cycle_records_truncated(device):
+    # 20 sensor events, beyond the record of the device
+    expose(device, 10)
+    cycles = device.read_cycle_records()
+    assert [len(records) for records in cycles[:7]] == [2] * 7
+    assert cycles[7:] == [None] * 3
+
+
+def test_streamed_cycle_records(device):
+    stream = device.stream_events()
+    try:
+        expose(device, 10)
+        cycles = device.read_cycle_records()
+    finally:
+        stream.stop()
+    assert [len(records) for records in cycles] == [2] * 10
+    assert cycles[9][1][0] == pytest.approx(0.0221, abs=1e-4)
+
+
+def test_repeat_requires_period(device):
+    with pytest.raises(ValueError):
+        device.timed_shutter(duration_sec=0.01, repeat=3)
+    with pytest.raises(ValueError):
+        device.timed_shutter(duration_sec=0.05, repeat=3, period_sec=0.01)
@@ -0,0 +1,37 @@
+import pytest
+
+import smartiris
+from smartiris import MAX_N_EVENTS, port_pins
+
+
+def pulses(n, step=20000):
+    ''' n open/close pulse pairs on port B, step counts apart '''
+    pins = port_pins['B']
+    return [((k + 1) * step, pins['open'] if (k // 2) % 2 == 0 else pins['close']) for k in range(2 * n)]
+
+
+def test_long_program_is_streamed(device, emulator):
+    events = pulses(20, step=4000)
+    assert len(events) > MAX_N_EVENTS
+    device.stream_program(events)
+    device.wait()
+    assert not emulator.streaming_program
+    assert device.status()['program_length'] == MAX_N_EVENTS
+
+
+def test_start_after_aborted_stream(device, emulator, monkeypatch):
+    # The host gives up (timeout, Ctrl-C) before the end of the stream
+    def interrupted():
+        raise KeyboardInterrupt
+    monkeypatch.setattr(device, 'raw_status', interrupted)
+    with pytest.raises(KeyboardInterrupt):
+        device.stream_program(pulses(20, step=200000))
+    monkeypatch.undo()
+    assert emulator.streaming_program
+    device.timed_shutter(duration_sec=0.05)
+    assert not emulator.streaming_program
+    status = device.wait()
+    assert status['program_length'] == 4
+    assert status['shutter_A'] == 'closed'
+    assert status['shutter_B'] == 'closed'
+    assert [pin for t, pin in device.read_timing_record()] == ['sensorA', 'sensorA']
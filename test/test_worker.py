@@ -0,0 +1,47 @@
+''' Sharing a controller between threads through the I/O worker '''
+import threading
+import time
+
+
+def test_operations_are_not_interleaved(device):
+    device.start_worker()
+    order = []
+    started = threading.Event()
+    def steps():
+        yield ('call', 'get_time', ())
+        started.set()
+        time.sleep(0.2)
+        yield ('call', 'get_time', ())
+        order.append('operation')
+    def other():
+        started.wait()
+        device.read_adc(1)
+        order.append('other')
+    thread = threading.Thread(target=other)
+    thread.start()
+    device._execute(steps())
+    thread.join()
+    device.worker.stop()
+    assert order == ['operation', 'other']
+
+
+def test_lock_released_while_sleeping(device):
+    device.start_worker()
+    order = []
+    started = threading.Event()
+    def steps():
+        started.set()
+        yield ('sleep', 0.2)
+        yield ('call', 'get_time', ())
+        order.append('operation')
+    def other():
+        started.wait()
+        device.read_adc(1)
+        order.append('other')
+    thread = threading.Thread(target=other)
+    thread.start()
+    device._execute(steps())
+    thread.join()
+    device.worker.stop()
+    assert order == ['other', 'operation']
+